@@ -0,0 +1,92 @@
+"""Benchmark: built-in bmff remuxer vs. `ffmpeg -c copy` for merging DASH tracks.
+
+Usage:
+    python bench/bench_remux.py                       # synthesize inputs with ffmpeg lavfi
+    python bench/bench_remux.py --video v.m4s --audio a.m4s --iterations 20
+
+Prints a JSON report with per-muxer wall-clock timings.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bmff  # noqa: E402
+
+
+def _synthesize(work_dir: str, seconds: int):
+    """Generate fragmented MP4 video/audio tracks shaped like Bilibili's DASH segments."""
+    video = os.path.join(work_dir, "video.m4s")
+    audio = os.path.join(work_dir, "audio.m4s")
+    frag = ["-movflags", "+frag_keyframe+empty_moov+default_base_moof", "-f", "mp4"]
+    subprocess.run(
+        ["ffmpeg", "-y", "-v", "error", "-f", "lavfi", "-i", f"testsrc2=size=1280x720:rate=30:duration={seconds}",
+         "-c:v", "libx264", "-preset", "ultrafast", "-g", "60", *frag, video],
+        check=True,
+    )
+    subprocess.run(
+        ["ffmpeg", "-y", "-v", "error", "-f", "lavfi", "-i", f"sine=frequency=440:duration={seconds}",
+         "-c:a", "aac", "-b:a", "128k", *frag, audio],
+        check=True,
+    )
+    return video, audio
+
+
+def _run_bmff(video: str, audio: str, out: str) -> None:
+    bmff.remux_files(video, audio, out)
+
+
+def _run_ffmpeg(video: str, audio: str, out: str) -> None:
+    subprocess.run(
+        ["ffmpeg", "-y", "-v", "error", "-i", video, "-i", audio,
+         "-map", "0:v:0", "-map", "1:a:0", "-c", "copy", "-movflags", "+faststart", "-f", "mp4", out],
+        check=True,
+    )
+
+
+def _bench(fn, video: str, audio: str, out: str, iterations: int) -> dict:
+    samples = []
+    for _ in range(iterations):
+        t0 = time.perf_counter()
+        fn(video, audio, out)
+        samples.append((time.perf_counter() - t0) * 1000.0)
+    return {
+        "iterations": iterations,
+        "min_ms": round(min(samples), 3),
+        "median_ms": round(statistics.median(samples), 3),
+        "max_ms": round(max(samples), 3),
+        "output_bytes": os.path.getsize(out),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--video", help="video track (.m4s); synthesized when omitted")
+    parser.add_argument("--audio", help="audio track (.m4s); synthesized when omitted")
+    parser.add_argument("--seconds", type=int, default=60, help="length of synthesized inputs")
+    parser.add_argument("--iterations", type=int, default=10)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="bench_remux_") as work_dir:
+        if args.video and args.audio:
+            video, audio = args.video, args.audio
+        else:
+            video, audio = _synthesize(work_dir, args.seconds)
+        report = {
+            "inputs": {"video_bytes": os.path.getsize(video), "audio_bytes": os.path.getsize(audio)},
+            "bmff": _bench(_run_bmff, video, audio, os.path.join(work_dir, "bmff.mp4"), args.iterations),
+            "ffmpeg": _bench(_run_ffmpeg, video, audio, os.path.join(work_dir, "ffmpeg.mp4"), args.iterations),
+        }
+        report["speedup"] = round(report["ffmpeg"]["median_ms"] / max(report["bmff"]["median_ms"], 1e-6), 2)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
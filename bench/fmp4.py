@@ -0,0 +1,130 @@
+"""Synthetic single-track fragmented MP4 files shaped like Bilibili DASH m4s.
+
+The sample data is filler, not decodable media: the files exist to exercise
+the proxy, ranged fetcher and box-level remuxer (bmff.py) at a chosen size.
+
+    video, audio = make_pair(video_bytes=4 << 20, audio_bytes=512 << 10)
+"""
+
+import os
+import struct
+from typing import Tuple
+
+_FILLER = os.urandom(64 * 1024)
+
+
+def _box(box_type: bytes, *payload: bytes) -> bytes:
+    body = b"".join(payload)
+    return struct.pack(">I4s", 8 + len(body), box_type) + body
+
+
+def _full_box(box_type: bytes, version: int, flags: int, *payload: bytes) -> bytes:
+    return _box(box_type, struct.pack(">I", (version << 24) | flags), *payload)
+
+
+_MATRIX = struct.pack(">9I", 0x00010000, 0, 0, 0, 0x00010000, 0, 0, 0, 0x40000000)
+
+
+def _sample_entry(kind: str) -> bytes:
+    if kind == "video":
+        return _box(
+            b"avc1",
+            b"\x00" * 6 + struct.pack(">H", 1),
+            b"\x00" * 16,
+            struct.pack(">HHII", 1920, 1080, 0x00480000, 0x00480000),
+            b"\x00" * 4 + struct.pack(">H", 1) + b"\x00" * 32 + struct.pack(">Hh", 0x18, -1),
+        )
+    return _box(
+        b"mp4a",
+        b"\x00" * 6 + struct.pack(">H", 1),
+        b"\x00" * 8,
+        struct.pack(">HHHHI", 2, 16, 0, 0, 48000 << 16),
+    )
+
+
+def _init_segment(kind: str, track_id: int, timescale: int, sample_duration: int) -> bytes:
+    handler = b"vide" if kind == "video" else b"soun"
+    media_header = (
+        _full_box(b"vmhd", 0, 1, b"\x00" * 8) if kind == "video" else _full_box(b"smhd", 0, 0, b"\x00" * 4)
+    )
+    stbl = _box(
+        b"stbl",
+        _full_box(b"stsd", 0, 0, struct.pack(">I", 1), _sample_entry(kind)),
+        _full_box(b"stts", 0, 0, struct.pack(">I", 0)),
+        _full_box(b"stsc", 0, 0, struct.pack(">I", 0)),
+        _full_box(b"stsz", 0, 0, struct.pack(">II", 0, 0)),
+        _full_box(b"stco", 0, 0, struct.pack(">I", 0)),
+    )
+    minf = _box(
+        b"minf",
+        media_header,
+        _box(b"dinf", _full_box(b"dref", 0, 0, struct.pack(">I", 1), _full_box(b"url ", 0, 1))),
+        stbl,
+    )
+    mdia = _box(
+        b"mdia",
+        _full_box(b"mdhd", 0, 0, struct.pack(">IIIIHH", 0, 0, timescale, 0, 0x55C4, 0)),
+        _full_box(b"hdlr", 0, 0, struct.pack(">I4s", 0, handler), b"\x00" * 12, kind.encode() + b"\x00"),
+        minf,
+    )
+    width, height = (1920 << 16, 1080 << 16) if kind == "video" else (0, 0)
+    tkhd = _full_box(
+        b"tkhd",
+        0,
+        3,
+        struct.pack(">IIIII", 0, 0, track_id, 0, 0),
+        b"\x00" * 8,
+        struct.pack(">hhhH", 0, 0, 0x0100 if kind == "audio" else 0, 0),
+        _MATRIX,
+        struct.pack(">II", width, height),
+    )
+    mvhd = _full_box(
+        b"mvhd",
+        0,
+        0,
+        struct.pack(">IIIIIH", 0, 0, 1000, 0, 0x00010000, 0x0100),
+        b"\x00" * 10,
+        _MATRIX,
+        b"\x00" * 24,
+        struct.pack(">I", track_id + 1),
+    )
+    trex = _full_box(b"trex", 0, 0, struct.pack(">IIIII", track_id, 1, sample_duration, 0, 0))
+    ftyp = _box(b"ftyp", b"iso5", struct.pack(">I", 512), b"iso5iso6mp41")
+    return ftyp + _box(b"moov", mvhd, _box(b"trak", tkhd, mdia), _box(b"mvex", trex))
+
+
+def _fragment(seq: int, track_id: int, decode_time: int, sample_duration: int, sizes: list) -> bytes:
+    # default-base-is-moof; trun carries data_offset, per-sample duration and size
+    tfhd = _full_box(b"tfhd", 0, 0x020000, struct.pack(">I", track_id))
+    tfdt = _full_box(b"tfdt", 1, 0, struct.pack(">Q", decode_time))
+    samples = b"".join(struct.pack(">II", sample_duration, size) for size in sizes)
+    trun_len = 8 + 4 + 4 + 4 + len(samples)
+    moof_len = 8 + (8 + 8) + 8 + len(tfhd) + len(tfdt) + trun_len
+    trun = _full_box(b"trun", 0, 0x000301, struct.pack(">Ii", len(sizes), moof_len + 8), samples)
+    moof = _box(b"moof", _full_box(b"mfhd", 0, 0, struct.pack(">I", seq)), _box(b"traf", tfhd, tfdt, trun))
+    assert len(moof) == moof_len
+    payload_len = sum(sizes)
+    payload = (_FILLER * (payload_len // len(_FILLER) + 1))[:payload_len]
+    return moof + _box(b"mdat", payload)
+
+
+def make_track(kind: str, size: int, fragment_seconds: float = 2.0) -> bytes:
+    """One m4s of roughly `size` bytes (video: 30 fps; audio: 48 kHz AAC-like frames)."""
+    track_id = 1
+    if kind == "video":
+        timescale, sample_duration, per_second = 15360, 512, 30
+    else:
+        timescale, sample_duration, per_second = 48000, 1024, 48000 / 1024
+    per_fragment = max(1, int(per_second * fragment_seconds))
+    fragments = max(1, size // (256 * 1024))
+    sample_size = max(1, size // (fragments * per_fragment))
+    out = [_init_segment(kind, track_id, timescale, sample_duration)]
+    for i in range(fragments):
+        out.append(
+            _fragment(i + 1, track_id, i * per_fragment * sample_duration, sample_duration, [sample_size] * per_fragment)
+        )
+    return b"".join(out)
+
+
+def make_pair(video_bytes: int = 4 << 20, audio_bytes: int = 512 << 10) -> Tuple[bytes, bytes]:
+    return make_track("video", video_bytes), make_track("audio", audio_bytes)
@@ -0,0 +1,257 @@
+"""Load test server.py against the local Bilibili stub (no network needed).
+
+Starts bench/stub.py in-process, launches `uvicorn server:app` pointed at it, and
+drives each scenario at each concurrency level for a fixed duration:
+
+    python bench/run_load.py --concurrency 1,8,32 --duration 10 --out before.json
+    python bench/run_load.py --concurrency 1,8,32 --duration 10 --compare before.json
+
+Scenarios: stream-video, download-video, download-audio, merge, merge-stream.
+Reports req/s, latency p50/p99/mean, status counts, bytes, and the server's
+peak RSS and open fd count per run as JSON.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from typing import Dict, List, Optional
+
+import httpx
+
+import stub
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SCENARIOS = {
+    "stream-video": ("/stream/video", {}),
+    "download-video": ("/download/video", {}),
+    "download-audio": ("/download/audio", {}),
+    "merge": ("/merge/mp4/remote", {}),
+    "merge-stream": ("/merge/mp4/remote", {"stream": "1"}),
+}
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _percentile(values: List[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+
+class _ProcSampler:
+    """Polls /proc/<pid> for VmRSS and open fds while a run is in progress."""
+
+    def __init__(self, pid: int, interval: float = 0.2) -> None:
+        self.pid = pid
+        self.interval = interval
+        self.rss_kb_max = 0
+        self.fds_max = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _sample(self) -> None:
+        try:
+            with open(f"/proc/{self.pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        self.rss_kb_max = max(self.rss_kb_max, int(line.split()[1]))
+                        break
+            self.fds_max = max(self.fds_max, len(os.listdir(f"/proc/{self.pid}/fd")))
+        except OSError:
+            pass
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            self._sample()
+            self._stop.wait(self.interval)
+
+    def __enter__(self) -> "_ProcSampler":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._stop.set()
+        self._thread.join()
+        self._sample()
+
+
+async def _drive(base: str, scenario: str, concurrency: int, duration: float, bvids: int) -> Dict:
+    path, extra = SCENARIOS[scenario]
+    latencies: List[float] = []
+    statuses: Dict[str, int] = {}
+    errors: Dict[str, int] = {}
+    total_bytes = 0
+    counter = 0
+    deadline = time.perf_counter() + duration
+
+    async def worker(client: httpx.AsyncClient) -> None:
+        nonlocal total_bytes, counter
+        while time.perf_counter() < deadline:
+            counter += 1
+            params = dict(extra, bvid=f"BV1bench{counter % bvids:04d}")
+            started = time.perf_counter()
+            try:
+                async with client.stream("GET", path, params=params) as resp:
+                    async for chunk in resp.aiter_raw():
+                        total_bytes += len(chunk)
+                statuses[str(resp.status_code)] = statuses.get(str(resp.status_code), 0) + 1
+            except httpx.HTTPError as e:
+                errors[type(e).__name__] = errors.get(type(e).__name__, 0) + 1
+                continue
+            latencies.append(time.perf_counter() - started)
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base, limits=limits, timeout=120.0) as client:
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(client) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+
+    ms = [x * 1000.0 for x in latencies]
+    return {
+        "scenario": scenario,
+        "concurrency": concurrency,
+        "seconds": round(elapsed, 3),
+        "requests": len(latencies),
+        "rps": round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        "p50_ms": round(_percentile(ms, 0.50), 2) if ms else None,
+        "p99_ms": round(_percentile(ms, 0.99), 2) if ms else None,
+        "mean_ms": round(sum(ms) / len(ms), 2) if ms else None,
+        "statuses": statuses,
+        "errors": errors,
+        "bytes": total_bytes,
+    }
+
+
+def _start_server(port: int, stub_base: str, data_dir: str, args) -> subprocess.Popen:
+    env = dict(
+        os.environ,
+        BILIURL_API_BASE=stub_base,
+        BILIURL_PASSPORT_BASE=stub_base,
+        BILIURL_DATA_DIR=data_dir,
+        # Let the bench evict freshly merged files so the cache cap actually bites
+        BILIURL_MERGE_CACHE_MIN_AGE="0",
+        BILIURL_MERGE_CACHE_MAX_BYTES=str(args.merge_cache_bytes),
+    )
+    cmd = [
+        sys.executable, "-m", "uvicorn", "server:app",
+        "--host", "127.0.0.1", "--port", str(port),
+        "--log-level", "warning", "--no-access-log",
+    ]
+    proc = subprocess.Popen(cmd, cwd=REPO_ROOT, env=env)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"server exited with {proc.returncode}")
+        try:
+            if httpx.get(f"http://127.0.0.1:{port}/stats", timeout=1.0).status_code == 200:
+                return proc
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    proc.terminate()
+    raise RuntimeError("server did not come up within 30s")
+
+
+def _compare(results: List[Dict], baseline_path: str) -> List[Dict]:
+    with open(baseline_path) as f:
+        baseline = {(r["scenario"], r["concurrency"]): r for r in json.load(f)["runs"]}
+    rows = []
+    for r in results:
+        old = baseline.get((r["scenario"], r["concurrency"]))
+        if not old:
+            continue
+        row = {"scenario": r["scenario"], "concurrency": r["concurrency"]}
+        for key in ("rps", "p50_ms", "p99_ms", "rss_mb_max", "fds_max"):
+            if old.get(key) and r.get(key) is not None:
+                row[key] = {"before": old[key], "after": r[key], "change": round(r[key] / old[key] - 1.0, 3)}
+        rows.append(row)
+    return rows
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Load test server.py against a local Bilibili stub")
+    parser.add_argument("--scenarios", default="stream-video,download-video,merge",
+                        help=f"comma separated, from: {','.join(SCENARIOS)}")
+    parser.add_argument("--concurrency", default="1,8,32", help="comma separated concurrency levels")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds per scenario/concurrency run")
+    parser.add_argument("--bvids", type=int, default=16, help="distinct bvids cycled through (cache hit ratio)")
+    parser.add_argument("--latency-ms", type=float, default=20.0, help="stub API latency")
+    parser.add_argument("--cdn-latency-ms", type=float, default=5.0, help="stub CDN first-byte latency")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of API calls failing with -412/-352")
+    parser.add_argument("--video-bytes", type=int, default=4 << 20)
+    parser.add_argument("--audio-bytes", type=int, default=512 << 10)
+    parser.add_argument("--merge-cache-bytes", type=int, default=256 << 20)
+    parser.add_argument("--out", help="write the JSON report here as well as stdout")
+    parser.add_argument("--compare", help="earlier --out report to diff against")
+    args = parser.parse_args()
+
+    scenarios = [s.strip() for s in args.scenarios.split(",") if s.strip()]
+    unknown = [s for s in scenarios if s not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(unknown)}")
+    levels = [int(c) for c in args.concurrency.split(",") if c.strip()]
+
+    config = stub.StubConfig(
+        latency_ms=args.latency_ms,
+        cdn_latency_ms=args.cdn_latency_ms,
+        error_rate=args.error_rate,
+        video_bytes=args.video_bytes,
+        audio_bytes=args.audio_bytes,
+    )
+    api = stub.StubServer(0, config).start()
+    port = _free_port()
+    runs = []
+    with tempfile.TemporaryDirectory(prefix="biliurl-bench-") as data_dir:
+        server = _start_server(port, api.base, data_dir, args)
+        try:
+            base = f"http://127.0.0.1:{port}"
+            for scenario in scenarios:
+                for level in levels:
+                    with _ProcSampler(server.pid) as sampler:
+                        result = asyncio.run(_drive(base, scenario, level, args.duration, args.bvids))
+                    result["rss_mb_max"] = round(sampler.rss_kb_max / 1024.0, 1)
+                    result["fds_max"] = sampler.fds_max
+                    runs.append(result)
+                    print(
+                        f"{scenario:>15} c={level:<4} {result['rps']:>8} req/s  "
+                        f"p50={result['p50_ms']}ms p99={result['p99_ms']}ms  "
+                        f"rss={result['rss_mb_max']}MB fds={result['fds_max']}",
+                        file=sys.stderr,
+                    )
+        finally:
+            server.terminate()
+            try:
+                server.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                server.kill()
+            api.shutdown()
+
+    report = {
+        "config": {k: v for k, v in vars(args).items() if k not in ("out", "compare")},
+        "stub_calls": dict(config.counters),
+        "runs": runs,
+    }
+    if args.compare:
+        report["compare"] = _compare(runs, args.compare)
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,243 @@
+"""Local stand-in for api.bilibili.com and the upos CDN, for load tests.
+
+Serves pagelist / nav / playurl (wbi and legacy) JSON, the passport QR login
+endpoints and synthetic m4s tracks with Range support. Latency and error injection are configurable:
+
+    python bench/stub.py --port 18080 --latency-ms 30 --error-rate 0.05
+
+Point server.py at it with BILIURL_API_BASE=http://127.0.0.1:18080.
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+import fmp4
+
+
+@dataclass
+class StubConfig:
+    latency_ms: float = 20.0
+    # Fraction of API calls answered with one of error_codes instead of data
+    error_rate: float = 0.0
+    error_codes: Tuple[int, ...] = (-412, -352)
+    # Per-page duration reported in pagelist, and pages per bvid
+    pages: int = 1
+    video_bytes: int = 4 << 20
+    audio_bytes: int = 512 << 10
+    # Extra first-byte delay for CDN responses
+    cdn_latency_ms: float = 5.0
+    # QR login: polls answered "not scanned" / "scanned" before the login succeeds
+    qr_scan_after: int = 2
+    qr_confirm_after: int = 4
+    counters: Dict[str, int] = field(default_factory=dict)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: "StubServer"
+
+    def log_message(self, *args) -> None:
+        pass
+
+    def _count(self, name: str) -> None:
+        with self.server.lock:
+            counters = self.server.config.counters
+            counters[name] = counters.get(name, 0) + 1
+
+    def _json(self, obj) -> None:
+        body = json.dumps(obj).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _qr(self, path: str, query: Dict[str, list]) -> None:
+        config = self.server.config
+        if path.endswith("/generate"):
+            key = f"qr{random.getrandbits(64):016x}"
+            with self.server.lock:
+                self.server.qr_polls[key] = 0
+            self._json({"code": 0, "data": {"qrcode_key": key, "url": f"{self.server.base}/qr/{key}"}})
+            return
+        key = (query.get("qrcode_key") or [""])[0]
+        with self.server.lock:
+            polls = self.server.qr_polls.get(key)
+            if polls is not None:
+                self.server.qr_polls[key] = polls + 1
+        if polls is None:
+            code = 86038
+        elif polls < config.qr_scan_after:
+            code = 86101
+        elif polls < config.qr_confirm_after:
+            code = 86090
+        else:
+            code = 0
+        body = json.dumps({"code": 0, "data": {"code": code, "refresh_token": "stub" if code == 0 else ""}})
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        if code == 0:
+            for cookie in (f"SESSDATA=stub{key}", "bili_jct=stub", "DedeUserID=1"):
+                self.send_header("Set-Cookie", f"{cookie}; Path=/")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body.encode("utf-8"))
+
+    def _api(self, path: str, query: Dict[str, list]) -> None:
+        config = self.server.config
+        time.sleep(config.latency_ms / 1000.0)
+        self._count(path)
+        if path.startswith("/x/passport-login/web/qrcode/"):
+            self._qr(path, query)
+            return
+        if path != "/x/web-interface/nav" and random.random() < config.error_rate:
+            code = random.choice(config.error_codes)
+            self._count(f"error{code}")
+            self._json({"code": code, "message": "stub error", "ttl": 1})
+            return
+        bvid = (query.get("bvid") or ["BV0"])[0]
+        if path == "/x/player/pagelist":
+            pages = [
+                {"cid": 10_000 + i, "page": i + 1, "part": f"P{i + 1}", "duration": 120}
+                for i in range(config.pages)
+            ]
+            self._json({"code": 0, "data": pages})
+        elif path == "/x/web-interface/nav":
+            self._json({
+                "code": -101,
+                "data": {
+                    "isLogin": False,
+                    "wbi_img": {
+                        "img_url": "https://i0.hdslb.com/bfs/wbi/7cd084941338484aae1ad9425b84077c.png",
+                        "sub_url": "https://i0.hdslb.com/bfs/wbi/4932caff0ff746eab6f01bf08b70ac45.png",
+                    },
+                },
+            })
+        elif path in ("/x/player/wbi/playurl", "/x/player/playurl"):
+            cid = (query.get("cid") or ["0"])[0]
+            self._json({"code": 0, "data": {"quality": 32, "dash": self.server.dash(bvid, cid)}})
+        else:
+            self._json({"code": -404, "message": "not found"})
+
+    def _cdn(self, path: str, head: bool) -> None:
+        config = self.server.config
+        time.sleep(config.cdn_latency_ms / 1000.0)
+        self._count("cdn_head" if head else "cdn_get")
+        data = self.server.video if path.endswith("video.m4s") else self.server.audio
+        start, end, status = 0, len(data) - 1, 200
+        rng = self.headers.get("Range")
+        if rng and rng.startswith("bytes="):
+            first, _, last = rng[len("bytes="):].partition("-")
+            start = int(first) if first else 0
+            end = min(int(last), len(data) - 1) if last else len(data) - 1
+            if start >= len(data):
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{len(data)}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            status = 206
+        self.send_response(status)
+        self.send_header("Content-Type", "video/mp4")
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("ETag", '"stub"')
+        if status == 206:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{len(data)}")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.end_headers()
+        if not head:
+            try:
+                self.wfile.write(memoryview(data)[start:end + 1])
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+
+    def do_GET(self) -> None:
+        parts = urlsplit(self.path)
+        if parts.path.startswith("/upos/"):
+            self._cdn(parts.path, head=False)
+        else:
+            self._api(parts.path, parse_qs(parts.query))
+
+    def do_HEAD(self) -> None:
+        self._cdn(urlsplit(self.path).path, head=True)
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, port: int, config: StubConfig) -> None:
+        super().__init__(("127.0.0.1", port), _Handler)
+        self.config = config
+        self.lock = threading.Lock()
+        # qrcode_key -> polls so far
+        self.qr_polls: Dict[str, int] = {}
+        self.video, self.audio = fmp4.make_pair(config.video_bytes, config.audio_bytes)
+
+    def handle_error(self, request, client_address) -> None:
+        # Race losers and cancelled transfers hang up mid-response; that is expected here
+        pass
+
+    @property
+    def base(self) -> str:
+        return f"http://127.0.0.1:{self.server_port}"
+
+    def dash(self, bvid: str, cid: str) -> Dict:
+        deadline = int(time.time()) + 7200
+
+        def url(host: str, name: str) -> str:
+            return f"http://{host}:{self.server_port}/upos/{bvid}/{cid}/{name}?deadline={deadline}"
+
+        def track(name: str, **info) -> Dict:
+            # "localhost" stands in for a second mirror so CDN racing is exercised
+            return dict(info, baseUrl=url("127.0.0.1", name), backupUrl=[url("localhost", name)])
+
+        return {
+            "duration": 120,
+            "video": [
+                track("video.m4s", id=32, codecid=7, codecs="avc1.64001F", bandwidth=500_000,
+                      width=852, height=480, frameRate="30"),
+            ],
+            "audio": [track("audio.m4s", id=30280, codecs="mp4a.40.2", bandwidth=192_000)],
+        }
+
+    def start(self) -> "StubServer":
+        threading.Thread(target=self.serve_forever, name="bili-stub", daemon=True).start()
+        return self
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Local Bilibili API + CDN stand-in")
+    parser.add_argument("--port", type=int, default=18080)
+    parser.add_argument("--latency-ms", type=float, default=20.0)
+    parser.add_argument("--cdn-latency-ms", type=float, default=5.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--pages", type=int, default=1)
+    parser.add_argument("--video-bytes", type=int, default=4 << 20)
+    parser.add_argument("--audio-bytes", type=int, default=512 << 10)
+    args = parser.parse_args()
+    config = StubConfig(
+        latency_ms=args.latency_ms,
+        cdn_latency_ms=args.cdn_latency_ms,
+        error_rate=args.error_rate,
+        pages=args.pages,
+        video_bytes=args.video_bytes,
+        audio_bytes=args.audio_bytes,
+    )
+    server = StubServer(args.port, config)
+    print(f"stub listening on {server.base}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
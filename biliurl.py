@@ -2,6 +2,8 @@ import requests
 import json
 import time
 import os
+import hashlib
+from urllib.parse import urlencode
 
 headers = {
     'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3',
@@ -15,69 +17,239 @@ headers = {
     'Referer': 'https://www.bilibili.com'
 }
 
+# overridable so a local stand-in can be used (see bench/)
+API_BASE = os.environ.get('BILIURL_API_BASE', 'https://api.bilibili.com').rstrip('/')
+
 tempVideoFile = 'temp\\video.m4s'
 
 tempAudioFile = 'temp\\audio.m4s'
 
 
-# get the cid of video by bvid
-def getCid(bvid, session=None, cookies=None):
+# optional pagelist cache shared with callers (e.g. server.py); any object with
+# get(bvid) -> list | None and put(bvid, pages)
+pagelist_cache = None
+
+
+# get the page list (every 分P with its cid) of video by bvid
+def getPagelist(bvid, session=None, cookies=None, use_cache=True):
+    cache = pagelist_cache if use_cache else None
+    if cache is not None:
+        pages = cache.get(bvid)
+        if pages:
+            return pages
+
     sess = session or requests
     respCid = sess.get(
-        'https://api.bilibili.com/x/player/pagelist?bvid=' + bvid,
+        API_BASE + '/x/player/pagelist?bvid=' + bvid,
         headers=headers,
         cookies=cookies,
         timeout=15,
     )
     plist = respCid.json()
-    cid = str(plist['data'][0]['cid'])
-    return cid
+    pages = plist.get('data') if plist.get('code') == 0 else None
+    if not pages:
+        raise RuntimeError(f'Failed to get pagelist: {plist}')
+
+    if cache is not None:
+        cache.put(bvid, pages)
+    return pages
+
+
+# get the cid of page p (1-based 分P number) of video by bvid
+def getCid(bvid, session=None, cookies=None, p=1):
+    pages = getPagelist(bvid, session=session, cookies=cookies)
+    for page in pages:
+        if page.get('page') == p:
+            return str(page['cid'])
+    if not 1 <= p <= len(pages):
+        raise ValueError(f'{bvid} has {len(pages)} pages, no p={p}')
+    return str(pages[p - 1]['cid'])
 
 
 # get video&audio stream by cid
-def _select_best_stream(dash_list, prefer_id=None, max_id=None):
-    if not dash_list:
-        return None
+VIDEO_CODECS = {7: 'avc', 12: 'hevc', 13: 'av1'}
+AUDIO_CODECS = ('aac', 'dolby', 'flac')
+DEFAULT_CODECS = ['avc', 'hevc', 'av1']
+
+
+def _get_id(item):
+    try:
+        return int(item.get('id') or 0)
+    except Exception:
+        return 0
+
+
+def _get_bandwidth(item):
+    try:
+        return int(item.get('bandwidth') or 0)
+    except Exception:
+        return 0
+
+
+def streamCodec(item):
+    """Codec family of a dash track: avc/hevc/av1 for video, aac/dolby/flac for audio."""
+    codecid = item.get('codecid')
+    if codecid in VIDEO_CODECS:
+        return VIDEO_CODECS[codecid]
+    codecs = str(item.get('codecs') or '').lower()
+    if codecs.startswith('avc'):
+        return 'avc'
+    if codecs.startswith(('hev', 'hvc')):
+        return 'hevc'
+    if codecs.startswith('av01'):
+        return 'av1'
+    if codecs.startswith('flac') or _get_id(item) == 30251:
+        return 'flac'
+    if codecs.startswith('ec-3') or _get_id(item) == 30250:
+        return 'dolby'
+    return 'aac'
+
+
+def audioTracks(dash, codecs=AUDIO_CODECS):
+    """All audio tracks of a dash object; dolby/flac included only if listed in codecs."""
+    tracks = list(dash.get('audio') or [])
+    # dolby/flac are separate sections of the dash object; only offered when asked for
+    if 'dolby' in codecs:
+        tracks += list((dash.get('dolby') or {}).get('audio') or [])
+    if 'flac' in codecs:
+        flac = (dash.get('flac') or {}).get('audio')
+        if flac:
+            tracks.append(flac)
+    return tracks
+
+
+def _rank_by_codec(tracks, codecs):
+    allowed = [t for t in tracks if streamCodec(t) in codecs]
+    # Nothing in an acceptable codec: anything beats no stream
+    return allowed or list(tracks)
+
 
-    def _get_id(item):
-        try:
-            return int(item.get('id') or 0)
-        except Exception:
-            return 0
+def _codec_order(track, codecs):
+    codec = streamCodec(track)
+    if codec in codecs:
+        return codecs.index(codec)
+    # aac is implied as the last audio choice when not listed
+    return len(codecs)
+
+
+def selectStreams(dash, codecs=None, max_bandwidth=None, prefer_id=None, max_id=None):
+    """Pick (video, audio, selection) from a playurl dash object.
+
+    Video is ranked by quality id (prefer_id first, nothing above max_id), then by the
+    position of its codec in `codecs`, then by lower bandwidth. Audio is ranked by codec
+    preference, then higher bandwidth. With max_bandwidth (bits/s) the best video that
+    fits together with some audio track wins; if nothing fits the smallest pair is used.
+    """
+    codecs = list(codecs or DEFAULT_CODECS)
+    videos = list(dash.get('video') or [])
+    audios = audioTracks(dash, codecs)
+    if not videos or not audios:
+        return None, None, None
 
-    candidates = list(dash_list)
     if max_id is not None:
-        candidates = [x for x in candidates if _get_id(x) <= max_id]
-        if not candidates:
-            candidates = list(dash_list)
+        capped = [v for v in videos if _get_id(v) <= max_id]
+        # Only higher qualities returned: fall back to the lowest one rather than exceed the cap
+        videos = capped or [v for v in videos if _get_id(v) == min(_get_id(x) for x in videos)]
+
+    videos = sorted(
+        _rank_by_codec(videos, codecs),
+        key=lambda v: (_get_id(v) != prefer_id, -_get_id(v), _codec_order(v, codecs), _get_bandwidth(v)),
+    )
+    audio_codecs = [c for c in codecs if c in AUDIO_CODECS]
+    audios = sorted(audios, key=lambda a: (_codec_order(a, audio_codecs), -_get_bandwidth(a)))
+
+    best_video, best_audio, over_budget = videos[0], audios[0], False
+    if max_bandwidth:
+        pair = next(
+            ((v, a) for v in videos for a in audios if _get_bandwidth(v) + _get_bandwidth(a) <= max_bandwidth),
+            None,
+        )
+        if pair is None:
+            pair = (min(videos, key=_get_bandwidth), min(audios, key=_get_bandwidth))
+            over_budget = True
+        best_video, best_audio = pair
+
+    selection = {
+        'codecs': codecs,
+        'max_bandwidth': max_bandwidth,
+        'video': {'id': _get_id(best_video), 'codec': streamCodec(best_video), 'bandwidth': _get_bandwidth(best_video)},
+        'audio': {'id': _get_id(best_audio), 'codec': streamCodec(best_audio), 'bandwidth': _get_bandwidth(best_audio)},
+        'bandwidth': _get_bandwidth(best_video) + _get_bandwidth(best_audio),
+        'over_budget': over_budget,
+        'candidates': {'video': len(videos), 'audio': len(audios)},
+    }
+    return best_video, best_audio, selection
+
+
+# WBI request signing (x/player/wbi/* and friends)
+MIXIN_KEY_ENC_TAB = [
+    46, 47, 18, 2, 53, 8, 23, 32, 15, 50, 10, 31, 58, 3, 45, 35, 27, 43, 5, 49,
+    33, 9, 42, 19, 29, 28, 14, 39, 12, 38, 41, 13, 37, 48, 7, 16, 24, 55, 40, 61,
+    26, 17, 0, 1, 60, 51, 30, 4, 22, 25, 54, 21, 56, 59, 6, 63, 57, 62, 11, 36,
+    20, 34, 44, 52,
+]
+
+# mixin key cached for getStream; server.py keeps and refreshes its own copy
+_wbi_key_cache = {'key': None, 'fetched_at': 0.0}
+
+
+def getWbiKeys(session=None, cookies=None):
+    """(img_key, sub_key) from the nav endpoint; nav answers guests too (code -101)."""
+    sess = session or requests
+    resp = sess.get(API_BASE + '/x/web-interface/nav', headers=headers, cookies=cookies, timeout=15)
+    j = resp.json()
+    wbi = (j.get('data') or {}).get('wbi_img') or {}
+    img_url, sub_url = wbi.get('img_url'), wbi.get('sub_url')
+    if not img_url or not sub_url:
+        raise RuntimeError(f'Failed to get wbi keys: {j}')
+    return img_url.rsplit('/', 1)[-1].split('.')[0], sub_url.rsplit('/', 1)[-1].split('.')[0]
+
+
+def getMixinKey(img_key, sub_key):
+    orig = img_key + sub_key
+    return ''.join(orig[i] for i in MIXIN_KEY_ENC_TAB if i < len(orig))[:32]
+
+
+def getWbiMixinKey(session=None, cookies=None, max_age=3600):
+    cached = _wbi_key_cache['key']
+    if cached and time.time() - _wbi_key_cache['fetched_at'] < max_age:
+        return cached
+    key = getMixinKey(*getWbiKeys(session=session, cookies=cookies))
+    _wbi_key_cache.update(key=key, fetched_at=time.time())
+    return key
 
-    if prefer_id is not None:
-        for x in candidates:
-            if _get_id(x) == prefer_id:
-                return x
 
-    return max(candidates, key=_get_id)
+def signWbiParams(params, mixin_key, wts=None):
+    """Return a copy of params with wts and w_rid added."""
+    signed = dict(params)
+    signed['wts'] = int(wts if wts is not None else time.time())
+    signed = {
+        k: ''.join(c for c in str(v) if c not in "!'()*")
+        for k, v in sorted(signed.items())
+    }
+    signed['w_rid'] = hashlib.md5((urlencode(signed) + mixin_key).encode('utf-8')).hexdigest()
+    return signed
 
 
 def getStream(bvid, cid, qn=125, session=None, cookies=None):
     sess = session or requests
-    base_params = f'from_client=BROWSER&cid={cid}&qn={qn}&fourk=1&fnver=0&fnval=4048&bvid={bvid}'
-    urls = [
-        'https://api.bilibili.com/x/player/wbi/playurl?' + base_params,
-        'https://api.bilibili.com/x/player/playurl?' + base_params,
-    ]
+    base_params = {'from_client': 'BROWSER', 'cid': cid, 'qn': qn, 'fourk': 1, 'fnver': 0, 'fnval': 4048, 'bvid': bvid}
+    attempts = []
+    try:
+        mixin_key = getWbiMixinKey(session=sess, cookies=cookies)
+        attempts.append((API_BASE + '/x/player/wbi/playurl', signWbiParams(base_params, mixin_key)))
+    except (RuntimeError, ValueError, requests.RequestException):
+        # no keys: the legacy endpoint still works unsigned
+        pass
+    attempts.append((API_BASE + '/x/player/playurl', base_params))
 
     last_plist = None
-    for url in urls:
-        respUrl = sess.get(url, headers=headers, cookies=cookies, timeout=15)
+    for url, params in attempts:
+        respUrl = sess.get(url, params=params, headers=headers, cookies=cookies, timeout=15)
         plist = respUrl.json()
         last_plist = plist
         if plist.get('code') == 0 and plist.get('data') and plist['data'].get('dash'):
-            dash = plist['data']['dash']
-            video = dash.get('video') or []
-            audio = dash.get('audio') or []
-            best_video = _select_best_stream(video)
-            best_audio = _select_best_stream(audio)
+            best_video, best_audio, _selection = selectStreams(plist['data']['dash'])
             if best_video and best_audio:
                 return [str(best_video.get('baseUrl')), str(best_audio.get('baseUrl'))]
 
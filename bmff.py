@@ -0,0 +1,521 @@
+"""Pure-Python ISO-BMFF remuxer for Bilibili DASH tracks.
+
+Bilibili serves video and audio as two single-track fragmented MP4 files
+(ftyp, moov, sidx, then moof/mdat pairs). Muxing them into one MP4 does not
+need a decoder: the two moov boxes are merged into one two-track moov and the
+fragments of both inputs are interleaved by decode time. Every moof is copied
+as-is except for its sequence number, track_ID and, when present, absolute
+base_data_offset; mdat payloads are never parsed, only copied (zero-copy with
+copy_file_range/sendfile when both ends are files).
+
+    remux(video_file, audio_file)           -> iterator of output chunks
+    remux_files(video_path, audio_path, out) -> write a file
+
+Inputs only need read(n): local files, pipes and HTTP response bodies all work.
+Anything this module does not understand raises BmffError so callers can fall
+back to ffmpeg.
+"""
+import os
+import struct
+from dataclasses import dataclass
+from typing import BinaryIO, Iterator, List, Optional, Tuple, Union
+
+CHUNK_SIZE = 256 * 1024
+
+# tfhd flags
+_TFHD_BASE_DATA_OFFSET = 0x000001
+_TFHD_SAMPLE_DESCRIPTION_INDEX = 0x000002
+_TFHD_DEFAULT_SAMPLE_DURATION = 0x000008
+
+# trun flags
+_TRUN_DATA_OFFSET = 0x000001
+_TRUN_FIRST_SAMPLE_FLAGS = 0x000004
+_TRUN_SAMPLE_DURATION = 0x000100
+_TRUN_SAMPLE_SIZE = 0x000200
+_TRUN_SAMPLE_FLAGS = 0x000400
+_TRUN_SAMPLE_CTO = 0x000800
+
+
+class BmffError(ValueError):
+    """Input is not a single-track fragmented MP4 this remuxer can handle."""
+
+
+def _box(box_type: bytes, payload: bytes) -> bytes:
+    size = 8 + len(payload)
+    if size > 0xFFFFFFFF:
+        return struct.pack(">I4sQ", 1, box_type, size + 8) + payload
+    return struct.pack(">I4s", size, box_type) + payload
+
+
+def _children(buf: bytes, start: int, end: int) -> Iterator[Tuple[bytes, int, int, int]]:
+    """Yield (type, box_start, payload_start, box_end) for the boxes in buf[start:end]."""
+    pos = start
+    while pos + 8 <= end:
+        size, box_type = struct.unpack_from(">I4s", buf, pos)
+        header = 8
+        if size == 1:
+            size = struct.unpack_from(">Q", buf, pos + 8)[0]
+            header = 16
+        elif size == 0:
+            size = end - pos
+        if size < header or pos + size > end:
+            raise BmffError(f"truncated {box_type!r} box at {pos}")
+        yield box_type, pos, pos + header, pos + size
+        pos += size
+
+
+def _header_len(buf: bytes, pos: int = 0) -> int:
+    return 16 if struct.unpack_from(">I", buf, pos)[0] == 1 else 8
+
+
+def _find(buf: bytes, start: int, end: int, box_type: bytes) -> Optional[Tuple[int, int, int]]:
+    for t, box_start, payload_start, box_end in _children(buf, start, end):
+        if t == box_type:
+            return box_start, payload_start, box_end
+    return None
+
+
+class _Source:
+    """Sequential reader that tracks its absolute position."""
+
+    def __init__(self, f: BinaryIO) -> None:
+        self.f = f
+        self.pos = 0
+        try:
+            self.fd: Optional[int] = f.fileno() if f.seekable() else None
+        except (AttributeError, OSError, ValueError):
+            self.fd = None
+
+    def read_exact(self, n: int) -> bytes:
+        parts = []
+        remaining = n
+        while remaining > 0:
+            chunk = self.f.read(remaining)
+            if not chunk:
+                raise BmffError(f"unexpected end of input at {self.pos + n - remaining}")
+            parts.append(chunk)
+            remaining -= len(chunk)
+        data = b"".join(parts)
+        self.pos += n
+        return data
+
+    def try_read(self, n: int) -> bytes:
+        # Like read_exact, but a clean EOF before the first byte returns b""
+        first = self.f.read(n)
+        if not first:
+            return b""
+        self.pos += len(first)
+        if len(first) < n:
+            first += self.read_exact(n - len(first))
+        return first
+
+    def skip(self, n: int) -> None:
+        if self.fd is not None:
+            self.f.seek(self.pos + n)
+            self.pos += n
+            return
+        while n > 0:
+            n -= len(self.read_exact(min(n, CHUNK_SIZE)))
+
+    def remaining_size(self) -> Optional[int]:
+        if self.fd is None:
+            return None
+        return os.fstat(self.fd).st_size - self.pos
+
+    def read_header(self) -> Optional[Tuple[bytes, bytes, int]]:
+        """Return (type, raw_header, payload_size) of the next top-level box, or None at EOF."""
+        head = self.try_read(8)
+        if not head:
+            return None
+        size, box_type = struct.unpack(">I4s", head)
+        if size == 1:
+            ext = self.read_exact(8)
+            head += ext
+            size = struct.unpack(">Q", ext)[0]
+        elif size == 0:
+            remaining = self.remaining_size()
+            if remaining is None:
+                raise BmffError(f"{box_type!r} box extends to end of a non-seekable input")
+            size = len(head) + remaining
+        if size < len(head):
+            raise BmffError(f"invalid size for {box_type!r} box")
+        return box_type, head, size - len(head)
+
+
+@dataclass
+class _Fragment:
+    moof: bytearray
+    moof_offset: int
+    mdat_header: bytes
+    payload_size: int
+    decode_time: float
+    duration: int
+    # Bytes of boxes between the moof and its mdat in the input, dropped on output
+    gap: int = 0
+
+
+@dataclass
+class _Track:
+    src: _Source
+    track_id: int
+    timescale: int = 0
+    default_sample_duration: int = 0
+    next_decode_time: int = 0
+    pending: Optional[_Fragment] = None
+    done: bool = False
+    moov: bytes = b""
+    ftyp: bytes = b""
+
+
+def _read_init(track: _Track) -> None:
+    while True:
+        hdr = track.src.read_header()
+        if hdr is None:
+            raise BmffError("no moov box found")
+        box_type, head, payload_size = hdr
+        if box_type == b"ftyp":
+            track.ftyp = head + track.src.read_exact(payload_size)
+        elif box_type == b"moov":
+            track.moov = head + track.src.read_exact(payload_size)
+            return
+        elif box_type in (b"moof", b"mdat"):
+            raise BmffError(f"{box_type!r} before moov")
+        else:
+            track.src.skip(payload_size)
+
+
+def _parse_track_header(track: _Track) -> None:
+    moov = track.moov
+    moov_payload, moov_end = _header_len(moov), len(moov)
+    traks = [c for c in _children(moov, moov_payload, moov_end) if c[0] == b"trak"]
+    if len(traks) != 1:
+        raise BmffError(f"expected exactly one trak, found {len(traks)}")
+    _t, _s, trak_payload, trak_end = traks[0]
+    mdia = _find(moov, trak_payload, trak_end, b"mdia")
+    if mdia is None:
+        raise BmffError("trak without mdia")
+    mdhd = _find(moov, mdia[1], mdia[2], b"mdhd")
+    if mdhd is None:
+        raise BmffError("mdia without mdhd")
+    version = moov[mdhd[1]]
+    offset = mdhd[1] + (20 if version == 1 else 12)
+    track.timescale = struct.unpack_from(">I", moov, offset)[0]
+    if not track.timescale:
+        raise BmffError("zero media timescale")
+
+    mvex = _find(moov, moov_payload, moov_end, b"mvex")
+    if mvex is None:
+        raise BmffError("moov without mvex: input is not fragmented")
+    trex = _find(moov, mvex[1], mvex[2], b"trex")
+    if trex is not None:
+        track.default_sample_duration = struct.unpack_from(">I", moov, trex[1] + 12)[0]
+
+
+def _mvhd(moov: bytes) -> Tuple[int, int, int, int, int]:
+    """Return (box_start, payload_start, box_end, timescale, duration) of a moov's mvhd."""
+    mvhd = _find(moov, _header_len(moov), len(moov), b"mvhd")
+    if mvhd is None:
+        raise BmffError("moov without mvhd")
+    if moov[mvhd[1]] == 1:
+        timescale, duration = struct.unpack_from(">IQ", moov, mvhd[1] + 20)
+    else:
+        timescale, duration = struct.unpack_from(">II", moov, mvhd[1] + 12)
+    return mvhd[0], mvhd[1], mvhd[2], timescale, duration
+
+
+def _rescale(value: int, src: int, dst: int) -> int:
+    return value if src == dst or not src else value * dst // src
+
+
+def _patch_trak(moov: bytes, trak: Tuple[int, int, int], track_id: int, src_scale: int, dst_scale: int) -> Tuple[bytes, int]:
+    """Copy a trak with a new track_ID, rescaling movie-timescale durations. Returns (trak, duration)."""
+    buf = bytearray(moov[trak[0]:trak[2]])
+    base = trak[0]
+    duration = 0
+    for box_type, _s, payload, end in _children(moov, trak[1], trak[2]):
+        p = payload - base
+        if box_type == b"tkhd":
+            if buf[p] == 1:
+                struct.pack_into(">I", buf, p + 20, track_id)
+                duration = _rescale(struct.unpack_from(">Q", buf, p + 28)[0], src_scale, dst_scale)
+                struct.pack_into(">Q", buf, p + 28, duration)
+            else:
+                struct.pack_into(">I", buf, p + 12, track_id)
+                duration = _rescale(struct.unpack_from(">I", buf, p + 20)[0], src_scale, dst_scale)
+                struct.pack_into(">I", buf, p + 20, min(duration, 0xFFFFFFFF))
+        elif box_type == b"edts" and src_scale != dst_scale:
+            elst = _find(moov, payload, end, b"elst")
+            if elst is None:
+                continue
+            q = elst[1] - base
+            version = buf[q]
+            count = struct.unpack_from(">I", buf, q + 4)[0]
+            entry = q + 8
+            for _ in range(count):
+                if version == 1:
+                    seg = struct.unpack_from(">Q", buf, entry)[0]
+                    struct.pack_into(">Q", buf, entry, _rescale(seg, src_scale, dst_scale))
+                    entry += 20
+                else:
+                    seg = struct.unpack_from(">I", buf, entry)[0]
+                    struct.pack_into(">I", buf, entry, min(_rescale(seg, src_scale, dst_scale), 0xFFFFFFFF))
+                    entry += 12
+    return bytes(buf), duration
+
+
+def _merge_moov(video: _Track, audio: _Track) -> bytes:
+    mvhd_start, mvhd_payload, mvhd_end, v_scale, v_duration = _mvhd(video.moov)
+    a_scale = _mvhd(audio.moov)[3]
+
+    traks: List[bytes] = []
+    durations = [v_duration]
+    trex_boxes: List[bytes] = []
+    extra: List[bytes] = []
+    for track, scale in ((video, v_scale), (audio, a_scale)):
+        moov = track.moov
+        for box_type, box_start, box_payload, box_end in _children(moov, _header_len(moov), len(moov)):
+            if box_type == b"trak":
+                trak, duration = _patch_trak(moov, (box_start, box_payload, box_end), track.track_id, scale, v_scale)
+                traks.append(trak)
+                durations.append(duration)
+            elif box_type == b"mvex":
+                trex = _find(moov, box_payload, box_end, b"trex")
+                trex_payload = bytearray(24)
+                if trex is not None:
+                    trex_payload = bytearray(moov[trex[1]:trex[2]])
+                else:
+                    struct.pack_into(">I", trex_payload, 8, 1)
+                struct.pack_into(">I", trex_payload, 4, track.track_id)
+                trex_boxes.append(_box(b"trex", bytes(trex_payload)))
+            elif track is video and box_type not in (b"mvhd", b"iods"):
+                # udta/meta/pssh of the video input are kept; the audio input's are dropped
+                extra.append(moov[box_start:box_end])
+
+    mvhd = bytearray(video.moov[mvhd_start:mvhd_end])
+    p = mvhd_payload - mvhd_start
+    if mvhd[p] == 1:
+        struct.pack_into(">Q", mvhd, p + 24, max(durations))
+    else:
+        struct.pack_into(">I", mvhd, p + 16, min(max(durations), 0xFFFFFFFF))
+    # next_track_ID is the last field of mvhd
+    struct.pack_into(">I", mvhd, len(mvhd) - 4, max(video.track_id, audio.track_id) + 1)
+
+    # mehd (fragment duration) is dropped on purpose: it is optional and would be stale
+    return _box(b"moov", bytes(mvhd) + b"".join(traks) + _box(b"mvex", b"".join(trex_boxes)) + b"".join(extra))
+
+
+def _fragment_duration(moof: bytearray, traf: Tuple[int, int, int], default_duration: int) -> int:
+    tfhd = _find(moof, traf[1], traf[2], b"tfhd")
+    if tfhd is not None:
+        flags = struct.unpack_from(">I", moof, tfhd[1])[0] & 0xFFFFFF
+        offset = tfhd[1] + 8
+        if flags & _TFHD_BASE_DATA_OFFSET:
+            offset += 8
+        if flags & _TFHD_SAMPLE_DESCRIPTION_INDEX:
+            offset += 4
+        if flags & _TFHD_DEFAULT_SAMPLE_DURATION:
+            default_duration = struct.unpack_from(">I", moof, offset)[0]
+
+    total = 0
+    for box_type, _s, payload, _e in _children(moof, traf[1], traf[2]):
+        if box_type != b"trun":
+            continue
+        flags = struct.unpack_from(">I", moof, payload)[0] & 0xFFFFFF
+        count = struct.unpack_from(">I", moof, payload + 4)[0]
+        if not flags & _TRUN_SAMPLE_DURATION:
+            total += count * default_duration
+            continue
+        entry = payload + 8
+        if flags & _TRUN_DATA_OFFSET:
+            entry += 4
+        if flags & _TRUN_FIRST_SAMPLE_FLAGS:
+            entry += 4
+        stride = 4 * sum(1 for f in (_TRUN_SAMPLE_DURATION, _TRUN_SAMPLE_SIZE, _TRUN_SAMPLE_FLAGS, _TRUN_SAMPLE_CTO) if flags & f)
+        for i in range(count):
+            total += struct.unpack_from(">I", moof, entry + i * stride)[0]
+    return total
+
+
+def _next_fragment(track: _Track) -> Optional[_Fragment]:
+    src = track.src
+    while True:
+        hdr = src.read_header()
+        if hdr is None:
+            return None
+        box_type, head, payload_size = hdr
+        if box_type == b"moof":
+            moof_offset = src.pos - len(head)
+            moof = bytearray(head + src.read_exact(payload_size))
+            break
+        if box_type == b"mfra":
+            return None
+        if box_type == b"mdat":
+            raise BmffError("mdat without a preceding moof")
+        # sidx/styp/free/emsg and unknown top-level boxes are not carried over
+        src.skip(payload_size)
+
+    # Find the mdat that carries this moof's samples
+    gap = 0
+    while True:
+        hdr = src.read_header()
+        if hdr is None:
+            raise BmffError("moof without mdat")
+        box_type, head, payload_size = hdr
+        if box_type == b"mdat":
+            mdat_header = head
+            break
+        gap += len(head) + payload_size
+        src.skip(payload_size)
+
+    trafs = [c for c in _children(moof, _header_len(moof), len(moof)) if c[0] == b"traf"]
+    if len(trafs) != 1:
+        raise BmffError(f"expected one traf per moof, found {len(trafs)}")
+    traf = trafs[0][1:]
+
+    decode = None
+    tfdt = _find(moof, traf[1], traf[2], b"tfdt")
+    if tfdt is not None:
+        if moof[tfdt[1]] == 1:
+            decode = struct.unpack_from(">Q", moof, tfdt[1] + 4)[0]
+        else:
+            decode = struct.unpack_from(">I", moof, tfdt[1] + 4)[0]
+    duration = _fragment_duration(moof, traf, track.default_sample_duration)
+    if decode is None:
+        decode = track.next_decode_time
+    track.next_decode_time = decode + duration
+
+    if gap:
+        _shift_data_offsets(moof, traf, -gap)
+
+    return _Fragment(
+        moof=moof,
+        moof_offset=moof_offset,
+        mdat_header=mdat_header,
+        payload_size=payload_size,
+        decode_time=decode / track.timescale,
+        duration=duration,
+        gap=gap,
+    )
+
+
+def _shift_data_offsets(moof: bytearray, traf: Tuple[int, int, int], delta: int) -> None:
+    tfhd = _find(moof, traf[1], traf[2], b"tfhd")
+    if tfhd is not None and struct.unpack_from(">I", moof, tfhd[1])[0] & _TFHD_BASE_DATA_OFFSET:
+        # Absolute offsets are rewritten (gap included) in _patch_fragment
+        return
+    for box_type, _s, payload, _e in _children(moof, traf[1], traf[2]):
+        if box_type == b"trun" and struct.unpack_from(">I", moof, payload)[0] & _TRUN_DATA_OFFSET:
+            value = struct.unpack_from(">i", moof, payload + 8)[0]
+            struct.pack_into(">i", moof, payload + 8, value + delta)
+
+
+def _patch_fragment(frag: _Fragment, track_id: int, sequence: int, out_offset: int) -> bytes:
+    moof = frag.moof
+    for box_type, _s, payload, end in _children(moof, _header_len(moof), len(moof)):
+        if box_type == b"mfhd":
+            struct.pack_into(">I", moof, payload + 4, sequence)
+        elif box_type == b"traf":
+            tfhd = _find(moof, payload, end, b"tfhd")
+            if tfhd is None:
+                raise BmffError("traf without tfhd")
+            struct.pack_into(">I", moof, tfhd[1] + 4, track_id)
+            if struct.unpack_from(">I", moof, tfhd[1])[0] & _TFHD_BASE_DATA_OFFSET:
+                old = struct.unpack_from(">Q", moof, tfhd[1] + 8)[0]
+                # Samples live in the mdat, which moves up by the dropped gap
+                struct.pack_into(">Q", moof, tfhd[1] + 8, out_offset + (old - frag.moof_offset) - frag.gap)
+    return bytes(moof)
+
+
+# A plan step is either literal output bytes or "copy the next N bytes of this source"
+_Piece = Union[bytes, Tuple[_Source, int]]
+
+
+def _plan(video_f: BinaryIO, audio_f: BinaryIO) -> Iterator[_Piece]:
+    video = _Track(src=_Source(video_f), track_id=1)
+    audio = _Track(src=_Source(audio_f), track_id=2)
+    for track in (video, audio):
+        _read_init(track)
+        _parse_track_header(track)
+
+    head = (video.ftyp or _box(b"ftyp", b"iso5\x00\x00\x02\x00iso5iso6mp41")) + _merge_moov(video, audio)
+    out_pos = len(head)
+    yield head
+
+    for track in (video, audio):
+        track.pending = _next_fragment(track)
+        track.done = track.pending is None
+
+    sequence = 0
+    while not (video.done and audio.done):
+        candidates = [t for t in (video, audio) if not t.done]
+        # Earliest decode time first; video wins ties so each keyframe leads its audio
+        track = min(candidates, key=lambda t: (t.pending.decode_time, t.track_id))
+        frag = track.pending
+        sequence += 1
+        moof = _patch_fragment(frag, track.track_id, sequence, out_pos)
+        yield moof + frag.mdat_header
+        out_pos += len(moof) + len(frag.mdat_header)
+        if frag.payload_size:
+            yield (track.src, frag.payload_size)
+            out_pos += frag.payload_size
+        track.pending = _next_fragment(track)
+        track.done = track.pending is None
+
+
+def remux(video_f: BinaryIO, audio_f: BinaryIO, chunk_size: int = CHUNK_SIZE) -> Iterator[bytes]:
+    """Interleave two single-track fragmented MP4 streams into one, yielding output chunks."""
+    for piece in _plan(video_f, audio_f):
+        if isinstance(piece, bytes):
+            yield piece
+            continue
+        src, remaining = piece
+        while remaining > 0:
+            chunk = src.read_exact(min(remaining, chunk_size))
+            remaining -= len(chunk)
+            yield chunk
+
+
+def _copy_range(src: _Source, out_fd: int, count: int) -> None:
+    if src.fd is not None:
+        offset = src.pos
+        done = 0
+        try:
+            while done < count:
+                if hasattr(os, "copy_file_range"):
+                    n = os.copy_file_range(src.fd, out_fd, count - done, offset + done)
+                else:
+                    n = os.sendfile(out_fd, src.fd, offset + done, count - done)
+                if n <= 0:
+                    raise BmffError("unexpected end of input while copying mdat")
+                done += n
+        except OSError:
+            # Cross-filesystem or unsupported: fall through to buffered copy of the rest
+            src.f.seek(offset + done)
+            src.pos = offset + done
+            count -= done
+        else:
+            src.f.seek(offset + count)
+            src.pos = offset + count
+            return
+    while count > 0:
+        chunk = src.read_exact(min(count, CHUNK_SIZE))
+        view = memoryview(chunk)
+        while view:
+            view = view[os.write(out_fd, view):]
+        count -= len(chunk)
+
+
+def remux_files(video_path: str, audio_path: str, output_path: str) -> None:
+    """File-to-file remux; mdat payloads are copied in-kernel where the platform allows."""
+    with open(video_path, "rb") as video_f, open(audio_path, "rb") as audio_f:
+        out_fd = os.open(output_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0), 0o644)
+        try:
+            for piece in _plan(video_f, audio_f):
+                if isinstance(piece, bytes):
+                    view = memoryview(piece)
+                    while view:
+                        view = view[os.write(out_fd, view):]
+                else:
+                    _copy_range(piece[0], out_fd, piece[1])
+        finally:
+            os.close(out_fd)
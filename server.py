@@ -1,7 +1,12 @@
+import asyncio
+import http.cookiejar
 import json
+import logging
 import sqlite3
 import os
 import secrets
+import shutil
+import socket
 import subprocess
 import tempfile
 import threading
@@ -9,26 +14,81 @@ import time
 import uuid
 import hmac
 import hashlib
-from dataclasses import dataclass
-from typing import Any, Dict, Optional, Tuple
-
+import re
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
+from dataclasses import dataclass, field
+from typing import Annotated, Any, AsyncIterator, Callable, Deque, Dict, Iterator, List, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+import httpx
 import qrcode
 import requests
+import urllib3
 from cryptography.fernet import Fernet, InvalidToken
-from fastapi import FastAPI, File, Header, HTTPException, Query, Response, UploadFile
-from fastapi.responses import HTMLResponse, StreamingResponse
-
-from biliurl import getCid
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import padding
+from requests.adapters import HTTPAdapter
+from fastapi import FastAPI, File, Header, HTTPException, Query, Request, Response, UploadFile
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse, HTMLResponse, JSONResponse, StreamingResponse
+from pydantic import BaseModel, Field, field_validator
+from starlette.background import BackgroundTask
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+import biliurl
+import bmff
+from biliurl import getPagelist
 
 app = FastAPI(title="biliurl http server", version="0.2.0")
+LOG = logging.getLogger("biliurl")
 
 
 @app.on_event("startup")
 def _startup_init() -> None:
     # Ensure directories, encryption key, and SQLite schema exist on fresh deploy
     _ensure_dirs()
-    _ = _load_or_create_key()
+    _ = _key_material()
     _db_init()
+    _probe_ffmpeg()
+    MERGE_CACHE.reconcile()
+    _migrate_sessions()
+    SHARED.start()
+    _start_periodic("invalidations", INVALIDATION_POLL_INTERVAL, _apply_invalidations)
+    _start_periodic("shared_cache_purge", SHARED_CACHE_PURGE_INTERVAL, SHARED.purge)
+    _start_periodic("session_reaper", SESSION_REAP_INTERVAL, _reap_sessions)
+    _start_periodic("session_health", SESSION_HEALTH_TICK, _check_session_health)
+    _start_periodic("login_flow_reaper", LOGIN_FLOW_REAP_INTERVAL, _cleanup_login_flows)
+    _start_periodic("wbi_keys", WBI_KEY_REFRESH_INTERVAL, WBI_KEYS.refresh)
+
+
+@app.on_event("shutdown")
+def _shutdown() -> None:
+    _BACKGROUND_STOP.set()
+
+
+@app.on_event("shutdown")
+async def _shutdown_async_http() -> None:
+    global _ASYNC_HTTP
+    if _ASYNC_HTTP is not None:
+        await _ASYNC_HTTP.aclose()
+        _ASYNC_HTTP = None
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.environ.get(name, default))
+    except ValueError:
+        return default
+
 
 BILI_HEADERS = {
     "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0 Safari/537.36",
@@ -40,26 +100,510 @@ BILI_HEADERS = {
 Q480 = 32
 QMAX = 125
 
+# Codec preference used when the client sends none: most compatible first
+DEFAULT_CODECS = [c.strip() for c in os.environ.get("BILIURL_DEFAULT_CODECS", "avc,hevc,av1").split(",") if c.strip()]
+CODEC_ALIASES = {
+    "avc": "avc",
+    "h264": "avc",
+    "avc1": "avc",
+    "hevc": "hevc",
+    "h265": "hevc",
+    "hev1": "hevc",
+    "hvc1": "hevc",
+    "av1": "av1",
+    "av01": "av1",
+    "aac": "aac",
+    "mp4a": "aac",
+    "dolby": "dolby",
+    "eac3": "dolby",
+    "ec-3": "dolby",
+    "flac": "flac",
+}
+
 ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
-COOKIES_DIR = os.path.join(ROOT_DIR, "cookies")
+# Where store.db, sessions.key and merge_cache/ live (defaults to the code directory)
+DATA_DIR = os.environ.get("BILIURL_DATA_DIR") or ROOT_DIR
+# Legacy per-user cookie files; migrated into the sessions table at startup
+COOKIES_DIR = os.path.join(DATA_DIR, "cookies")
 
-DB_FILE = os.path.join(ROOT_DIR, "store.db")
+DB_FILE = os.path.join(DATA_DIR, "store.db")
 
 # Root-level encrypted secret key (used for both session encryption and user_id keyed lookup)
-SESSIONS_KEY_FILE = os.path.join(ROOT_DIR, "sessions.key")
+SESSIONS_KEY_FILE = os.path.join(DATA_DIR, "sessions.key")
+
+# Upstream hosts; overridable so tests and bench/ can point at a local stand-in
+PASSPORT_BASE = os.environ.get("BILIURL_PASSPORT_BASE", "https://passport.bilibili.com").rstrip("/")
+WWW_BASE = os.environ.get("BILIURL_WWW_BASE", "https://www.bilibili.com").rstrip("/")
 
 # Concurrency safety (threaded requests / sync endpoints)
 STORE_LOCK = threading.RLock()
 
+# Session resolution cache: decrypted sessions are kept in memory so warm requests
+# touch neither sessions.key nor SQLite. Unknown user_ids are cached negatively.
+SESSION_CACHE_SIZE = 4096
+SESSION_CACHE_TTL = 600.0
+SESSION_NEGATIVE_TTL = 30.0
+# How often sessions.key is stat()-ed to detect rotation (seconds)
+KEY_RECHECK_INTERVAL = 5.0
+
 
 @dataclass
 class UserSession:
     created_at: float
     token: str
     cookie_dict: Dict[str, str]
+    # Keyed hash of user_id; invalidations from other workers name sessions by it
+    user_key: str = ""
+    # Set by the health checker when Bilibili no longer accepts the cookies
+    degraded: bool = False
+
+
+class _LRUCache:
+    """线程安全的有界 LRU 缓存，每个条目带 TTL，并统计命中/未命中次数。"""
+
+    def __init__(self, maxsize: int, ttl: float) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data: "OrderedDict[Any, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Any) -> Any:
+        now = time.monotonic()
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            expires_at, value = item
+            if expires_at <= now:
+                del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: Any, value: Any, ttl: Optional[float] = None) -> None:
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key: Any) -> Any:
+        with self._lock:
+            item = self._data.pop(key, None)
+        return item[1] if item else None
+
+    def pop_where(self, predicate: Callable[[Any], bool]) -> int:
+        """删除所有值满足 predicate 的条目（线性扫描，仅用于少见的失效路径）。"""
+        with self._lock:
+            doomed = [k for k, (_exp, v) in self._data.items() if predicate(v)]
+            for k in doomed:
+                del self._data[k]
+        return len(doomed)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            size = len(self._data)
+        total = self.hits + self.misses
+        return {
+            "size": size,
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / total, 4) if total else None,
+        }
+
+
+USER_SESSIONS = _LRUCache(maxsize=SESSION_CACHE_SIZE, ttl=SESSION_CACHE_TTL)
+# user_id -> True for ids that have no (valid) session row
+USER_SESSIONS_MISSING = _LRUCache(maxsize=SESSION_CACHE_SIZE, ttl=SESSION_NEGATIVE_TTL)
+
+# Loaded sessions.key material; refreshed when the file's mtime changes
+_KEY_STATE: Dict[str, Any] = {"key": None, "fernet": None, "mtime": None, "checked_at": 0.0, "loads": 0}
+
+# QR login flows older than this are removed by the background reaper
+LOGIN_FLOW_TTL = 600
+LOGIN_FLOW_REAP_INTERVAL = 60.0
+# Server-side QR watchers: one upstream qrcode/poll per interval per login_id however many
+# clients listen; a watcher nobody listens to stops after the idle grace, a finished one
+# keeps its final state around for late subscribers (a success hands out user_id/token
+# to the first client only; later ones just see the status)
+QR_WATCH_INTERVAL = _env_float("BILIURL_QR_WATCH_INTERVAL", 1.0)
+QR_WATCH_IDLE = 30.0
+QR_WATCH_LINGER = 60.0
+# SSE keepalive comment interval and the longest /login/wait hold (seconds)
+QR_EVENTS_HEARTBEAT = 15.0
+QR_WAIT_MAX = 60.0
+
+# Sessions older than this are rejected and deleted in bulk (SESSDATA itself lasts ~6 months)
+SESSION_MAX_AGE = _env_float("BILIURL_SESSION_MAX_AGE", 180 * 86400.0)
+SESSION_REAP_INTERVAL = _env_float("BILIURL_SESSION_REAP_INTERVAL", 3600.0)
+# VACUUM once this fraction of store.db pages is free
+DB_VACUUM_FREE_RATIO = _env_float("BILIURL_DB_VACUUM_FREE_RATIO", 0.25)
+# Each stored session's cookies are checked against nav this often; the job wakes every
+# SESSION_HEALTH_TICK seconds and checks at most SESSION_HEALTH_BATCH due sessions
+SESSION_HEALTH_INTERVAL = _env_float("BILIURL_SESSION_HEALTH_INTERVAL", 6 * 3600.0)
+SESSION_HEALTH_TICK = 60.0
+SESSION_HEALTH_BATCH = _env_int("BILIURL_SESSION_HEALTH_BATCH", 50)
+SESSION_HEALTH_STATS: Dict[str, int] = {
+    "checked": 0, "ok": 0, "degraded": 0, "refreshed": 0, "errors": 0, "throttled": 0, "conflicts": 0
+}
+# Public key www.bilibili.com uses for the cookie refresh "correspond" path
+BILI_CORRESPOND_KEY = b"""-----BEGIN PUBLIC KEY-----
+MIGfMA0GCSqGSIb3DQEBAQUAA4GNADCBiQKBgQDLgd2OAkcGVtoE3ThUREbio0Eg
+Uc/prcajMKXvkCKFCWhJYJcLkcM2DKKcSeFpD/j6Boy538YXnR6VhcuUJOhH2x71
+nzPjfdTcqMz7djHum0qSZA0AyCBDABUqCrfNgCiJ00Ra7GmRj+YCK1NJEuewlb40
+JNrRuoEUXpabUzGB8QIDAQAB
+-----END PUBLIC KEY-----
+"""
+# Counters for the one-time cookie migration and the session reaper (reported by /stats)
+SESSION_STORE_STATS: Dict[str, int] = {
+    "migrated": 0, "orphaned": 0, "undecryptable": 0, "stamped": 0, "reaped": 0, "vacuums": 0
+}
+
+# One SQLite connection per thread; schema is created once per process
+_DB_LOCAL = threading.local()
+_DB_STATE: Dict[str, Any] = {"schema_ready": False}
+_DB_INIT_LOCK = threading.Lock()
+
+# Cross-worker cache for pagelist/playurl (and sessions with redis) plus invalidation
+# fan-out. "sqlite" shares store.db between the workers of one host; "redis" also
+# spans hosts and needs the redis package.
+SHARED_BACKEND = os.environ.get("BILIURL_SHARED_BACKEND", "sqlite").strip().lower()
+REDIS_URL = os.environ.get("BILIURL_REDIS_URL", "redis://127.0.0.1:6379/0")
+REDIS_PREFIX = os.environ.get("BILIURL_REDIS_PREFIX", "biliurl:")
+# Workers apply invalidations published by others within this many seconds
+INVALIDATION_POLL_INTERVAL = _env_float("BILIURL_INVALIDATION_POLL_INTERVAL", 1.0)
+# SQLite backend: invalidation log rows and expired values are purged this often
+SHARED_CACHE_PURGE_INTERVAL = 300.0
+INVALIDATION_LOG_TTL = 3600.0
+
+# bvid -> page list cache (memory LRU in front of the shared backend).
+# A bvid's pages practically never change, hence the long TTL.
+PAGELIST_CACHE_SIZE = 4096
+PAGELIST_TTL = 7 * 24 * 3600.0
+# DELETE /cache/pagelist: when set, callers must send it as X-Admin-Token; when unset,
+# any valid login session may invalidate
+ADMIN_TOKEN = os.environ.get("BILIURL_ADMIN_TOKEN", "")
+
+# (bvid, cid, qn, auth tier) -> playurl json. Entries expire shortly before the
+# deadline= signed into the returned stream URLs.
+PLAYURL_CACHE_SIZE = 4096
+PLAYURL_EXPIRY_MARGIN = 120.0
+PLAYURL_DEFAULT_TTL = 300.0
+
+# /stream/pages: playurl lookups for the pages of one bvid run this many at a time
+PAGE_RESOLVE_WORKERS = _env_int("BILIURL_PAGE_RESOLVE_WORKERS", 16)
+
+# POST /stream/batch: (bvid, page) resolutions in flight across all batches (also the
+# size of the batch thread pool), and the most a single batch may ask for
+BATCH_CONCURRENCY = _env_int("BILIURL_BATCH_CONCURRENCY", 32)
+BATCH_MAX_ITEMS = _env_int("BILIURL_BATCH_MAX_ITEMS", 1000)
+
+# WBI mixin key (from nav img/sub keys): refreshed in the background, and on demand
+# once older than WBI_KEY_MAX_AGE or after the API rejects a signature
+WBI_KEY_REFRESH_INTERVAL = _env_float("BILIURL_WBI_KEY_REFRESH_INTERVAL", 3600.0)
+WBI_KEY_MAX_AGE = 2 * WBI_KEY_REFRESH_INTERVAL
+# playurl codes meaning "signature/risk check failed" rather than "no such video"
+WBI_REJECT_CODES = (-352, -403)
+
+# api.bilibili.com rate governor: a token bucket whose rate halves on -412/-352
+# risk-control answers and climbs back by UPSTREAM_RECOVERY req/s per second of clean
+# responses. Interactive calls are served before batch, batch before background.
+# UPSTREAM_RATE/MIN_RATE/BURST are for the whole host: each worker process keeps its
+# own bucket with a 1/UPSTREAM_WORKERS share (defaults to uvicorn's WEB_CONCURRENCY,
+# set BILIURL_WORKERS when starting workers any other way).
+UPSTREAM_WORKERS = max(1, _env_int("BILIURL_WORKERS", _env_int("WEB_CONCURRENCY", 1)))
+UPSTREAM_RATE = _env_float("BILIURL_UPSTREAM_RATE", 20.0)
+UPSTREAM_MIN_RATE = _env_float("BILIURL_UPSTREAM_MIN_RATE", 0.5)
+UPSTREAM_BURST = _env_float("BILIURL_UPSTREAM_BURST", 10.0)
+UPSTREAM_RECOVERY = _env_float("BILIURL_UPSTREAM_RECOVERY", 0.5)
+UPSTREAM_BACKOFF = 0.5
+# Risk answers to requests already in flight don't halve the rate again within this window
+UPSTREAM_BACKOFF_COOLDOWN = 2.0
+UPSTREAM_RISK_CODES = (-412, -352)
+# Longest a call waits for a token before failing with 503
+UPSTREAM_MAX_WAIT = {
+    "interactive": _env_float("BILIURL_UPSTREAM_MAX_WAIT", 10.0),
+    "batch": 60.0,
+    "background": 120.0,
+}
+UPSTREAM_PRIORITIES = ("interactive", "batch", "background")
+
+# Shared keep-alive pool for every upstream call (api.bilibili.com, passport, upos CDN)
+HTTP_POOL_HOSTS = _env_int("BILIURL_HTTP_POOL_HOSTS", 32)
+HTTP_POOL_PER_HOST = _env_int("BILIURL_HTTP_POOL_PER_HOST", 32)
+# Pools block at HTTP_POOL_PER_HOST; a caller waiting longer than this for a free
+# connection fails with requests.ConnectionError instead of hanging its thread
+HTTP_POOL_WAIT = _env_float("BILIURL_HTTP_POOL_WAIT", 30.0)
+# 0 disables the DNS cache of the shared pool
+DNS_CACHE_TTL = _env_float("BILIURL_DNS_CACHE_TTL", 300.0)
+
+# Async client used by the /download/* streaming proxy: each in-flight download
+# is a coroutine, not a threadpool worker. HTTP/2 needs the optional `h2` package.
+ASYNC_HTTP_MAX_CONNECTIONS = _env_int("BILIURL_ASYNC_HTTP_MAX_CONNECTIONS", 1024)
+ASYNC_HTTP_MAX_KEEPALIVE = _env_int("BILIURL_ASYNC_HTTP_MAX_KEEPALIVE", 128)
+HTTP2 = os.environ.get("BILIURL_HTTP2", "0") == "1"
+# Upper bound of data buffered per proxied connection
+PROXY_CHUNK_SIZE = 256 * 1024
+
+# CDN mirror selection: the first CDN_RACE_WIDTH ranked mirrors (baseUrl + backupUrl)
+# are requested at once and the first to answer wins. A read that makes no progress
+# for CDN_STALL_TIMEOUT seconds counts as a stall and resumes on another mirror.
+CDN_RACE_WIDTH = _env_int("BILIURL_CDN_RACE_WIDTH", 2)
+CDN_STALL_TIMEOUT = _env_float("BILIURL_CDN_STALL_TIMEOUT", 8.0)
+# Measured latencies fade back to the prior with this half-life (seconds)
+CDN_SCORE_HALF_LIFE = _env_float("BILIURL_CDN_SCORE_HALF_LIFE", 600.0)
+CDN_FAILOVER_ATTEMPTS = 3
+
+# /merge/mp4/remote track fetcher: both tracks download at once and large tracks
+# are split into byte ranges fetched in parallel over the shared pool.
+MERGE_FETCH_WORKERS = _env_int("BILIURL_MERGE_FETCH_WORKERS", 16)
+MERGE_RANGE_SIZE = _env_int("BILIURL_MERGE_RANGE_SIZE", 4 * 1024 * 1024)
+MERGE_RANGE_RETRIES = 3
+
+# Content-addressed cache of merged MP4s, keyed by (bvid, cid, video stream, audio stream)
+MERGE_CACHE_DIR = os.path.join(DATA_DIR, "merge_cache")
+MERGE_CACHE_MAX_BYTES = _env_int("BILIURL_MERGE_CACHE_MAX_BYTES", 10 * 1024 * 1024 * 1024)
+# Entries served this recently are never evicted (a response may still be reading them)
+MERGE_CACHE_MIN_AGE = _env_float("BILIURL_MERGE_CACHE_MIN_AGE", 60.0)
+
+# ffmpeg mux scheduler: at most FFMPEG_MAX_JOBS processes, FFMPEG_MAX_QUEUE waiters;
+# beyond that requests are rejected with 503 + Retry-After
+FFMPEG_MAX_JOBS = _env_int("BILIURL_FFMPEG_MAX_JOBS", os.cpu_count() or 2)
+FFMPEG_MAX_QUEUE = _env_int("BILIURL_FFMPEG_MAX_QUEUE", 16)
+FFMPEG_QUEUE_TIMEOUT = _env_float("BILIURL_FFMPEG_QUEUE_TIMEOUT", 300.0)
+
+# "auto": built-in bmff remuxer with ffmpeg as fallback; "bmff" / "ffmpeg": only that one
+MUXER = os.environ.get("BILIURL_MUXER", "auto")
+
+# Background maintenance threads (started on app startup)
+_BACKGROUND_STOP = threading.Event()
+_BACKGROUND_THREADS: Dict[str, threading.Thread] = {}
+
+
+class _Timing:
+    """累计耗时统计（次数/总耗时/最大耗时）。"""
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float) -> None:
+        with self._lock:
+            self.count += 1
+            self.total += seconds
+            if seconds > self.max:
+                self.max = seconds
+
+    @contextmanager
+    def time(self) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(time.perf_counter() - start)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            count, total, peak = self.count, self.total, self.max
+        return {
+            "count": count,
+            "total_ms": round(total * 1000, 3),
+            "avg_ms": round(total * 1000 / count, 3) if count else None,
+            "max_ms": round(peak * 1000, 3),
+        }
+
+
+DB_TIMING = _Timing()
+
+
+# Prometheus text exposition (GET /metrics); a small in-house registry, no client library
+_METRICS: List[Any] = []
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+
+def _label_str(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    parts = [f'{n}="{v}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class _Histogram:
+    """带标签的直方图（Prometheus histogram）。"""
+
+    def __init__(self, name: str, doc: str, labels: Tuple[str, ...] = (), buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.name = name
+        self.doc = doc
+        self.labels = labels
+        self.buckets = buckets
+        self._series: Dict[Tuple[str, ...], List[float]] = {}
+        self._lock = threading.Lock()
+        _METRICS.append(self)
+
+    def observe(self, value: float, *labels: str) -> None:
+        with self._lock:
+            # [bucket counts..., sum, count]
+            series = self._series.setdefault(labels, [0.0] * (len(self.buckets) + 2))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    @contextmanager
+    def time(self, *labels: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {k: list(v) for k, v in self._series.items()}
+        for labels, values in sorted(series.items()):
+            for bound, count in zip(self.buckets, values):
+                le = 'le="%s"' % bound
+                lines.append(f"{self.name}_bucket{_label_str(self.labels, labels, le)} {int(count)}")
+            le = 'le="+Inf"'
+            lines.append(f"{self.name}_bucket{_label_str(self.labels, labels, le)} {int(values[-1])}")
+            lines.append(f"{self.name}_sum{_label_str(self.labels, labels)} {values[-2]}")
+            lines.append(f"{self.name}_count{_label_str(self.labels, labels)} {int(values[-1])}")
+        return lines
+
+
+class _Counter:
+    """带标签的计数器；kind="gauge" 时可增可减。"""
+
+    def __init__(self, name: str, doc: str, labels: Tuple[str, ...] = (), kind: str = "counter"):
+        self.name = name
+        self.doc = doc
+        self.labels = labels
+        self.kind = kind
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+        _METRICS.append(self)
+
+    def inc(self, amount: float = 1, *labels: str) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, amount: float = 1, *labels: str) -> None:
+        self.inc(-amount, *labels)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            values = dict(self._values)
+        for labels, value in sorted(values.items()):
+            lines.append(f"{self.name}{_label_str(self.labels, labels)} {value:g}")
+        return lines
+
+
+UPSTREAM_SECONDS = _Histogram(
+    "biliurl_upstream_request_seconds", "Bilibili API call latency.", ("api",)
+)
+CDN_FIRST_BYTE_SECONDS = _Histogram("biliurl_cdn_first_byte_seconds", "CDN time to response headers.")
+TRANSFER_SECONDS = _Histogram("biliurl_transfer_seconds", "Full track transfer / stream duration.", ("path",))
+PROXIED_BYTES = _Counter("biliurl_proxied_bytes_total", "Bytes sent to clients from upstream.", ("endpoint",))
+ACTIVE_STREAMS = _Counter("biliurl_active_streams", "Responses currently streaming.", ("endpoint",), kind="gauge")
+MUX_WAIT_SECONDS = _Histogram("biliurl_mux_queue_wait_seconds", "Time waiting for an ffmpeg slot.")
+MUX_RUN_SECONDS = _Histogram("biliurl_mux_run_seconds", "Time an ffmpeg slot was held.")
+# Included in biliurl_upstream_request_seconds, which times the call as the caller sees it
+UPSTREAM_WAIT_SECONDS = _Histogram(
+    "biliurl_upstream_wait_seconds", "Time waiting for an api.bilibili.com rate token.", ("priority",)
+)
+
+# Per-request stage timings for the Server-Timing header (set by _ResponseHeadersMiddleware)
+_STAGES: ContextVar[Optional[List[Tuple[str, float]]]] = ContextVar("biliurl_stages", default=None)
+# Per-request flags handlers raise for the middleware to turn into headers (e.g. session_stale)
+_REQUEST_FLAGS: ContextVar[Optional[Dict[str, Any]]] = ContextVar("biliurl_request_flags", default=None)
+
+
+def _flag_request(name: str) -> None:
+    flags = _REQUEST_FLAGS.get()
+    if flags is not None:
+        flags[name] = True
+
+
+@contextmanager
+def _stage(name: str) -> Iterator[None]:
+    stages = _STAGES.get()
+    if stages is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stages.append((name, time.perf_counter() - start))
+
 
+def _server_timing(stages: List[Tuple[str, float]], total: float) -> str:
+    # Repeated stages (e.g. /stream/pages) are summed under one name
+    merged: Dict[str, float] = {}
+    for name, seconds in stages:
+        merged[name] = merged.get(name, 0.0) + seconds
+    parts = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in merged.items()]
+    parts.append(f"total;dur={total * 1000:.1f}")
+    return ", ".join(parts)
 
-USER_SESSIONS: Dict[str, UserSession] = {}
+
+@dataclass
+class _Flight:
+    event: threading.Event
+    result: Any = None
+    error: Optional[BaseException] = None
+
+
+class _SingleFlight:
+    """同一个 key 的并发调用只真正执行一次，其余调用等待并共享结果（或异常）。"""
+
+    def __init__(self) -> None:
+        self.shared = 0
+        self._calls: Dict[Any, _Flight] = {}
+        self._lock = threading.Lock()
+
+    def do(self, key: Any, fn: Callable[[], Any]) -> Any:
+        with self._lock:
+            flight = self._calls.get(key)
+            leader = flight is None
+            if leader:
+                flight = _Flight(event=threading.Event())
+                self._calls[key] = flight
+            else:
+                self.shared += 1
+
+        if not leader:
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = fn()
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            flight.event.set()
+        return flight.result
 
 
 def _now() -> float:
@@ -67,7 +611,7 @@ def _now() -> float:
 
 
 def _ensure_dirs() -> None:
-    os.makedirs(COOKIES_DIR, exist_ok=True)
+    os.makedirs(DATA_DIR, exist_ok=True)
 
 
 def _ensure_db_dir() -> None:
@@ -76,9 +620,11 @@ def _ensure_db_dir() -> None:
         os.makedirs(db_dir, exist_ok=True)
 
 
-def _db_connect() -> sqlite3.Connection:
+def _db_open() -> sqlite3.Connection:
     _ensure_db_dir()
-    conn = sqlite3.connect(DB_FILE, timeout=30, isolation_level=None, check_same_thread=False)
+    conn = sqlite3.connect(
+        DB_FILE, timeout=30, isolation_level=None, check_same_thread=False, cached_statements=256
+    )
     # Best-effort PRAGMA; avoid crashing on filesystems that don't support WAL
     try:
         conn.execute("PRAGMA journal_mode=WAL;")
@@ -91,44 +637,834 @@ def _db_connect() -> sqlite3.Connection:
     return conn
 
 
-def _db_init() -> None:
-    _ensure_dirs()
-    _ensure_db_dir()
-    conn = _db_connect()
+def _db_thread_conn() -> sqlite3.Connection:
+    conn = getattr(_DB_LOCAL, "conn", None)
+    if conn is None:
+        conn = _db_open()
+        _DB_LOCAL.conn = conn
+    return conn
+
+
+def _db_connect() -> sqlite3.Connection:
+    """返回当前线程复用的连接（PRAGMA 在建连时执行一次，语句走 sqlite3 的预编译缓存）。"""
+    if not _DB_STATE["schema_ready"]:
+        _db_init()
+    return _db_thread_conn()
+
+
+def _db_execute(sql: str, params: Tuple[Any, ...] = ()) -> sqlite3.Cursor:
+    with DB_TIMING.time():
+        return _db_connect().execute(sql, params)
+
+
+def _db_fetchone(sql: str, params: Tuple[Any, ...] = ()) -> Optional[Tuple[Any, ...]]:
+    with DB_TIMING.time():
+        return _db_connect().execute(sql, params).fetchone()
+
+
+def _db_fetchall(sql: str, params: Tuple[Any, ...] = ()) -> List[Tuple[Any, ...]]:
+    with DB_TIMING.time():
+        return _db_connect().execute(sql, params).fetchall()
+
+
+class _TimedConnection:
+    """事务内使用的连接包装：只累计 SQL 语句本身的耗时，不含调用方在事务中做的加解密等工作。"""
+
+    def __init__(self, conn: sqlite3.Connection) -> None:
+        self.conn = conn
+        self.elapsed = 0.0
+
+    def execute(self, sql: str, params: Tuple[Any, ...] = ()) -> sqlite3.Cursor:
+        start = time.perf_counter()
+        try:
+            return self.conn.execute(sql, params)
+        finally:
+            self.elapsed += time.perf_counter() - start
+
+
+@contextmanager
+def _db_transaction() -> Iterator[_TimedConnection]:
+    conn = _TimedConnection(_db_connect())
+    conn.execute("BEGIN IMMEDIATE")
     try:
-        conn.execute(
-            """
-            CREATE TABLE IF NOT EXISTS login_flows (
-                login_id TEXT PRIMARY KEY,
-                created_at REAL NOT NULL,
-                qrcode_key TEXT NOT NULL
-            );
-            """
-        )
-        conn.execute(
-            """
-            CREATE TABLE IF NOT EXISTS sessions (
-                user_key TEXT PRIMARY KEY,
-                payload BLOB NOT NULL
-            );
-            """
+        yield conn
+    except BaseException:
+        conn.execute("ROLLBACK")
+        DB_TIMING.record(conn.elapsed)
+        raise
+    conn.execute("COMMIT")
+    # One sample per transaction, like one per _db_execute
+    DB_TIMING.record(conn.elapsed)
+
+
+def _db_init() -> None:
+    with _DB_INIT_LOCK:
+        if _DB_STATE["schema_ready"]:
+            return
+        _ensure_dirs()
+        conn = _db_thread_conn()
+        _db_create_schema(conn)
+        _DB_STATE["schema_ready"] = True
+
+
+def _db_create_schema(conn: sqlite3.Connection) -> None:
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS login_flows (
+            login_id TEXT PRIMARY KEY,
+            created_at REAL NOT NULL,
+            qrcode_key TEXT NOT NULL
+        );
+        """
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_login_flows_created_at ON login_flows(created_at);")
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS sessions (
+            user_key TEXT PRIMARY KEY,
+            payload BLOB NOT NULL,
+            created_at REAL NOT NULL DEFAULT 0
+        );
+        """
+    )
+    # Tables created before created_at was a column get it added in place; their rows
+    # are stamped from the encrypted payload by _migrate_sessions()
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(sessions)")}
+    for column in ("created_at", "checked_at"):
+        if column not in columns:
+            conn.execute(f"ALTER TABLE sessions ADD COLUMN {column} REAL NOT NULL DEFAULT 0;")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_sessions_created_at ON sessions(created_at);")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_sessions_checked_at ON sessions(checked_at);")
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS merge_cache (
+            cache_key TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            last_access REAL NOT NULL
+        );
+        """
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_merge_cache_last_access ON merge_cache(last_access);")
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS shared_cache (
+            ns TEXT NOT NULL,
+            key TEXT NOT NULL,
+            value TEXT NOT NULL,
+            expires_at REAL NOT NULL,
+            PRIMARY KEY (ns, key)
+        ) WITHOUT ROWID;
+        """
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_shared_cache_expires_at ON shared_cache(expires_at);")
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS cache_invalidations (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            ns TEXT NOT NULL,
+            key TEXT NOT NULL,
+            at REAL NOT NULL
+        );
+        """
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_cache_invalidations_at ON cache_invalidations(at);")
+    # Superseded by shared_cache (ns "pagelist")
+    conn.execute("DROP TABLE IF EXISTS pagelist_cache;")
+
+
+class _SqliteBackend:
+    """同机多 worker 共享缓存：值存 store.db 的 shared_cache 表，失效事件写入 cache_invalidations 日志，
+    各 worker 按序号增量轮询。"""
+
+    name = "sqlite"
+    # The sessions table in store.db is already shared by every worker on the host
+    stores_sessions = False
+
+    def __init__(self) -> None:
+        self.hits = 0
+        self.misses = 0
+        self.published = 0
+        self.received = 0
+        self._last_seq: Optional[int] = None
+        self._lock = threading.Lock()
+
+    def get(self, ns: str, key: str) -> Optional[Tuple[str, float]]:
+        """返回 (value, 剩余 TTL 秒)；不存在或已过期返回 None。"""
+        row = _db_fetchone("SELECT value, expires_at FROM shared_cache WHERE ns = ? AND key = ?", (ns, key))
+        remaining = (float(row[1]) - _now()) if row else 0.0
+        if remaining <= 0:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return row[0], remaining
+
+    def set(self, ns: str, key: str, value: str, ttl: float) -> None:
+        _db_execute(
+            "INSERT OR REPLACE INTO shared_cache(ns, key, value, expires_at) VALUES (?, ?, ?, ?)",
+            (ns, key, value, _now() + ttl),
         )
+
+    def delete(self, ns: str, key: str) -> bool:
+        return _db_execute("DELETE FROM shared_cache WHERE ns = ? AND key = ?", (ns, key)).rowcount > 0
+
+    def publish(self, ns: str, key: str) -> None:
+        _db_execute("INSERT INTO cache_invalidations(ns, key, at) VALUES (?, ?, ?)", (ns, key, _now()))
+        self.published += 1
+
+    def poll(self) -> List[Tuple[str, str]]:
+        with self._lock:
+            if self._last_seq is None:
+                # First poll only sets the watermark; older events predate this process's caches
+                row = _db_fetchone("SELECT MAX(seq) FROM cache_invalidations")
+                self._last_seq = int(row[0] or 0) if row else 0
+                return []
+            rows = _db_fetchall(
+                "SELECT seq, ns, key FROM cache_invalidations WHERE seq > ? ORDER BY seq", (self._last_seq,)
+            )
+            if rows:
+                self._last_seq = int(rows[-1][0])
+        self.received += len(rows)
+        return [(str(ns), str(key)) for _seq, ns, key in rows]
+
+    def start(self) -> None:
+        self.poll()
+
+    def purge(self) -> None:
+        now = _now()
+        _db_execute("DELETE FROM shared_cache WHERE expires_at < ?", (now,))
+        _db_execute("DELETE FROM cache_invalidations WHERE at < ?", (now - INVALIDATION_LOG_TTL,))
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "backend": self.name,
+            "hits": self.hits,
+            "misses": self.misses,
+            "invalidations_published": self.published,
+            "invalidations_received": self.received,
+        }
+
+
+class _RedisBackend:
+    """Redis（或兼容实现）共享缓存：值带 PX 过期，失效事件走 pub/sub 频道；可跨主机。"""
+
+    name = "redis"
+    # store.db is per host, so sessions are written through to redis as well
+    stores_sessions = True
+
+    def __init__(self, url: str, prefix: str) -> None:
+        try:
+            import redis
+        except ImportError as e:
+            raise RuntimeError("BILIURL_SHARED_BACKEND=redis requires the redis package") from e
+        self._redis = redis
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+        self.channel = f"{prefix}invalidate"
+        self.hits = 0
+        self.misses = 0
+        self.published = 0
+        self.received = 0
+        self._pending: Deque[Tuple[str, str]] = deque()
+        self._thread: Optional[threading.Thread] = None
+
+    def _key(self, ns: str, key: str) -> str:
+        return f"{self.prefix}{ns}:{key}"
+
+    def get(self, ns: str, key: str) -> Optional[Tuple[str, float]]:
+        pipe = self.client.pipeline(transaction=False)
+        pipe.get(self._key(ns, key))
+        pipe.pttl(self._key(ns, key))
+        value, pttl = pipe.execute()
+        if value is None or pttl == -2:
+            self.misses += 1
+            return None
+        self.hits += 1
+        # -1: no expiry set (written by something else); treat as the default TTL
+        remaining = pttl / 1000.0 if pttl > 0 else PLAYURL_DEFAULT_TTL
+        return value.decode("utf-8"), remaining
+
+    def set(self, ns: str, key: str, value: str, ttl: float) -> None:
+        self.client.set(self._key(ns, key), value, px=max(1, int(ttl * 1000)))
+
+    def delete(self, ns: str, key: str) -> bool:
+        return bool(self.client.delete(self._key(ns, key)))
+
+    def publish(self, ns: str, key: str) -> None:
+        self.client.publish(self.channel, json.dumps([ns, key]))
+        self.published += 1
+
+    def _listen(self) -> None:
+        while not _BACKGROUND_STOP.is_set():
+            try:
+                pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                while not _BACKGROUND_STOP.is_set():
+                    msg = pubsub.get_message(timeout=1.0)
+                    if not msg:
+                        continue
+                    try:
+                        ns, key = json.loads(msg["data"])
+                    except (ValueError, TypeError):
+                        continue
+                    self._pending.append((str(ns), str(key)))
+            except self._redis.RedisError:
+                # Connection lost: resubscribe after a pause; events in between are missed
+                _BACKGROUND_STOP.wait(1.0)
+
+    def poll(self) -> List[Tuple[str, str]]:
+        events: List[Tuple[str, str]] = []
+        while self._pending:
+            events.append(self._pending.popleft())
+        self.received += len(events)
+        return events
+
+    def start(self) -> None:
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self._listen, name="biliurl-redis-invalidations", daemon=True)
+        self._thread.start()
+
+    def purge(self) -> None:
+        # Redis expires keys itself
+        pass
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "backend": self.name,
+            "hits": self.hits,
+            "misses": self.misses,
+            "invalidations_published": self.published,
+            "invalidations_received": self.received,
+        }
+
+
+def _make_shared_backend() -> Any:
+    if SHARED_BACKEND == "redis":
+        return _RedisBackend(REDIS_URL, REDIS_PREFIX)
+    if SHARED_BACKEND != "sqlite":
+        raise RuntimeError(f"unknown BILIURL_SHARED_BACKEND: {SHARED_BACKEND!r} (expected sqlite or redis)")
+    return _SqliteBackend()
+
+
+SHARED = _make_shared_backend()
+
+
+class _PagelistCache:
+    """bvid -> 分P 列表的两级缓存：内存 LRU + 共享后端（SHARED）；实现 biliurl.pagelist_cache 协议。"""
+
+    def __init__(self, maxsize: int, ttl: float) -> None:
+        self.ttl = ttl
+        self.memory = _LRUCache(maxsize=maxsize, ttl=ttl)
+        self.shared_hits = 0
+        self.shared_misses = 0
+
+    def get(self, bvid: str) -> Optional[List[Dict[str, Any]]]:
+        pages = self.memory.get(bvid)
+        if pages is not None:
+            return pages
+
+        hit = SHARED.get("pagelist", bvid)
+        if hit is None:
+            self.shared_misses += 1
+            return None
+        try:
+            pages = json.loads(hit[0])
+        except ValueError:
+            self.shared_misses += 1
+            return None
+        self.shared_hits += 1
+        self.memory.set(bvid, pages, ttl=hit[1])
+        return pages
+
+    def put(self, bvid: str, pages: List[Dict[str, Any]]) -> None:
+        self.memory.set(bvid, pages)
+        SHARED.set("pagelist", bvid, json.dumps(pages, ensure_ascii=False, separators=(",", ":")), self.ttl)
+
+    def invalidate(self, bvid: str) -> bool:
+        in_memory = self.memory.pop(bvid) is not None
+        in_shared = SHARED.delete("pagelist", bvid)
+        # Other workers drop their in-memory copy on their next poll
+        SHARED.publish("pagelist", bvid)
+        return in_memory or in_shared
+
+    def stats(self) -> Dict[str, Any]:
+        return {"memory": self.memory.stats(), "shared_hits": self.shared_hits, "shared_misses": self.shared_misses}
+
+
+PAGELIST_CACHE = _PagelistCache(maxsize=PAGELIST_CACHE_SIZE, ttl=PAGELIST_TTL)
+_PAGELIST_FLIGHT = _SingleFlight()
+# biliurl.getCid/getPagelist callers in this process share the same cache
+biliurl.pagelist_cache = PAGELIST_CACHE
+
+PLAYURL_CACHE = _LRUCache(maxsize=PLAYURL_CACHE_SIZE, ttl=PLAYURL_DEFAULT_TTL)
+_PLAYURL_FLIGHT = _SingleFlight()
+
+
+class _WbiKeys:
+    """WBI 签名用的 mixin key：从 nav 接口取 img/sub key，内存缓存并定时刷新。"""
+
+    def __init__(self, max_age: float) -> None:
+        self.max_age = max_age
+        self.mixin_key: Optional[str] = None
+        self.fetched_at = 0.0
+        self.stale = False
+        self.refreshes = 0
+        self.failures = 0
+        self._flight = _SingleFlight()
+
+    def refresh(self) -> Optional[str]:
+        def _fetch() -> Optional[str]:
+            try:
+                with UPSTREAM_SECONDS.time("nav"):
+                    img_key, sub_key = biliurl.getWbiKeys(session=HTTP)
+            except (RuntimeError, ValueError, requests.RequestException):
+                self.failures += 1
+                return None
+            self.mixin_key = biliurl.getMixinKey(img_key, sub_key)
+            self.fetched_at = time.monotonic()
+            self.stale = False
+            self.refreshes += 1
+            return self.mixin_key
+
+        return self._flight.do("nav", _fetch)
+
+    def get(self) -> Optional[str]:
+        if self.mixin_key and not self.stale and time.monotonic() - self.fetched_at < self.max_age:
+            return self.mixin_key
+        # Stale or missing: refresh inline; a failed refresh still leaves the old key usable
+        return self.refresh() or self.mixin_key
+
+    def invalidate(self) -> None:
+        self.stale = True
+
+    def stats(self) -> Dict[str, Any]:
+        age = time.monotonic() - self.fetched_at if self.mixin_key else None
+        return {
+            "loaded": self.mixin_key is not None,
+            "stale": self.stale,
+            "age_s": round(age, 1) if age is not None else None,
+            "refreshes": self.refreshes,
+            "failures": self.failures,
+        }
+
+
+class _VariantMemory:
+    """记住每个上游接口当前成功的请求方式（如 wbi 签名 / 旧接口），下次优先尝试它。"""
+
+    def __init__(self) -> None:
+        self.preferred: Dict[str, str] = {}
+        self.switches = 0
+
+    def order(self, endpoint: str, variants: List[str]) -> List[str]:
+        first = self.preferred.get(endpoint)
+        if first not in variants:
+            return list(variants)
+        return [first] + [v for v in variants if v != first]
+
+    def succeeded(self, endpoint: str, variant: str) -> None:
+        previous = self.preferred.get(endpoint)
+        if previous != variant:
+            if previous is not None:
+                self.switches += 1
+            self.preferred[endpoint] = variant
+
+    def stats(self) -> Dict[str, Any]:
+        return {"preferred": dict(self.preferred), "switches": self.switches}
+
+
+WBI_KEYS = _WbiKeys(WBI_KEY_MAX_AGE)
+API_VARIANTS = _VariantMemory()
+PLAYURL_ENDPOINTS = {
+    "wbi": f"{biliurl.API_BASE}/x/player/wbi/playurl",
+    "legacy": f"{biliurl.API_BASE}/x/player/playurl",
+}
+
+
+# Priority of api.bilibili.com calls made from the current context (see _RateGovernor)
+_UPSTREAM_PRIORITY: ContextVar[str] = ContextVar("biliurl_upstream_priority", default="interactive")
+
+
+@contextmanager
+def _upstream_priority(priority: str) -> Iterator[None]:
+    token = _UPSTREAM_PRIORITY.set(priority)
+    try:
+        yield
     finally:
-        conn.close()
+        _UPSTREAM_PRIORITY.reset(token)
+
+
+class _UpstreamThrottled(Exception):
+    """GOVERNOR 等待令牌超时。不是上游错误：降级/重试都无济于事，由 exception handler 转成 503。"""
+
+    def __init__(self, rate: float, retry_after: int) -> None:
+        super().__init__(f"upstream throttled at {rate:.3f} req/s")
+        self.rate = rate
+        self.retry_after = retry_after
+
+    @property
+    def detail(self) -> Dict[str, Any]:
+        return {"error": "upstream_throttled", "rate": round(self.rate, 3)}
+
+
+class _RateGovernor:
+    """api.bilibili.com 的全局令牌桶：遇到 -412/-352 风控时速率减半（AIMD），之后逐步恢复；
+    排队时高优先级（interactive > batch > background）先拿令牌。"""
+
+    def __init__(self, rate: float, min_rate: float, burst: float) -> None:
+        self.max_rate = rate
+        self.min_rate = min(min_rate, rate)
+        self.burst = max(1.0, burst)
+        self.rate = rate
+        self.tokens = self.burst
+        self.waiting = {p: 0 for p in UPSTREAM_PRIORITIES}
+        self.granted = {p: 0 for p in UPSTREAM_PRIORITIES}
+        self.throttled = {p: 0 for p in UPSTREAM_PRIORITIES}
+        self.wait_seconds = 0.0
+        self.risk_events = 0
+        self.backoffs = 0
+        self._refilled_at = time.monotonic()
+        self._adjusted_at = self._refilled_at
+        self._backoff_at = 0.0
+        self._cond = threading.Condition()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self._refilled_at) * self.rate)
+        self._refilled_at = now
+
+    def _outranked(self, priority: str) -> bool:
+        rank = UPSTREAM_PRIORITIES.index(priority)
+        return any(self.waiting[p] for p in UPSTREAM_PRIORITIES[:rank])
+
+    def acquire(self, priority: str = "interactive") -> None:
+        """取一个令牌；超过 UPSTREAM_MAX_WAIT 仍未取到则抛 _UpstreamThrottled。"""
+        if priority not in self.waiting:
+            priority = "interactive"
+        start = time.monotonic()
+        deadline = start + UPSTREAM_MAX_WAIT[priority]
+        with self._cond:
+            self.waiting[priority] += 1
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._refill(now)
+                    if self.tokens >= 1.0 and not self._outranked(priority):
+                        self.tokens -= 1.0
+                        self.granted[priority] += 1
+                        self.wait_seconds += now - start
+                        UPSTREAM_WAIT_SECONDS.observe(now - start, priority)
+                        return
+                    if now >= deadline:
+                        self.throttled[priority] += 1
+                        retry_after = max(1, int(self.waiting[priority] / self.rate + 1))
+                        raise _UpstreamThrottled(self.rate, retry_after)
+                    # Sleep until the next token is due; outranked waiters re-check as well
+                    due = max(0.0, (1.0 - self.tokens) / self.rate)
+                    self._cond.wait(min(max(due, 0.005), deadline - now))
+            finally:
+                self.waiting[priority] -= 1
+                # Lower-priority waiters may now be next in line
+                self._cond.notify_all()
+
+    def observe(self, risk: bool) -> None:
+        now = time.monotonic()
+        with self._cond:
+            if risk:
+                self.risk_events += 1
+                if now - self._backoff_at >= UPSTREAM_BACKOFF_COOLDOWN:
+                    self.rate = max(self.min_rate, self.rate * UPSTREAM_BACKOFF)
+                    # Drop the saved-up burst too: the next calls are paced at the new rate
+                    self.tokens = min(self.tokens, 0.0)
+                    self._backoff_at = now
+                    self.backoffs += 1
+            elif self.rate < self.max_rate:
+                # Additive increase, proportional to the time since the last adjustment
+                elapsed = min(now - self._adjusted_at, 1.0)
+                self.rate = min(self.max_rate, self.rate + UPSTREAM_RECOVERY * elapsed)
+            self._adjusted_at = now
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            self._refill(time.monotonic())
+            granted = sum(self.granted.values())
+            return {
+                "rate": round(self.rate, 3),
+                "max_rate": self.max_rate,
+                "tokens": round(self.tokens, 2),
+                "queue": dict(self.waiting),
+                "granted": dict(self.granted),
+                "throttled": dict(self.throttled),
+                "avg_wait_ms": round(self.wait_seconds / granted * 1000, 2) if granted else None,
+                "risk_events": self.risk_events,
+                "backoffs": self.backoffs,
+            }
+
+
+GOVERNOR = _RateGovernor(
+    UPSTREAM_RATE / UPSTREAM_WORKERS, UPSTREAM_MIN_RATE / UPSTREAM_WORKERS, UPSTREAM_BURST / UPSTREAM_WORKERS
+)
+
+
+@app.exception_handler(_UpstreamThrottled)
+async def _upstream_throttled_handler(request: Request, exc: _UpstreamThrottled) -> JSONResponse:
+    return JSONResponse(
+        status_code=503, content={"detail": exc.detail}, headers={"Retry-After": str(exc.retry_after)}
+    )
 
 
-def _atomic_write_bytes(path: str, data: bytes) -> None:
-    tmp_dir = os.path.dirname(os.path.abspath(path)) or "."
-    with tempfile.NamedTemporaryFile(mode="wb", delete=False, dir=tmp_dir) as f:
-        f.write(data)
-        f.flush()
-        os.fsync(f.fileno())
-        tmp_path = f.name
-    os.replace(tmp_path, path)
+# {"code":-412,... at the start of a JSON body; Bilibili puts code first
+_RISK_CODE_RE = re.compile(rb'^\s*\{\s*"code"\s*:\s*(-?\d+)')
+
+_DNS_CACHE = _LRUCache(maxsize=1024, ttl=DNS_CACHE_TTL)
+
+
+class _CachedDNSConnection:
+    """urllib3 连接混入：新建连接时经 _DNS_CACHE 解析主机名，依次尝试各地址。只作用于 HTTP 连接池。"""
+
+    def _new_conn(self):  # type: ignore[no-untyped-def]
+        host = self._dns_host
+        if DNS_CACHE_TTL <= 0:
+            return super()._new_conn()
+        key = (host, self.port, urllib3.util.connection.allowed_gai_family())
+        addrs = _DNS_CACHE.get(key)
+        if addrs is None:
+            try:
+                infos = socket.getaddrinfo(host, self.port, key[2], socket.SOCK_STREAM)
+            except socket.gaierror as e:
+                raise urllib3.exceptions.NameResolutionError(host, self, e) from e
+            addrs = [info[4][0] for info in infos]
+            _DNS_CACHE.set(key, addrs)
+        error: Optional[Exception] = None
+        try:
+            for addr in addrs:
+                # TLS SNI and certificate checks keep using self.host
+                self._dns_host = addr
+                try:
+                    return super()._new_conn()
+                except urllib3.exceptions.ConnectTimeoutError as e:
+                    # Includes NewConnectionError: try the next address, like create_connection
+                    error = e
+        finally:
+            self._dns_host = host
+        _DNS_CACHE.pop(key)
+        raise error or urllib3.exceptions.NewConnectionError(self, f"no address for {host}")
+
+
+class _BoundedWaitPool:
+    """连接池混入：pool_block 时等待空闲连接最多 HTTP_POOL_WAIT 秒。"""
+
+    def _get_conn(self, timeout=None):  # type: ignore[no-untyped-def]
+        return super()._get_conn(HTTP_POOL_WAIT if timeout is None else timeout)
+
+
+class _HTTPConnection(_CachedDNSConnection, urllib3.connection.HTTPConnection):
+    pass
+
 
+class _HTTPSConnection(_CachedDNSConnection, urllib3.connection.HTTPSConnection):
+    pass
 
-def _atomic_write_text(path: str, text: str) -> None:
-    _atomic_write_bytes(path, text.encode("utf-8"))
+
+class _HTTPConnectionPool(_BoundedWaitPool, urllib3.connectionpool.HTTPConnectionPool):
+    ConnectionCls = _HTTPConnection
+
+
+class _HTTPSConnectionPool(_BoundedWaitPool, urllib3.connectionpool.HTTPSConnectionPool):
+    ConnectionCls = _HTTPSConnection
+
+
+class _PoolAdapter(HTTPAdapter):
+    """共享 HTTP 会话的 adapter：连接池带 DNS 缓存与有界等待；池等待超时转为 requests.ConnectionError。"""
+
+    def init_poolmanager(self, *args, **kwargs):  # type: ignore[no-untyped-def]
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {"http": _HTTPConnectionPool, "https": _HTTPSConnectionPool}
+
+    def send(self, request, *args, **kwargs):  # type: ignore[override]
+        try:
+            return super().send(request, *args, **kwargs)
+        except urllib3.exceptions.EmptyPoolError as e:
+            raise requests.ConnectionError(e, request=request)
+
+
+class _GovernedAdapter(_PoolAdapter):
+    """挂在 api.bilibili.com 上的 HTTPAdapter：发送前向 GOVERNOR 取令牌，收到响应后回报是否触发风控。"""
+
+    def send(self, request, stream=False, **kwargs):  # type: ignore[override]
+        GOVERNOR.acquire(_UPSTREAM_PRIORITY.get())
+        resp = super().send(request, stream=stream, **kwargs)
+        risk = resp.status_code == 412
+        if not risk and not stream:
+            m = _RISK_CODE_RE.match(resp.content[:64])
+            risk = bool(m) and int(m.group(1)) in UPSTREAM_RISK_CODES
+        GOVERNOR.observe(risk)
+        return resp
+
+
+def _make_http_session() -> requests.Session:
+    sess = requests.Session()
+    # pool_block: at most HTTP_POOL_PER_HOST connections per host, extra callers wait
+    # (up to HTTP_POOL_WAIT) for a free one
+    adapter = _PoolAdapter(pool_connections=HTTP_POOL_HOSTS, pool_maxsize=HTTP_POOL_PER_HOST, pool_block=True)
+    sess.mount("https://", adapter)
+    sess.mount("http://", adapter)
+    # Longest prefix wins: API calls (all under /x/, and only those) go through the rate governor
+    governed = _GovernedAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_PER_HOST, pool_block=True)
+    sess.mount(biliurl.API_BASE + "/x/", governed)
+    # The session is shared by all users: never persist Set-Cookie into it,
+    # cookies are always passed per request.
+    sess.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+    return sess
+
+
+HTTP = _make_http_session()
+
+_ASYNC_HTTP: Optional[httpx.AsyncClient] = None
+
+
+def _async_http() -> httpx.AsyncClient:
+    global _ASYNC_HTTP
+    if _ASYNC_HTTP is None:
+        http2 = HTTP2
+        if http2:
+            try:
+                import h2  # noqa: F401
+            except ImportError:
+                http2 = False
+        client = httpx.AsyncClient(
+            http2=http2,
+            limits=httpx.Limits(
+                max_connections=ASYNC_HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=ASYNC_HTTP_MAX_KEEPALIVE,
+            ),
+            # A read making no progress this long is treated as a stalled mirror
+            timeout=httpx.Timeout(30.0, connect=10.0, read=CDN_STALL_TIMEOUT),
+            follow_redirects=True,
+        )
+        # Same rule as the sync pool: the shared client never stores upstream cookies
+        client.cookies.jar.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+        _ASYNC_HTTP = client
+    return _ASYNC_HTTP
+
+def _http_pool_stats() -> Dict[str, Any]:
+    hosts: Dict[str, Dict[str, Any]] = {}
+    for adapter in {id(a): a for a in HTTP.adapters.values()}.values():
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            idle = [c for c in list(pool.pool.queue) if c is not None] if pool.pool else []
+            hosts[f"{pool.scheme}://{pool.host}:{pool.port}"] = {
+                "requests": pool.num_requests,
+                "new_connections": pool.num_connections,
+                "idle_open": sum(1 for c in idle if getattr(c, "sock", None) is not None),
+            }
+    total_requests = sum(h["requests"] for h in hosts.values())
+    total_new = sum(h["new_connections"] for h in hosts.values())
+    return {
+        "hosts": hosts,
+        "requests": total_requests,
+        "new_connections": total_new,
+        "reuse_ratio": round(1 - total_new / total_requests, 4) if total_requests else None,
+        "open_connections": sum(h["idle_open"] for h in hosts.values()),
+        "dns_cache": _DNS_CACHE.stats(),
+    }
+
+
+class _MergeCache:
+    """合并后 MP4 的磁盘缓存：文件名为内容 key，SQLite 记录大小与最近访问时间，超出总预算按 LRU 淘汰。"""
+
+    def __init__(self, root: str, max_bytes: int) -> None:
+        self.root = root
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+    def path_for(self, key: str) -> str:
+        return os.path.join(self.root, f"{key}.mp4")
+
+    def lookup(self, key: str) -> Optional[str]:
+        path = self.path_for(key)
+        row = _db_fetchone("SELECT size FROM merge_cache WHERE cache_key = ?", (key,))
+        if row and os.path.exists(path):
+            _db_execute("UPDATE merge_cache SET last_access = ? WHERE cache_key = ?", (_now(), key))
+            self.hits += 1
+            return path
+        if row:
+            _db_execute("DELETE FROM merge_cache WHERE cache_key = ?", (key,))
+        self.misses += 1
+        return None
+
+    def work_dir(self) -> str:
+        os.makedirs(self.root, exist_ok=True)
+        return tempfile.mkdtemp(prefix="tmp_", dir=self.root)
+
+    def store(self, key: str, src_path: str) -> str:
+        path = self.path_for(key)
+        size = os.path.getsize(src_path)
+        os.replace(src_path, path)
+        _db_execute(
+            "INSERT OR REPLACE INTO merge_cache(cache_key, size, last_access) VALUES (?, ?, ?)",
+            (key, size, _now()),
+        )
+        self.evict()
+        return path
+
+    def evict(self) -> None:
+        with self._lock:
+            row = _db_fetchone("SELECT COALESCE(SUM(size), 0) FROM merge_cache")
+            total = int(row[0]) if row else 0
+            if total <= self.max_bytes:
+                return
+            rows = _db_fetchall(
+                "SELECT cache_key, size FROM merge_cache WHERE last_access < ? ORDER BY last_access",
+                (_now() - MERGE_CACHE_MIN_AGE,),
+            )
+            for key, size in rows:
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(self.path_for(key))
+                except FileNotFoundError:
+                    pass
+                _db_execute("DELETE FROM merge_cache WHERE cache_key = ?", (key,))
+                total -= int(size)
+                self.evictions += 1
+
+    def reconcile(self) -> None:
+        # Drop leftovers of interrupted merges and files the index doesn't know about
+        if not os.path.isdir(self.root):
+            return
+        known = {r[0] for r in _db_fetchall("SELECT cache_key FROM merge_cache")}
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if name.startswith("tmp_") and os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            elif name.endswith(".mp4") and name[: -len(".mp4")] not in known:
+                os.remove(path)
+        for key in known:
+            if not os.path.exists(self.path_for(key)):
+                _db_execute("DELETE FROM merge_cache WHERE cache_key = ?", (key,))
+        self.evict()
+
+    def stats(self) -> Dict[str, Any]:
+        row = _db_fetchone("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM merge_cache")
+        total = self.hits + self.misses
+        return {
+            "entries": int(row[0]) if row else 0,
+            "bytes": int(row[1]) if row else 0,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / total, 4) if total else None,
+            "evictions": self.evictions,
+        }
+
+
+MERGE_CACHE = _MergeCache(MERGE_CACHE_DIR, MERGE_CACHE_MAX_BYTES)
+_MERGE_FLIGHT = _SingleFlight()
 
 
 def _load_or_create_key() -> bytes:
@@ -139,17 +1475,62 @@ def _load_or_create_key() -> bytes:
         return key
 
     key = Fernet.generate_key()
-    _atomic_write_bytes(SESSIONS_KEY_FILE, key + b"\n")
+    tmp_dir = os.path.dirname(os.path.abspath(SESSIONS_KEY_FILE)) or "."
+    with tempfile.NamedTemporaryFile(mode="wb", delete=False, dir=tmp_dir) as f:
+        f.write(key + b"\n")
+        f.flush()
+        os.fsync(f.fileno())
+        tmp_path = f.name
+    try:
+        # link() fails if another worker created the key first; everyone then uses that one
+        os.link(tmp_path, SESSIONS_KEY_FILE)
+    except FileExistsError:
+        os.remove(tmp_path)
+        return _load_or_create_key()
+    except OSError:
+        # No hard links on this filesystem: plain atomic replace (last writer wins)
+        os.replace(tmp_path, SESSIONS_KEY_FILE)
+        return key
+    os.remove(tmp_path)
     return key
 
 
+def _key_mtime() -> Optional[int]:
+    try:
+        return os.stat(SESSIONS_KEY_FILE).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def _key_material() -> Tuple[bytes, Fernet]:
+    """返回缓存的 (key, Fernet)；仅当 sessions.key 的 mtime 变化时才重新读盘。"""
+    mono = time.monotonic()
+    with STORE_LOCK:
+        if _KEY_STATE["key"] is not None and mono - _KEY_STATE["checked_at"] < KEY_RECHECK_INTERVAL:
+            return _KEY_STATE["key"], _KEY_STATE["fernet"]
+
+        mtime = _key_mtime()
+        if _KEY_STATE["key"] is None or mtime is None or mtime != _KEY_STATE["mtime"]:
+            key = _load_or_create_key()
+            if _KEY_STATE["key"] is not None and key != _KEY_STATE["key"]:
+                # Key rotated: user_key hashes and ciphertexts no longer match
+                USER_SESSIONS.clear()
+                USER_SESSIONS_MISSING.clear()
+            _KEY_STATE["key"] = key
+            _KEY_STATE["fernet"] = Fernet(key)
+            _KEY_STATE["mtime"] = _key_mtime()
+            _KEY_STATE["loads"] += 1
+        _KEY_STATE["checked_at"] = mono
+        return _KEY_STATE["key"], _KEY_STATE["fernet"]
+
+
 def _fernet() -> Fernet:
-    return Fernet(_load_or_create_key())
+    return _key_material()[1]
 
 
 def _user_key(user_id: str) -> str:
     # Deterministic keyed hash so DB doesn't store plaintext user_id
-    secret = _load_or_create_key()
+    secret = _key_material()[0]
     return hmac.new(secret, user_id.encode("utf-8"), hashlib.sha256).hexdigest()
 
 
@@ -163,50 +1544,270 @@ def _decrypt_json(blob: bytes) -> Dict[str, Any]:
     return json.loads(raw.decode("utf-8"))
 
 
-def _cookie_path(user_id: str) -> str:
-    # 按需求：文件名就是 user_id（无扩展名）
-    return os.path.join(COOKIES_DIR, user_id)
+def _legacy_cookie_file(path: str) -> Optional[Dict[str, str]]:
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return data if isinstance(data, dict) else None
 
 
-def _save_cookies_to_disk(user_id: str, cookie_dict: Dict[str, str]) -> None:
-    _ensure_dirs()
-    _atomic_write_text(_cookie_path(user_id), json.dumps(cookie_dict, ensure_ascii=False, indent=2))
+def _migrate_sessions() -> None:
+    """一次性迁移：把 cookies/<user_id> 文件并入加密的 sessions 行，并补齐旧行的 created_at。"""
+    stats = SESSION_STORE_STATS
+    legacy: List[Tuple[str, str]] = []
+    try:
+        with os.scandir(COOKIES_DIR) as entries:
+            legacy = [(e.name, e.path) for e in entries if e.is_file()]
+    except FileNotFoundError:
+        pass
 
+    kept = 0
+    for user_id, path in legacy:
+        user_key = _user_key(user_id)
+        cookie_dict = _legacy_cookie_file(path)
+        with _db_transaction() as conn:
+            row = conn.execute("SELECT payload FROM sessions WHERE user_key = ?", (user_key,)).fetchone()
+            try:
+                payload = _decrypt_json(row[0]) if row else None
+            except InvalidToken:
+                # Likely a rotated/misplaced sessions.key: the file may be the only good copy
+                payload = None
+            if row and payload is None:
+                stats["undecryptable"] += 1
+                kept += 1
+                continue
+            if isinstance(payload, dict) and cookie_dict and not payload.get("cookies"):
+                payload["cookies"] = cookie_dict
+                conn.execute(
+                    "UPDATE sessions SET payload = ?, created_at = ? WHERE user_key = ?",
+                    (_encrypt_json(payload), float(payload.get("created_at") or _now()), user_key),
+                )
+                stats["migrated"] += 1
+            else:
+                # No usable session to attach the file to (or already migrated)
+                stats["orphaned"] += 1
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+    if kept:
+        LOG.warning(
+            "session migration: %d row(s) do not decrypt with the current key; left them and their %s files in place",
+            kept,
+            COOKIES_DIR,
+        )
+    elif legacy:
+        try:
+            os.rmdir(COOKIES_DIR)
+        except OSError:
+            pass
 
-def _load_cookies_from_disk(user_id: str) -> Optional[Dict[str, str]]:
-    path = _cookie_path(user_id)
-    if not os.path.exists(path):
+    # Rows written before created_at was a column still have the default 0
+    unstamped = 0
+    for user_key, blob in _db_fetchall("SELECT user_key, payload FROM sessions WHERE created_at = 0"):
+        try:
+            created_at = float(_decrypt_json(blob).get("created_at") or _now())
+        except (InvalidToken, ValueError, AttributeError):
+            # Undecryptable under the current key: keep created_at = 0, which the reaper skips
+            unstamped += 1
+            continue
+        _db_execute("UPDATE sessions SET created_at = ? WHERE user_key = ?", (created_at, user_key))
+        stats["stamped"] += 1
+    if unstamped:
+        LOG.warning("session migration: %d legacy row(s) do not decrypt with the current key; left unstamped", unstamped)
+
+
+def _reap_sessions(max_age: float = SESSION_MAX_AGE) -> int:
+    """批量删除过期会话，空闲页过多时 VACUUM；返回删除的行数。"""
+    # created_at = 0: legacy rows _migrate_sessions could not decrypt, kept for recovery
+    deleted = _db_execute("DELETE FROM sessions WHERE created_at > 0 AND created_at < ?", (_now() - max_age,)).rowcount
+    # Cached copies are rejected by age in _validate_user, so the LRU needn't be purged
+    SESSION_STORE_STATS["reaped"] += deleted
+    page_count = (_db_fetchone("PRAGMA page_count") or (0,))[0]
+    free_pages = (_db_fetchone("PRAGMA freelist_count") or (0,))[0]
+    if page_count and free_pages / page_count >= DB_VACUUM_FREE_RATIO:
+        _db_execute("VACUUM")
+        SESSION_STORE_STATS["vacuums"] += 1
+    return deleted
+
+
+def _correspond_path(timestamp_ms: int) -> str:
+    key = serialization.load_pem_public_key(BILI_CORRESPOND_KEY)
+    oaep = padding.OAEP(mgf=padding.MGF1(algorithm=hashes.SHA256()), algorithm=hashes.SHA256(), label=None)
+    return key.encrypt(f"refresh_{timestamp_ms}".encode("utf-8"), oaep).hex()
+
+
+def _nav_is_login(cookies: Dict[str, str]) -> bool:
+    with UPSTREAM_SECONDS.time("nav"):
+        resp = HTTP.get(f"{biliurl.API_BASE}/x/web-interface/nav", headers=BILI_HEADERS, cookies=cookies, timeout=15)
+    j = resp.json()
+    return j.get("code") == 0 and bool((j.get("data") or {}).get("isLogin"))
+
+
+def _refresh_cookies(cookies: Dict[str, str], refresh_token: str) -> Optional[Tuple[Dict[str, str], str]]:
+    """按 B 站 Web 端 cookie 刷新流程换新 cookies；无需或无法刷新时返回 None。
+
+    cookie/info 判断是否需要刷新 -> correspond 页拿 refresh_csrf -> cookie/refresh 换新 cookies
+    与 refresh_token -> confirm/refresh 让旧 refresh_token 失效。
+    """
+    csrf = cookies.get("bili_jct")
+    if not csrf or not refresh_token:
         return None
-    try:
-        with open(path, "r", encoding="utf-8") as f:
-            data = json.load(f)
-        return data if isinstance(data, dict) else None
-    except Exception:
+    with UPSTREAM_SECONDS.time("cookie_info"):
+        info = HTTP.get(
+            f"{PASSPORT_BASE}/x/passport-login/web/cookie/info",
+            params={"csrf": csrf},
+            headers=BILI_HEADERS,
+            cookies=cookies,
+            timeout=15,
+        ).json()
+    # -101: SESSDATA already dead; Bilibili only refreshes cookies that still authenticate
+    if info.get("code") != 0 or not (info.get("data") or {}).get("refresh"):
         return None
 
+    path = _correspond_path(int(time.time() * 1000))
+    with UPSTREAM_SECONDS.time("correspond"):
+        html = HTTP.get(f"{WWW_BASE}/correspond/1/{path}", headers=BILI_HEADERS, cookies=cookies, timeout=15).text
+    m = re.search(r'<div id="1-name">([^<]+)</div>', html)
+    if not m:
+        return None
 
-def _cleanup_login_flows(ttl_seconds: int = 600) -> None:
-    # Fresh deploy may not have DB/tables yet
+    with UPSTREAM_SECONDS.time("cookie_refresh"):
+        resp = HTTP.post(
+            f"{PASSPORT_BASE}/x/passport-login/web/cookie/refresh",
+            data={"csrf": csrf, "refresh_csrf": m.group(1).strip(), "source": "main_web", "refresh_token": refresh_token},
+            headers=BILI_HEADERS,
+            cookies=cookies,
+            timeout=15,
+        )
+    j = resp.json()
+    new_token = (j.get("data") or {}).get("refresh_token")
+    if j.get("code") != 0 or not new_token:
+        return None
+    new_cookies = dict(cookies)
+    new_cookies.update(resp.cookies.get_dict())
+
+    # The new cookies already work; confirming only retires the old refresh_token
     try:
-        _db_init()
-    except Exception:
-        # If DB init fails, don't crash request paths that call cleanup
-        return
+        with UPSTREAM_SECONDS.time("cookie_confirm"):
+            HTTP.post(
+                f"{PASSPORT_BASE}/x/passport-login/web/confirm/refresh",
+                data={"csrf": new_cookies.get("bili_jct", csrf), "refresh_token": refresh_token},
+                headers=BILI_HEADERS,
+                cookies=new_cookies,
+                timeout=15,
+            )
+    except requests.RequestException:
+        pass
+    return new_cookies, str(new_token)
 
-    cutoff = _now() - ttl_seconds
 
-    conn = _db_connect()
-    try:
+def _store_session_payload(
+    user_key: str, payload: Dict[str, Any], checked_at: float, expect: bytes, created_at: float
+) -> bool:
+    """仅当行内 payload 仍是 expect（读取时的密文）时写入；期间被他人改写则放弃并返回 False。"""
+    enc = _encrypt_json(payload)
+    cur = _db_execute(
+        "UPDATE sessions SET payload = ?, checked_at = ? WHERE user_key = ? AND payload = ?",
+        (enc, checked_at, user_key, expect),
+    )
+    if cur.rowcount == 0:
+        return False
+    if SHARED.stores_sessions:
+        # Same lifetime as the row: the reaper drops it SESSION_MAX_AGE after login
+        SHARED.set("session", user_key, enc.decode("ascii"), created_at + SESSION_MAX_AGE - _now())
+    # Every worker (this one included) reloads the row on next use
+    USER_SESSIONS.pop_where(lambda sess: sess.user_key == user_key)
+    SHARED.publish("session", user_key)
+    return True
+
+
+def _check_session_health(limit: int = SESSION_HEALTH_BATCH) -> None:
+    """后台检查到期会话的 cookies：必要时刷新，失效则标记 degraded（请求直接走游客档）。"""
+    now = _now()
+    due = _db_fetchall(
+        "SELECT user_key, payload, created_at, checked_at FROM sessions WHERE checked_at < ? AND created_at >= ?"
+        " ORDER BY checked_at LIMIT ?",
+        (now - SESSION_HEALTH_INTERVAL, now - SESSION_MAX_AGE, limit),
+    )
+    stats = SESSION_HEALTH_STATS
+    for user_key, blob, created_at, checked_at in due:
+        if SHARED.stores_sessions and SHARED.get("session", user_key) is None:
+            # Logged out (or expired) in the shared store while this host missed the event
+            _db_execute("DELETE FROM sessions WHERE user_key = ?", (user_key,))
+            continue
+        # Claim the row: with several workers only one of them checks (and refreshes) it
+        claimed_at = _now()
+        cur = _db_execute(
+            "UPDATE sessions SET checked_at = ? WHERE user_key = ? AND checked_at = ?",
+            (claimed_at, user_key, checked_at),
+        )
+        if cur.rowcount == 0:
+            continue
         try:
-            conn.execute("DELETE FROM login_flows WHERE created_at < ?", (cutoff,))
-        except sqlite3.OperationalError as e:
-            # Tables might not exist yet if DB was deleted between requests
-            if "no such table" in str(e).lower():
-                _db_init()
-            else:
-                raise
-    finally:
-        conn.close()
+            payload = _decrypt_json(blob)
+            cookies = payload.get("cookies") or {}
+            refreshed = _refresh_cookies(cookies, str(payload.get("refresh_token") or ""))
+            if refreshed:
+                cookies, payload["refresh_token"] = refreshed
+                payload["cookies"] = cookies
+                stats["refreshed"] += 1
+            alive = _nav_is_login(cookies)
+        except InvalidToken:
+            # Written under another key; nothing to check (the claim stamped checked_at)
+            continue
+        except (requests.RequestException, ValueError, KeyError):
+            # Upstream trouble says nothing about the cookies: hand the row back for a later tick
+            stats["errors"] += 1
+            _db_execute(
+                "UPDATE sessions SET checked_at = ? WHERE user_key = ? AND checked_at = ?",
+                (checked_at, user_key, claimed_at),
+            )
+            continue
+        except _UpstreamThrottled:
+            # Background calls queue last: the rest of the batch would be throttled too
+            stats["throttled"] += 1
+            _db_execute(
+                "UPDATE sessions SET checked_at = ? WHERE user_key = ? AND checked_at = ?",
+                (checked_at, user_key, claimed_at),
+            )
+            break
+
+        stats["checked"] += 1
+        stats["ok" if alive else "degraded"] += 1
+        if refreshed or payload.get("degraded", False) != (not alive):
+            payload["degraded"] = not alive
+            if not _store_session_payload(user_key, payload, _now(), expect=blob, created_at=created_at):
+                # Row rewritten meanwhile (e.g. a slower checker elsewhere): keep theirs
+                stats["conflicts"] += 1
+
+
+def _cleanup_login_flows(ttl_seconds: int = LOGIN_FLOW_TTL) -> None:
+    cutoff = _now() - ttl_seconds
+    _db_execute("DELETE FROM login_flows WHERE created_at < ?", (cutoff,))
+
+
+def _start_periodic(name: str, interval: float, fn: Callable[[], None]) -> None:
+    """启动后台维护线程，每隔 interval 秒执行一次 fn，直到应用关闭。"""
+    if name in _BACKGROUND_THREADS and _BACKGROUND_THREADS[name].is_alive():
+        return
+    _BACKGROUND_STOP.clear()
+
+    def _loop() -> None:
+        # Maintenance calls to api.bilibili.com queue behind request traffic
+        _UPSTREAM_PRIORITY.set("background")
+        while not _BACKGROUND_STOP.wait(interval):
+            try:
+                fn()
+            except Exception:
+                # Maintenance must never kill the loop; next tick retries
+                pass
+
+    t = threading.Thread(target=_loop, name=f"biliurl-{name}", daemon=True)
+    _BACKGROUND_THREADS[name] = t
+    t.start()
 
 
 def _make_qr_png_bytes(text: str) -> bytes:
@@ -220,8 +1821,9 @@ def _make_qr_png_bytes(text: str) -> bytes:
 
 
 def _bili_qr_generate(sess: requests.Session) -> Tuple[str, str]:
-    url = "https://passport.bilibili.com/x/passport-login/web/qrcode/generate"
-    resp = sess.get(url, headers=BILI_HEADERS, timeout=15)
+    url = f"{PASSPORT_BASE}/x/passport-login/web/qrcode/generate"
+    with UPSTREAM_SECONDS.time("qr_generate"):
+        resp = sess.get(url, headers=BILI_HEADERS, timeout=15)
     data = resp.json()
     if data.get("code") != 0 or not data.get("data"):
         raise RuntimeError(f"QR generate failed: {data}")
@@ -231,15 +1833,17 @@ def _bili_qr_generate(sess: requests.Session) -> Tuple[str, str]:
 
 
 def _bili_qr_poll(sess: requests.Session, qrcode_key: str) -> Dict[str, Any]:
-    url = "https://passport.bilibili.com/x/passport-login/web/qrcode/poll"
-    resp = sess.get(url, params={"qrcode_key": qrcode_key}, headers=BILI_HEADERS, timeout=15)
+    url = f"{PASSPORT_BASE}/x/passport-login/web/qrcode/poll"
+    with UPSTREAM_SECONDS.time("qr_poll"):
+        resp = sess.get(url, params={"qrcode_key": qrcode_key}, headers=BILI_HEADERS, timeout=15)
     return resp.json()
 
 
 def _bili_qr_poll_stateless(qrcode_key: str) -> Tuple[Dict[str, Any], Dict[str, str]]:
     """多进程友好的轮询：不依赖 generate 阶段的 Session；成功时从响应里拿到 Set-Cookie。"""
-    url = "https://passport.bilibili.com/x/passport-login/web/qrcode/poll"
-    resp = requests.get(url, params={"qrcode_key": qrcode_key}, headers=BILI_HEADERS, timeout=15)
+    url = f"{PASSPORT_BASE}/x/passport-login/web/qrcode/poll"
+    with UPSTREAM_SECONDS.time("qr_poll"):
+        resp = HTTP.get(url, params={"qrcode_key": qrcode_key}, headers=BILI_HEADERS, timeout=15)
     data = resp.json()
     cookie_dict = {k: v for k, v in resp.cookies.get_dict().items()}
     return data, cookie_dict
@@ -260,54 +1864,160 @@ def _get_auth_from_request(
     return user_id, token
 
 
-def _validate_user(user_id: Optional[str], token: Optional[str]) -> Optional[UserSession]:
-    if not user_id or not token:
+def _load_session(user_id: str) -> Optional[UserSession]:
+    user_key = _user_key(user_id)
+    blob: Optional[bytes] = None
+    if SHARED.stores_sessions:
+        # The shared store is authoritative: this host's row may outlive a logout elsewhere
+        hit = SHARED.get("session", user_key)
+        blob = hit[0].encode("ascii") if hit else None
+    else:
+        row = _db_fetchone(
+            "SELECT payload FROM sessions WHERE user_key = ? AND created_at >= ?",
+            (user_key, _now() - SESSION_MAX_AGE),
+        )
+        blob = row[0] if row else None
+    if not blob:
+        return None
+    try:
+        payload = _decrypt_json(blob)
+    except InvalidToken:
+        return None
+    if not isinstance(payload, dict) or not payload.get("token"):
         return None
 
-    with STORE_LOCK:
-        sess = USER_SESSIONS.get(user_id)
+    cookie_dict = payload.get("cookies")
+    if not cookie_dict or not isinstance(cookie_dict, dict):
+        return None
+    return UserSession(
+        created_at=float(payload.get("created_at") or _now()),
+        token=str(payload["token"]),
+        cookie_dict=cookie_dict,
+        user_key=user_key,
+        degraded=bool(payload.get("degraded")),
+    )
 
-    # 允许并发/重启后继续使用：内存没有就从磁盘恢复
-    if not sess:
-        user_key = _user_key(user_id)
-        conn = _db_connect()
-        try:
-            try:
-                row = conn.execute("SELECT payload FROM sessions WHERE user_key = ?", (user_key,)).fetchone()
-            except sqlite3.OperationalError as e:
-                if "no such table" in str(e).lower():
-                    _db_init()
-                    row = None
-                else:
-                    raise
-        finally:
-            conn.close()
 
-        if row and row[0]:
-            try:
-                payload = _decrypt_json(row[0])
-            except InvalidToken:
-                payload = None
+def _validate_user(user_id: Optional[str], token: Optional[str]) -> Optional[UserSession]:
+    if not user_id or not token:
+        return None
 
-            if isinstance(payload, dict) and payload.get("token"):
-                cookie_dict = _load_cookies_from_disk(user_id)
-                if cookie_dict:
-                    sess = UserSession(
-                        created_at=float(payload.get("created_at") or _now()),
-                        token=str(payload["token"]),
-                        cookie_dict=cookie_dict,
-                    )
-                    with STORE_LOCK:
-                        USER_SESSIONS[user_id] = sess
+    sess = USER_SESSIONS.get(user_id)
 
+    # 允许并发/重启后继续使用：内存没有就从磁盘恢复（未知 user_id 短时间负缓存）
     if not sess:
+        if USER_SESSIONS_MISSING.get(user_id):
+            return None
+        with _stage("session_load"):
+            sess = _load_session(user_id)
+        if sess:
+            USER_SESSIONS.set(user_id, sess)
+        else:
+            USER_SESSIONS_MISSING.set(user_id, True)
+            return None
+
+    if sess.created_at < _now() - SESSION_MAX_AGE:
+        USER_SESSIONS.pop(user_id)
         return None
     if secrets.compare_digest(sess.token, token):
         return sess
     return None
 
 
+def _get_pages(bvid: str, cookies: Optional[Dict[str, str]]) -> List[Dict[str, Any]]:
+    with _stage("pagelist"):
+        pages = PAGELIST_CACHE.get(bvid)
+        if pages:
+            return pages
+
+        def _fetch() -> List[Dict[str, Any]]:
+            try:
+                with UPSTREAM_SECONDS.time("pagelist"):
+                    fetched = getPagelist(bvid, session=HTTP, cookies=cookies, use_cache=False)
+            except (RuntimeError, ValueError, requests.RequestException) as e:
+                raise HTTPException(status_code=502, detail={"error": "bilibili_pagelist_failed", "message": str(e)})
+            PAGELIST_CACHE.put(bvid, fetched)
+            return fetched
+
+        # Concurrent misses for the same bvid share one upstream call
+        return _PAGELIST_FLIGHT.do(bvid, _fetch)
+
+
+def _page_entry(pages: List[Dict[str, Any]], p: int) -> Dict[str, Any]:
+    for page in pages:
+        if page.get("page") == p:
+            return page
+    if 1 <= p <= len(pages):
+        return pages[p - 1]
+    raise HTTPException(status_code=404, detail={"error": "page_not_found", "p": p, "pages": len(pages)})
+
+
+def _get_cid(bvid: str, cookies: Optional[Dict[str, str]], p: int = 1) -> str:
+    return str(_page_entry(_get_pages(bvid, cookies), p)["cid"])
+
+
+def _page_suffix(p: int) -> str:
+    # Single-part downloads keep their old file names
+    return f"-p{p}" if p > 1 else ""
+
+
+def _auth_tier(cookies: Optional[Dict[str, str]]) -> str:
+    """playurl 缓存的鉴权维度：游客共享一份；登录用户按 B 站账号（DedeUserID）共享。"""
+    if not cookies:
+        return "guest"
+    mid = cookies.get("DedeUserID")
+    if mid:
+        return f"mid:{mid}"
+    # No account id in the cookie jar: fall back to a per-cookie-set key
+    digest = hashlib.sha256(json.dumps(cookies, sort_keys=True).encode("utf-8")).hexdigest()
+    return f"cookies:{digest[:16]}"
+
+
+def _playurl_ttl(j: Dict[str, Any]) -> float:
+    """根据 baseUrl/backupUrl 中最早的 deadline= 计算缓存时长（秒）。"""
+    dash = (j.get("data") or {}).get("dash") or {}
+    deadlines: List[float] = []
+    for track in (dash.get("video") or []) + (dash.get("audio") or []):
+        for url in [track.get("baseUrl")] + list(track.get("backupUrl") or []):
+            if not url:
+                continue
+            values = parse_qs(urlsplit(url).query).get("deadline")
+            if values and values[0].isdigit():
+                deadlines.append(float(values[0]))
+    if not deadlines:
+        return PLAYURL_DEFAULT_TTL
+    return min(deadlines) - PLAYURL_EXPIRY_MARGIN - _now()
+
+
 def _playurl_json(bvid: str, cid: str, qn: int, cookies: Optional[Dict[str, str]]) -> Dict[str, Any]:
+    with _stage("playurl"):
+        key = f"{bvid}:{cid}:{int(qn)}:{_auth_tier(cookies)}"
+        cached = PLAYURL_CACHE.get(key)
+        if cached is not None:
+            return cached
+
+        def _fetch() -> Dict[str, Any]:
+            # Another worker may already have resolved it
+            hit = SHARED.get("playurl", key)
+            if hit is not None:
+                try:
+                    j = json.loads(hit[0])
+                except ValueError:
+                    j = None
+                if isinstance(j, dict):
+                    PLAYURL_CACHE.set(key, j, ttl=hit[1])
+                    return j
+            j = _playurl_fetch(bvid=bvid, cid=cid, qn=qn, cookies=cookies)
+            ttl = _playurl_ttl(j)
+            if ttl > 0:
+                PLAYURL_CACHE.set(key, j, ttl=ttl)
+                SHARED.set("playurl", key, json.dumps(j, ensure_ascii=False, separators=(",", ":")), ttl)
+            return j
+
+        return _PLAYURL_FLIGHT.do(key, _fetch)
+
+
+def _playurl_fetch(bvid: str, cid: str, qn: int, cookies: Optional[Dict[str, str]]) -> Dict[str, Any]:
     base_params = {
         "from_client": "BROWSER",
         "cid": cid,
@@ -318,19 +2028,29 @@ def _playurl_json(bvid: str, cid: str, qn: int, cookies: Optional[Dict[str, str]
         "bvid": bvid,
     }
 
-    # Try wbi first, then fallback.
-    urls = [
-        "https://api.bilibili.com/x/player/wbi/playurl",
-        "https://api.bilibili.com/x/player/playurl",
-    ]
-
+    # Signed wbi endpoint and the legacy one; whichever last succeeded goes first
     last: Optional[Dict[str, Any]] = None
-    for url in urls:
-        r = requests.get(url, params=base_params, headers=BILI_HEADERS, cookies=cookies, timeout=15)
+    for variant in API_VARIANTS.order("playurl", list(PLAYURL_ENDPOINTS)):
+        params: Dict[str, Any] = base_params
+        if variant == "wbi":
+            try:
+                mixin_key = WBI_KEYS.get()
+            except _UpstreamThrottled:
+                # The nav call for the keys queued too long: fall back to the unsigned variant
+                continue
+            if not mixin_key:
+                continue
+            params = biliurl.signWbiParams(base_params, mixin_key)
+        with UPSTREAM_SECONDS.time(f"playurl_{variant}"):
+            r = HTTP.get(PLAYURL_ENDPOINTS[variant], params=params, headers=BILI_HEADERS, cookies=cookies, timeout=15)
         j = r.json()
         last = j
         if j.get("code") == 0 and j.get("data") and j["data"].get("dash"):
+            API_VARIANTS.succeeded("playurl", variant)
             return j
+        if variant == "wbi" and j.get("code") in WBI_REJECT_CODES:
+            # Keys may have rotated: the next request re-reads nav
+            WBI_KEYS.invalidate()
 
     raise HTTPException(status_code=502, detail={"error": "bilibili_playurl_failed", "raw": last})
 
@@ -357,6 +2077,8 @@ def _playurl_dash_with_fallback(
             try:
                 j2 = _playurl_json(bvid=bvid, cid=cid, qn=Q480, cookies=None)
                 dash2 = j2["data"]["dash"]
+                # Served as guest despite a session: tell the client, as for a degraded one
+                _flag_request("session_stale")
                 return j2, dash2, None, False, Q480
             except HTTPException:
                 raise e
@@ -371,46 +2093,741 @@ def _auth_cookies_and_qn(
 ) -> Tuple[Optional[Dict[str, str]], int, bool]:
     uid, tok = _get_auth_from_request(user_id, token, x_user_id, x_token)
     user_sess = _validate_user(uid, tok)
+    if user_sess and user_sess.degraded:
+        # Cookies known dead: go straight to the guest tier instead of a doomed authed attempt
+        _flag_request("session_stale")
+        user_sess = None
     cookies = user_sess.cookie_dict if user_sess else None
     qn = QMAX if user_sess else Q480
     return cookies, qn, bool(user_sess)
 
 
-def _stream_download(url: str, cookies: Optional[Dict[str, str]]):
+def _cookie_header(cookies: Optional[Dict[str, str]]) -> Optional[str]:
+    if not cookies:
+        return None
+    return "; ".join(f"{k}={v}" for k, v in cookies.items())
+
+
+def _track_urls(track: Dict[str, Any]) -> List[str]:
+    urls: List[str] = []
+    for url in [track.get("baseUrl")] + list(track.get("backupUrl") or []):
+        if url and url not in urls:
+            urls.append(url)
+    return urls
+
+
+def _cdn_region(host: str) -> str:
+    # upos-sz-mirrorcos.bilivideo.com -> "sz"; cn-gdfs-cm-01-07.bilivideo.com -> "gdfs"
+    parts = host.split(".")[0].split("-")
+    if len(parts) >= 2 and parts[0] in ("upos", "cn"):
+        return parts[1]
+    return host
+
+
+class _CdnSelector:
+    """CDN 镜像打分：按主机记录首字节延迟的 EWMA，随时间衰减回先验；未测过的主机参考同区域最好成绩。"""
+
+    ALPHA = 0.3
+    # Assumed latency (seconds) of a host with no recent measurements
+    PRIOR = 0.5
+    # Recorded as the latency of a failed or stalled request
+    FAILURE_PENALTY = 10.0
+
+    def __init__(self, half_life: float) -> None:
+        self.half_life = max(1.0, half_life)
+        self.races = 0
+        self.failovers = 0
+        self._hosts: Dict[str, Dict[str, float]] = {}
+        self._lock = threading.Lock()
+
+    def _decayed(self, entry: Dict[str, float], now: float) -> float:
+        weight = 0.5 ** ((now - entry["updated"]) / self.half_life)
+        return self.PRIOR + (entry["ewma"] - self.PRIOR) * weight
+
+    def score(self, host: str) -> float:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._hosts.get(host)
+            if entry is not None:
+                return self._decayed(entry, now)
+            region = _cdn_region(host)
+            peers = [self._decayed(e, now) for h, e in self._hosts.items() if _cdn_region(h) == region]
+        return min(peers) if peers else self.PRIOR
+
+    def _record(self, url: str, seconds: float, failed: bool) -> None:
+        host = urlsplit(url).hostname or url
+        now = time.monotonic()
+        with self._lock:
+            entry = self._hosts.get(host)
+            if entry is None:
+                self._hosts[host] = {"ewma": seconds, "updated": now, "samples": 1, "failures": int(failed)}
+                return
+            current = self._decayed(entry, now)
+            entry["ewma"] = current + self.ALPHA * (seconds - current)
+            entry["updated"] = now
+            entry["samples"] += 1
+            entry["failures"] += int(failed)
+
+    def observe(self, url: str, seconds: float) -> None:
+        CDN_FIRST_BYTE_SECONDS.observe(seconds)
+        self._record(url, seconds, failed=False)
+
+    def failure(self, url: str) -> None:
+        self._record(url, self.FAILURE_PENALTY, failed=True)
+
+    def rank(self, urls: List[str]) -> List[str]:
+        # Stable: with no data the playurl order (baseUrl first) is kept
+        return sorted(urls, key=lambda u: self.score(urlsplit(u).hostname or u))
+
+    def next_mirror(self, urls: List[str], tried: List[str]) -> Optional[str]:
+        for url in self.rank(urls):
+            if url not in tried:
+                return url
+        return None
+
+    def stats(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        with self._lock:
+            hosts = {
+                host: {
+                    "region": _cdn_region(host),
+                    "score_ms": round(self._decayed(e, now) * 1000, 1),
+                    "samples": int(e["samples"]),
+                    "failures": int(e["failures"]),
+                }
+                for host, e in self._hosts.items()
+            }
+        best: Dict[str, str] = {}
+        for host, info in sorted(hosts.items(), key=lambda kv: kv[1]["score_ms"]):
+            best.setdefault(info["region"], host)
+        return {"races": self.races, "failovers": self.failovers, "best_by_region": best, "hosts": hosts}
+
+
+CDN = _CdnSelector(CDN_SCORE_HALF_LIFE)
+_RACE_POOL = ThreadPoolExecutor(max_workers=32, thread_name_prefix="biliurl-race")
+
+
+def _close_when_done(fut: Future) -> None:
+    if not fut.cancelled() and fut.exception() is None:
+        fut.result().close()
+
+
+def _race_get(
+    urls: List[str], headers: Dict[str, str], cookies: Optional[Dict[str, str]]
+) -> Tuple[requests.Response, str]:
+    """同步竞速：同时请求排名靠前的镜像，返回最先给出成功响应头的 (response, url)，其余响应关闭。"""
+    candidates = CDN.rank(urls)[: max(1, CDN_RACE_WIDTH)]
+    started = time.monotonic()
+
+    def _get(url: str) -> requests.Response:
+        try:
+            r = HTTP.get(url, headers=headers, cookies=cookies, stream=True, timeout=(10, CDN_STALL_TIMEOUT))
+        except requests.RequestException:
+            CDN.failure(url)
+            raise
+        if r.status_code >= 400:
+            CDN.failure(url)
+        else:
+            # Losers keep reporting after the race is decided, so slow mirrors are scored too
+            CDN.observe(url, time.monotonic() - started)
+        return r
+
+    if len(candidates) == 1:
+        return _get(candidates[0]), candidates[0]
+
+    CDN.races += 1
+    pending = {_RACE_POOL.submit(_get, url): url for url in candidates}
+    fallback: Optional[Tuple[requests.Response, str]] = None
+    last_error: Optional[BaseException] = None
+    while pending:
+        done, _ = wait(list(pending), return_when=FIRST_COMPLETED)
+        for fut in done:
+            url = pending.pop(fut)
+            if fut.exception() is not None:
+                last_error = fut.exception()
+                continue
+            r = fut.result()
+            if r.status_code < 400:
+                for loser in pending:
+                    loser.add_done_callback(_close_when_done)
+                if fallback:
+                    fallback[0].close()
+                return r, url
+            if fallback:
+                fallback[0].close()
+            fallback = (r, url)
+    if fallback:
+        # Every mirror answered with an error status: let the caller report it
+        return fallback
+    assert last_error is not None
+    raise last_error
+
+
+async def _async_race(
+    method: str, urls: List[str], headers: Dict[str, str]
+) -> Tuple[httpx.Response, str]:
+    """异步竞速：同 _race_get，用于 /download/* 转发。"""
+    client = _async_http()
+    candidates = CDN.rank(urls)[: max(1, CDN_RACE_WIDTH)]
+    started = time.monotonic()
+
+    async def _send(url: str) -> httpx.Response:
+        try:
+            r = await client.send(client.build_request(method, url, headers=headers), stream=True)
+        except httpx.HTTPError:
+            CDN.failure(url)
+            raise
+        if r.status_code >= 400 and r.status_code not in (405, 416):
+            CDN.failure(url)
+        else:
+            CDN.observe(url, time.monotonic() - started)
+        return r
+
+    if len(candidates) == 1:
+        return await _send(candidates[0]), candidates[0]
+
+    CDN.races += 1
+    pending = {asyncio.ensure_future(_send(url)): url for url in candidates}
+    fallback: Optional[Tuple[httpx.Response, str]] = None
+    last_error: Optional[BaseException] = None
+    try:
+        while pending:
+            done, _ = await asyncio.wait(list(pending), return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                url = pending.pop(task)
+                if task.exception() is not None:
+                    last_error = task.exception()
+                    continue
+                r = task.result()
+                # 416 is a valid answer to the client's Range, not a mirror fault
+                if r.status_code < 400 or r.status_code in (405, 416):
+                    if fallback:
+                        await fallback[0].aclose()
+                    return r, url
+                if fallback:
+                    await fallback[0].aclose()
+                fallback = (r, url)
+    finally:
+        for task in pending:
+            if not task.done():
+                task.cancel()
+            elif not task.cancelled() and task.exception() is None:
+                await task.result().aclose()
+    if fallback:
+        return fallback
+    assert last_error is not None
+    raise last_error
+
+
+def _content_range_span(value: Optional[str]) -> Optional[Tuple[int, int, int]]:
+    # "bytes 0-4194303/73400320" -> (0, 4194303, 73400320)
+    if not value or not value.startswith("bytes ") or "/" not in value:
+        return None
+    span, total = value[len("bytes ") :].split("/", 1)
+    first, _, last = span.partition("-")
+    if not (first.isdigit() and last.isdigit() and total.isdigit()):
+        return None
+    return int(first), int(last), int(total)
+
+
+class _MirrorStream:
+    """上游轨道的顺序读取流（file-like read）：首包在镜像间竞速，读取中断或卡住时用 Range 从当前偏移换镜像续传。"""
+
+    def __init__(self, urls: List[str], cookies: Optional[Dict[str, str]]) -> None:
+        self.urls = urls
+        self.cookies = cookies
+        self.headers = dict(BILI_HEADERS)
+        self.headers["Accept-Encoding"] = "identity"
+        self.pos = 0
+        self.tried: List[str] = []
+        self.response, self.url = _race_get(urls, self.headers, cookies)
+        if self.response.status_code >= 400:
+            status = self.response.status_code
+            self.response.close()
+            raise requests.HTTPError(f"upstream status {status}")
+        length = self.response.headers.get("Content-Length", "")
+        self.total: Optional[int] = int(length) if length.isdigit() else None
+
+    def _failover(self) -> bool:
+        CDN.failure(self.url)
+        self.response.close()
+        self.tried.append(self.url)
+        next_url = CDN.next_mirror(self.urls, self.tried)
+        if next_url is None or self.total is None or len(self.tried) > CDN_FAILOVER_ATTEMPTS:
+            return False
+        CDN.failovers += 1
+        headers = dict(self.headers, Range=f"bytes={self.pos}-{self.total - 1}")
+        sent_at = time.monotonic()
+        try:
+            r = HTTP.get(next_url, headers=headers, cookies=self.cookies, stream=True, timeout=(10, CDN_STALL_TIMEOUT))
+        except requests.RequestException:
+            CDN.failure(next_url)
+            return False
+        span = _content_range_span(r.headers.get("Content-Range"))
+        if r.status_code != 206 or span is None or span[2] != self.total:
+            r.close()
+            CDN.failure(next_url)
+            return False
+        CDN.observe(next_url, time.monotonic() - sent_at)
+        self.response, self.url = r, next_url
+        return True
+
+    def read(self, n: int = -1) -> bytes:
+        while True:
+            try:
+                data = self.response.raw.read(n if n >= 0 else None)
+            except (urllib3.exceptions.HTTPError, OSError) as e:
+                if not self._failover():
+                    raise IOError(f"track read failed at byte {self.pos}: {e}") from e
+                continue
+            if not data and n != 0 and self.total is not None and self.pos < self.total:
+                # Connection closed early without an error
+                if not self._failover():
+                    raise IOError(f"track truncated at byte {self.pos} of {self.total}")
+                continue
+            self.pos += len(data)
+            return data
+
+    def close(self) -> None:
+        self.response.close()
+
+
+# Upstream response headers relayed to the client on proxied downloads
+PROXY_PASSTHROUGH_HEADERS = ("Content-Length", "Content-Range", "Accept-Ranges", "ETag", "Last-Modified")
+
+
+async def _async_proxy_track(
+    method: str,
+    urls: List[str],
+    cookies: Optional[Dict[str, str]],
+    filename: str,
+    range_header: Optional[str] = None,
+    if_range: Optional[str] = None,
+    endpoint: str = "/download",
+) -> Response:
+    """转发单个 m4s 轨道：透传 Range/If-Range，按上游返回 200/206/416，HEAD 不带响应体。
+
+    urls 为 baseUrl + backupUrl：首包在镜像间竞速；传输中镜像卡住或断开时，
+    用 Range 从已发送位置在下一个镜像续传。
+    """
     headers = dict(BILI_HEADERS)
     headers["Accept-Encoding"] = "identity"
-    upstream = requests.get(url, headers=headers, cookies=cookies, stream=True, timeout=30)
-    upstream.raise_for_status()
+    cookie = _cookie_header(cookies)
+    if cookie:
+        headers["Cookie"] = cookie
+    if range_header:
+        headers["Range"] = range_header
+        if if_range:
+            headers["If-Range"] = if_range
+
+    client = _async_http()
+    try:
+        upstream, url = await _async_race(method, urls, headers)
+        if method == "HEAD" and upstream.status_code == 405:
+            # Some edges reject HEAD: fall back to GET and drop the body unread
+            await upstream.aclose()
+            upstream = await client.send(client.build_request("GET", url, headers=headers), stream=True)
+    except httpx.HTTPError as e:
+        raise HTTPException(status_code=502, detail={"error": "upstream_http_error", "message": str(e)})
+    if upstream.status_code >= 400 and upstream.status_code != 416:
+        await upstream.aclose()
+        raise HTTPException(status_code=502, detail={"error": "upstream_http_error", "status": upstream.status_code})
+
+    resp_headers = {"Content-Disposition": f'attachment; filename="{filename}"'}
+    for name in PROXY_PASSTHROUGH_HEADERS:
+        value = upstream.headers.get(name)
+        if value:
+            resp_headers[name] = value
+    resp_headers.setdefault("Accept-Ranges", "bytes")
+    content_type = upstream.headers.get("Content-Type") or "application/octet-stream"
 
-    def _iter():
+    if method == "HEAD" or upstream.status_code == 416:
+        await upstream.aclose()
+        return Response(status_code=upstream.status_code, media_type=content_type, headers=resp_headers)
+
+    # Byte span this response covers, so a failover can ask another mirror for the rest
+    span = _content_range_span(upstream.headers.get("Content-Range"))
+    if span is None and upstream.status_code == 200 and upstream.headers.get("Content-Length", "").isdigit():
+        length = int(upstream.headers["Content-Length"])
+        span = (0, length - 1, length)
+
+    async def _iter() -> AsyncIterator[bytes]:
+        # StreamingResponse awaits each send, so a slow client throttles the upstream read
+        current, current_url = upstream, url
+        tried = [url]
+        sent = 0
+        started = time.perf_counter()
+        ACTIVE_STREAMS.inc(1, endpoint)
         try:
-            for chunk in upstream.iter_content(chunk_size=1024 * 256):
-                if chunk:
-                    yield chunk
+            while True:
+                try:
+                    async for chunk in current.aiter_raw(PROXY_CHUNK_SIZE):
+                        if chunk:
+                            sent += len(chunk)
+                            PROXIED_BYTES.inc(len(chunk), endpoint)
+                            yield chunk
+                    return
+                except httpx.TransportError:
+                    CDN.failure(current_url)
+                    await current.aclose()
+                next_url = CDN.next_mirror(urls, tried)
+                if span is None or next_url is None or len(tried) > CDN_FAILOVER_ATTEMPTS:
+                    # Nothing to resume from: the client sees a truncated body
+                    return
+                CDN.failovers += 1
+                tried.append(next_url)
+                resume = dict(headers)
+                resume.pop("If-Range", None)
+                resume["Range"] = f"bytes={span[0] + sent}-{span[1]}"
+                sent_at = time.monotonic()
+                try:
+                    current = await client.send(client.build_request("GET", next_url, headers=resume), stream=True)
+                except httpx.HTTPError:
+                    CDN.failure(next_url)
+                    return
+                resumed = _content_range_span(current.headers.get("Content-Range"))
+                if current.status_code != 206 or resumed is None or resumed[2] != span[2]:
+                    # Mirror doesn't hold the same object; never splice different bytes
+                    CDN.failure(next_url)
+                    return
+                CDN.observe(next_url, time.monotonic() - sent_at)
+                current_url = next_url
         finally:
-            upstream.close()
+            ACTIVE_STREAMS.dec(1, endpoint)
+            TRANSFER_SECONDS.observe(time.perf_counter() - started, "proxy")
+            await current.aclose()
 
-    content_type = upstream.headers.get("Content-Type") or "application/octet-stream"
-    return _iter(), content_type
+    return StreamingResponse(
+        _iter(), status_code=upstream.status_code, media_type=content_type, headers=resp_headers
+    )
+
+
+_FETCH_POOL = ThreadPoolExecutor(max_workers=MERGE_FETCH_WORKERS, thread_name_prefix="biliurl-fetch")
+
+
+class _FetchCancelled(Exception):
+    """另一个区间已失败，本轨道的其余下载应尽快停止（不重试、不换镜像）。"""
+
+
+@dataclass
+class _TrackFetch:
+    urls: List[str]
+    path: str
+    fd: int = -1
+    size: Optional[int] = None
+    # Mirror the ranges are fetched from; set by the probe race, moved on failover
+    url: str = ""
+    # Set when the merge fails; workers stop before their next write
+    cancelled: bool = False
+    # Serializes seek+write where there is no pwrite
+    lock: threading.Lock = field(default_factory=threading.Lock)
+
+
+def _pwrite(track: _TrackFetch, data: bytes, offset: int) -> None:
+    if track.cancelled:
+        raise _FetchCancelled(track.path)
+    if hasattr(os, "pwrite"):
+        view = memoryview(data)
+        while view:
+            written = os.pwrite(track.fd, view, offset)
+            view = view[written:]
+            offset += written
+        return
+    # Windows has no pwrite: serialize seek+write on this track's descriptor
+    with track.lock:
+        os.lseek(track.fd, offset, os.SEEK_SET)
+        os.write(track.fd, data)
 
 
-def _download_to_file(url: str, cookies: Optional[Dict[str, str]], file_path: str) -> None:
+def _preallocate(fd: int, size: int) -> None:
+    os.ftruncate(fd, size)
+    if hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(fd, 0, size)
+        except OSError:
+            # e.g. tmpfs/overlay without fallocate support; ftruncate is enough
+            pass
+
+
+def _fetch_range(
+    track: _TrackFetch,
+    cookies: Optional[Dict[str, str]],
+    start: int,
+    end: int,
+    first: bool = False,
+) -> List[Tuple[int, int]]:
+    """下载 [start, end] 字节区间并 pwrite 到预分配文件，失败时换下一个镜像从已写位置续传重试。
+
+    first=True 时这是探测请求：在各镜像间竞速，根据 Content-Range 得到总大小、预分配文件，
+    并返回剩余需要并行下载的区间；上游不支持 Range（返回 200）时直接单连接写完整文件。
+    """
     headers = dict(BILI_HEADERS)
     headers["Accept-Encoding"] = "identity"
-    r = requests.get(url, headers=headers, cookies=cookies, stream=True, timeout=30)
-    r.raise_for_status()
-    with open(file_path, "wb") as f:
-        for chunk in r.iter_content(chunk_size=1024 * 256):
-            if chunk:
-                f.write(chunk)
-    r.close()
+    pos = start
+    url = track.url
+    tried: List[str] = []
+    last_error: Optional[Exception] = None
+    for _attempt in range(MERGE_RANGE_RETRIES + CDN_FAILOVER_ATTEMPTS):
+        headers["Range"] = f"bytes={pos}-{end}"
+        try:
+            if first and not url:
+                r, url = _race_get(track.urls, headers, cookies)
+                track.url = url
+            else:
+                sent_at = time.monotonic()
+                r = HTTP.get(url, headers=headers, cookies=cookies, stream=True, timeout=(10, CDN_STALL_TIMEOUT))
+                # A fast 403/404 is not a fast mirror: other statuses raise below and count as CDN.failure
+                if r.status_code == 206 or (first and r.status_code == 200):
+                    CDN.observe(url, time.monotonic() - sent_at)
+            try:
+                if first and r.status_code == 200:
+                    # No range support: single connection, whole object
+                    os.ftruncate(track.fd, 0)
+                    offset = 0
+                    for chunk in r.iter_content(chunk_size=1024 * 256):
+                        _pwrite(track, chunk, offset)
+                        offset += len(chunk)
+                    track.size = offset
+                    return []
+                if r.status_code != 206:
+                    raise IOError(f"unexpected status {r.status_code} for range {pos}-{end}")
+                span = _content_range_span(r.headers.get("Content-Range"))
+                total = span[2] if span else None
+                if first and track.size is None:
+                    if total is None:
+                        raise IOError("missing Content-Range total")
+                    track.size = total
+                    end = min(end, total - 1)
+                    _preallocate(track.fd, total)
+                elif total != track.size:
+                    # Mirror serves a different object; never splice its bytes in
+                    raise IOError(f"size mismatch on {urlsplit(url).hostname}: {total} != {track.size}")
+                for chunk in r.iter_content(chunk_size=1024 * 256):
+                    _pwrite(track, chunk, pos)
+                    pos += len(chunk)
+            finally:
+                r.close()
+            if pos < end + 1:
+                raise IOError(f"short range: got {pos - start} of {end + 1 - start} bytes")
+            break
+        except (requests.RequestException, OSError) as e:
+            last_error = e
+            if not url:
+                continue
+            CDN.failure(url)
+            tried.append(url)
+            next_url = CDN.next_mirror(track.urls, tried)
+            if next_url:
+                # Resume from `pos` on another mirror; later ranges of this track follow it
+                CDN.failovers += 1
+                url = track.url = next_url
+    else:
+        raise RuntimeError(f"range {start}-{end} failed after {len(tried)} attempts: {last_error}")
 
+    if not first or track.size is None:
+        return []
+    return [(a, min(a + MERGE_RANGE_SIZE, track.size) - 1) for a in range(end + 1, track.size, MERGE_RANGE_SIZE)]
 
-def _ffmpeg_mux_to_mp4(video_path: str, audio_path: str, output_path: str) -> None:
+
+def _fetch_tracks(tracks: List[Tuple[List[str], str]], cookies: Optional[Dict[str, str]]) -> None:
+    """并发下载多个轨道 (镜像 urls, path)：每个轨道先取首个区间探测大小，其余区间并行拉取。"""
+    fetches = [_TrackFetch(urls=urls, path=path) for urls, path in tracks]
+    futures: List[Future] = []
+    started = time.perf_counter()
     try:
-        subprocess.run(["ffmpeg", "-version"], capture_output=True, text=True, timeout=10)
+        for f in fetches:
+            f.fd = os.open(f.path, os.O_RDWR | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0), 0o644)
+        firsts = [_FETCH_POOL.submit(_fetch_range, f, cookies, 0, MERGE_RANGE_SIZE - 1, True) for f in fetches]
+        futures.extend(firsts)
+        for f, fut in zip(fetches, firsts):
+            for start, end in fut.result():
+                futures.append(_FETCH_POOL.submit(_fetch_range, f, cookies, start, end))
+        for fut in futures:
+            fut.result()
+        TRANSFER_SECONDS.observe(time.perf_counter() - started, "merge_fetch")
+    except BaseException:
+        for f in fetches:
+            f.cancelled = True
+        for fut in futures:
+            fut.cancel()
+        raise
+    finally:
+        # Running workers must be done with the descriptors before they are closed:
+        # a closed fd number can be reused by another file (store.db, another merge)
+        wait(futures)
+        for f in fetches:
+            if f.fd >= 0:
+                os.close(f.fd)
+
+
+# Result of the one-time `ffmpeg -version` probe
+FFMPEG_INFO: Dict[str, Any] = {"probed": False, "available": False, "version": None, "error": None}
+
+
+def _probe_ffmpeg() -> Dict[str, Any]:
+    try:
+        p = subprocess.run(["ffmpeg", "-version"], capture_output=True, text=True, timeout=10)
+        first_line = (p.stdout or "").splitlines()[0] if p.stdout else ""
+        FFMPEG_INFO.update(available=p.returncode == 0, version=first_line or None, error=None)
     except Exception as e:
-        raise HTTPException(status_code=500, detail={"error": "ffmpeg_not_available", "message": str(e)})
+        FFMPEG_INFO.update(available=False, version=None, error=str(e))
+    FFMPEG_INFO["probed"] = True
+    return FFMPEG_INFO
+
+
+def _require_ffmpeg() -> None:
+    if not FFMPEG_INFO["probed"]:
+        _probe_ffmpeg()
+    if not FFMPEG_INFO["available"]:
+        raise HTTPException(
+            status_code=500, detail={"error": "ffmpeg_not_available", "message": FFMPEG_INFO["error"]}
+        )
+
+
+class _MuxScheduler:
+    """限制并发 ffmpeg 进程数；超出时排队，队列满或等待超时返回 503 + Retry-After。"""
+
+    def __init__(self, max_jobs: int, max_queue: int, queue_timeout: float) -> None:
+        self.max_jobs = max(1, max_jobs)
+        self.max_queue = max(0, max_queue)
+        self.queue_timeout = queue_timeout
+        self.running = 0
+        self.queued = 0
+        self.completed = 0
+        self.rejected = 0
+        self.wait_timing = _Timing()
+        self.run_timing = _Timing()
+        self._cond = threading.Condition()
+
+    def retry_after(self) -> int:
+        avg = (self.run_timing.total / self.run_timing.count) if self.run_timing.count else 10.0
+        return max(1, int(avg * (self.queued + 1) / self.max_jobs) + 1)
+
+    def _reject(self, reason: str) -> HTTPException:
+        self.rejected += 1
+        return HTTPException(
+            status_code=503,
+            detail={"error": reason, "running": self.running, "queued": self.queued},
+            headers={"Retry-After": str(self.retry_after())},
+        )
+
+    def check_capacity(self) -> None:
+        # Fail fast before any download work is spent on a request that would be rejected
+        with self._cond:
+            if self.running >= self.max_jobs and self.queued >= self.max_queue:
+                raise self._reject("mux_queue_full")
+
+    def acquire(self) -> float:
+        enqueued = time.monotonic()
+        with self._cond:
+            if self.running >= self.max_jobs and self.queued >= self.max_queue:
+                raise self._reject("mux_queue_full")
+            self.queued += 1
+            try:
+                deadline = enqueued + self.queue_timeout
+                while self.running >= self.max_jobs:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise self._reject("mux_queue_timeout")
+                    self._cond.wait(remaining)
+            finally:
+                self.queued -= 1
+            self.running += 1
+        started = time.monotonic()
+        self.wait_timing.record(started - enqueued)
+        MUX_WAIT_SECONDS.observe(started - enqueued)
+        return started
+
+    def release(self, started: float) -> None:
+        self.run_timing.record(time.monotonic() - started)
+        MUX_RUN_SECONDS.observe(time.monotonic() - started)
+        with self._cond:
+            self.running -= 1
+            self.completed += 1
+            self._cond.notify()
+
+    @contextmanager
+    def slot(self) -> Iterator[None]:
+        started = self.acquire()
+        try:
+            yield
+        finally:
+            self.release(started)
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "max_jobs": self.max_jobs,
+            "max_queue": self.max_queue,
+            "running": self.running,
+            "queued": self.queued,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "wait": self.wait_timing.stats(),
+            "mux": self.run_timing.stats(),
+        }
+
+
+MUX_SCHEDULER = _MuxScheduler(FFMPEG_MAX_JOBS, FFMPEG_MAX_QUEUE, FFMPEG_QUEUE_TIMEOUT)
+BMFF_TIMING = _Timing()
+MUX_COUNTS: Dict[str, int] = {"bmff": 0, "ffmpeg": 0, "bmff_fallbacks": 0}
+
+
+def _mux_to_mp4(video_path: str, audio_path: str, output_path: str) -> None:
+    """合并两个 m4s：优先用内置 bmff 重封装（无子进程），不支持的输入回退 ffmpeg。"""
+    if MUXER != "ffmpeg":
+        try:
+            with BMFF_TIMING.time():
+                bmff.remux_files(video_path, audio_path, output_path)
+            MUX_COUNTS["bmff"] += 1
+            return
+        except bmff.BmffError as e:
+            if MUXER == "bmff":
+                raise HTTPException(status_code=500, detail={"error": "bmff_remux_failed", "message": str(e)})
+            MUX_COUNTS["bmff_fallbacks"] += 1
+    _ffmpeg_mux_to_mp4(video_path, audio_path, output_path)
+    MUX_COUNTS["ffmpeg"] += 1
+
+
+def _bmff_stream_mux(
+    video_urls: List[str], audio_urls: List[str], cookies: Optional[Dict[str, str]]
+) -> Optional[Iterator[bytes]]:
+    """流式 bmff 重封装：直接读取两个上游响应体并交错输出；输入不受支持时返回 None 以便回退 ffmpeg。"""
+    streams: List[_MirrorStream] = []
+
+    def _close() -> None:
+        for stream in streams:
+            stream.close()
+
+    try:
+        for urls in (video_urls, audio_urls):
+            streams.append(_MirrorStream(urls, cookies))
+        chunks = bmff.remux(streams[0], streams[1])
+        # ftyp + merged moov: unsupported inputs fail here, before the response starts
+        first = next(chunks)
+    except (bmff.BmffError, StopIteration):
+        _close()
+        MUX_COUNTS["bmff_fallbacks"] += 1
+        return None
+    except (requests.RequestException, OSError) as e:
+        _close()
+        raise HTTPException(status_code=502, detail={"error": "upstream_http_error", "message": str(e)})
+    MUX_COUNTS["bmff"] += 1
+
+    def _iter() -> Iterator[bytes]:
+        try:
+            yield first
+            yield from chunks
+        except (bmff.BmffError, OSError):
+            # Headers are already sent; the client sees a truncated stream
+            pass
+        finally:
+            _close()
+
+    return _iter()
+
+
+def _ffmpeg_mux_to_mp4(video_path: str, audio_path: str, output_path: str) -> None:
+    _require_ffmpeg()
 
     cmd = [
         "ffmpeg",
@@ -428,7 +2845,8 @@ def _ffmpeg_mux_to_mp4(video_path: str, audio_path: str, output_path: str) -> No
         output_path,
     ]
 
-    p = subprocess.run(cmd, capture_output=True, text=True)
+    with MUX_SCHEDULER.slot():
+        p = subprocess.run(cmd, capture_output=True, text=True)
     if p.returncode != 0:
         raise HTTPException(
             status_code=500,
@@ -440,66 +2858,262 @@ def _ffmpeg_mux_to_mp4(video_path: str, audio_path: str, output_path: str) -> No
         )
 
 
-def _pick_video_audio(
+class _MuxOutput:
+    """ffmpeg stdout 的迭代器。close() 幂等，回收进程、喂数据线程与调度槽位；
+    与生成器不同，即使响应体从未开始迭代（客户端提前断开）也能释放。"""
+
+    def __init__(self, first: bytes, stdout: Any, cleanup: Callable[[], None]) -> None:
+        self._first: Optional[bytes] = first
+        self._stdout = stdout
+        self._cleanup = cleanup
+        self._closed = False
+        self._lock = threading.Lock()
+
+    def __iter__(self) -> "_MuxOutput":
+        return self
+
+    def __next__(self) -> bytes:
+        if self._first is not None:
+            chunk, self._first = self._first, None
+            return chunk
+        buf = b"" if self._closed else self._stdout.read1(1024 * 256)
+        if not buf:
+            self.close()
+            raise StopIteration
+        return buf
+
+    def close(self) -> None:
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        self._cleanup()
+
+
+def _ffmpeg_stream_mux(
+    video_urls: List[str], audio_urls: List[str], cookies: Optional[Dict[str, str]]
+) -> _MuxOutput:
+    """流式合并：上游轨道经管道喂给 ffmpeg，ffmpeg 输出 fragmented MP4 到 stdout，边合并边返回。
+
+    仅 POSIX（依赖 pass_fds 继承管道）。首个输出块在返回前读取，以便 ffmpeg 启动失败时仍能返回错误码。
+    """
+    _require_ffmpeg()
+    started = MUX_SCHEDULER.acquire()
+    video_r, video_w = os.pipe()
+    audio_r, audio_w = os.pipe()
+    cmd = [
+        "ffmpeg",
+        "-nostdin",
+        "-loglevel",
+        "error",
+        "-i",
+        f"pipe:{video_r}",
+        "-i",
+        f"pipe:{audio_r}",
+        "-map",
+        "0:v:0",
+        "-map",
+        "1:a:0",
+        "-c:v",
+        "copy",
+        "-c:a",
+        "copy",
+        "-movflags",
+        "frag_keyframe+empty_moov+default_base_moof",
+        "-f",
+        "mp4",
+        "pipe:1",
+    ]
+    try:
+        proc = subprocess.Popen(
+            cmd,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            pass_fds=(video_r, audio_r),
+        )
+    except Exception as e:
+        for fd in (video_r, video_w, audio_r, audio_w):
+            os.close(fd)
+        MUX_SCHEDULER.release(started)
+        raise HTTPException(status_code=500, detail={"error": "ffmpeg_not_available", "message": str(e)})
+    os.close(video_r)
+    os.close(audio_r)
+
+    stderr_tail: List[bytes] = []
+    feed_errors: List[str] = []
+
+    def _feed(urls: List[str], fd: int) -> None:
+        try:
+            with os.fdopen(fd, "wb") as pipe:
+                source = _MirrorStream(urls, cookies)
+                try:
+                    while True:
+                        chunk = source.read(1024 * 256)
+                        if not chunk:
+                            break
+                        pipe.write(chunk)
+                finally:
+                    source.close()
+        except BrokenPipeError:
+            # ffmpeg exited (error or client went away)
+            pass
+        except Exception as e:
+            feed_errors.append(str(e))
+
+    def _drain_stderr() -> None:
+        for line in proc.stderr:
+            stderr_tail.append(line)
+            del stderr_tail[:-50]
+
+    threads = [
+        threading.Thread(target=_feed, args=(video_urls, video_w), daemon=True),
+        threading.Thread(target=_feed, args=(audio_urls, audio_w), daemon=True),
+        threading.Thread(target=_drain_stderr, daemon=True),
+    ]
+    for t in threads:
+        t.start()
+
+    def _cleanup() -> None:
+        if proc.poll() is None:
+            proc.kill()
+        proc.wait()
+        proc.stdout.close()
+        for t in threads:
+            t.join(timeout=5)
+        # The scheduler slot is held for as long as the process streams
+        MUX_SCHEDULER.release(started)
+
+    first = proc.stdout.read1(1024 * 256)
+    if not first:
+        _cleanup()
+        raise HTTPException(
+            status_code=500,
+            detail={
+                "error": "ffmpeg_mux_failed",
+                "returncode": proc.returncode,
+                "stderr": b"".join(stderr_tail).decode("utf-8", "replace")[-4000:],
+                "upstream": feed_errors,
+            },
+        )
+
+    return _MuxOutput(first, proc.stdout, _cleanup)
+
+
+def _metered(chunks: Iterator[bytes], endpoint: str) -> Iterator[bytes]:
+    started = time.perf_counter()
+    ACTIVE_STREAMS.inc(1, endpoint)
+    try:
+        for chunk in chunks:
+            PROXIED_BYTES.inc(len(chunk), endpoint)
+            yield chunk
+    finally:
+        ACTIVE_STREAMS.dec(1, endpoint)
+        TRANSFER_SECONDS.observe(time.perf_counter() - started, "stream_mux")
+        close = getattr(chunks, "close", None)
+        if close:
+            close()
+
+
+def _merge_cache_key(bvid: str, cid: str, video: Dict[str, Any], audio: Dict[str, Any]) -> str:
+    ident = f"{bvid}|{cid}|v{video.get('id')}-{video.get('codecid')}|a{audio.get('id')}"
+    return hashlib.sha256(ident.encode("utf-8")).hexdigest()
+
+
+def _build_merged_mp4(
+    key: str, video_urls: List[str], audio_urls: List[str], cookies: Optional[Dict[str, str]]
+) -> str:
+    work_dir = MERGE_CACHE.work_dir()
+    try:
+        video_path = os.path.join(work_dir, "video.m4s")
+        audio_path = os.path.join(work_dir, "audio.m4s")
+        out_path = os.path.join(work_dir, "merged.mp4")
+        _fetch_tracks([(video_urls, video_path), (audio_urls, audio_path)], cookies)
+        _mux_to_mp4(video_path, audio_path, out_path)
+        return MERGE_CACHE.store(key, out_path)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def _parse_codecs(codecs: Optional[str]) -> List[str]:
+    """解析客户端编码偏好（逗号分隔，按优先级），如 "av1,hevc,avc,flac"。"""
+    if not codecs:
+        return list(DEFAULT_CODECS)
+    parsed: List[str] = []
+    for token in codecs.split(","):
+        name = CODEC_ALIASES.get(token.strip().lower(), token.strip().lower())
+        if not name:
+            continue
+        if name not in CODEC_ALIASES.values():
+            raise HTTPException(status_code=400, detail={"error": "invalid_codecs", "codec": token.strip()})
+        if name not in parsed:
+            parsed.append(name)
+    return parsed or list(DEFAULT_CODECS)
+
+
+def _select_tracks(
     dash: Dict[str, Any],
-    prefer_video_id: Optional[int] = None,
-    max_video_id: Optional[int] = None,
-) -> Tuple[Dict[str, Any], Dict[str, Any]]:
-    videos = dash.get("video") or []
-    audios = dash.get("audio") or []
-    if not videos or not audios:
+    authed: bool,
+    codecs: Optional[str] = None,
+    max_bandwidth: Optional[int] = None,
+    max_qn: Optional[int] = None,
+) -> Tuple[Dict[str, Any], Dict[str, Any], Dict[str, Any]]:
+    """按画质、编码偏好与带宽上限选择视频/音频轨道；游客固定 480p，max_qn 可进一步限制画质。返回 (video, audio, selection)。"""
+    prefer = Q480 if not authed else None
+    caps = [q for q in (prefer, max_qn) if q is not None]
+    with _stage("select"):
+        best_video, best_audio, selection = biliurl.selectStreams(
+            dash,
+            codecs=_parse_codecs(codecs),
+            max_bandwidth=max_bandwidth,
+            prefer_id=prefer,
+            max_id=min(caps) if caps else None,
+        )
+    if not best_video or not best_audio:
         raise HTTPException(status_code=502, detail={"error": "dash_missing"})
+    return best_video, best_audio, selection
 
-    def vid_id(x: Dict[str, Any]) -> int:
-        try:
-            return int(x.get("id") or 0)
-        except Exception:
-            return 0
 
-    video_candidates = list(videos)
-    if max_video_id is not None:
-        capped = [v for v in video_candidates if vid_id(v) <= max_video_id]
-        if capped:
-            video_candidates = capped
-        else:
-            # 如果服务端只返回了更高画质，兜底选择最低画质，避免无鉴权时拿到更高画质
-            video_candidates = [min(videos, key=vid_id)]
-    if prefer_video_id is not None:
-        for v in video_candidates:
-            if vid_id(v) == prefer_video_id:
-                best_video = v
-                break
-        else:
-            best_video = max(video_candidates, key=vid_id)
-    else:
-        best_video = max(video_candidates, key=vid_id)
+def _selection_header(selection: Dict[str, Any]) -> str:
+    # "video=80/av1/900000; audio=30280/aac/192000"
+    return "; ".join(
+        f"{kind}={selection[kind]['id']}/{selection[kind]['codec']}/{selection[kind]['bandwidth']}"
+        for kind in ("video", "audio")
+    )
 
-    best_audio = max(audios, key=vid_id)
-    return best_video, best_audio
+
+def _track_info(track: Dict[str, Any], with_urls: bool = True) -> Dict[str, Any]:
+    info = {
+        "id": track.get("id"),
+        "codecid": track.get("codecid"),
+        "codec": biliurl.streamCodec(track),
+        "codecs": track.get("codecs"),
+        "bandwidth": track.get("bandwidth"),
+        "width": track.get("width"),
+        "height": track.get("height"),
+        "frame_rate": track.get("frameRate") or track.get("frame_rate"),
+    }
+    if with_urls:
+        # Mirrors ordered by measured CDN latency; with no data this is baseUrl, backupUrl...
+        urls = CDN.rank(_track_urls(track))
+        info["url"] = urls[0] if urls else None
+        info["backup_url"] = urls[1:]
+    return info
 
 
 @app.get("/login/qr", responses={200: {"content": {"image/png": {}}}})
 def login_qr():
     """返回二维码图片（image/png）。登录流程 id 放在响应头 X-Login-Id。"""
-    _cleanup_login_flows()
     _ensure_dirs()
-    _ = _load_or_create_key()
 
-    _db_init()
-
-    sess = requests.Session()
-    qrcode_key, qr_url = _bili_qr_generate(sess)
+    qrcode_key, qr_url = _bili_qr_generate(HTTP)
     png = _make_qr_png_bytes(qr_url)
 
     login_id = uuid.uuid4().hex
-    conn = _db_connect()
-    try:
-        conn.execute(
-            "INSERT OR REPLACE INTO login_flows(login_id, created_at, qrcode_key) VALUES (?, ?, ?)",
-            (login_id, _now(), qrcode_key),
-        )
-    finally:
-        conn.close()
+    _db_execute(
+        "INSERT OR REPLACE INTO login_flows(login_id, created_at, qrcode_key) VALUES (?, ?, ?)",
+        (login_id, _now(), qrcode_key),
+    )
 
     resp = Response(content=png, media_type="image/png")
     resp.headers["X-Login-Id"] = login_id
@@ -537,7 +3151,7 @@ def index():
             <div class="muted">获取后请用 B 站 App 扫码并确认</div>
             <div style="margin-top:12px;"><img id="qrImg" alt="二维码" /></div>
             <div class="muted" style="margin-top:8px;">login_id: <span id="loginId">-</span></div>
-            <button id="btnPoll" disabled>开始轮询登录状态</button>
+            <button id="btnPoll" disabled>开始监听登录状态</button>
             <pre id="loginOut">{}</pre>
         </div>
 
@@ -568,6 +3182,7 @@ let loginId = null;
 let userId = null;
 let token = null;
 let pollTimer = null;
+let loginEvents = null;
 
 function $(id){ return document.getElementById(id); }
 function setJson(id, obj){ $(id).textContent = JSON.stringify(obj, null, 2); }
@@ -579,6 +3194,8 @@ async function getQr(){
     $('loginId').textContent = loginId || '-';
     const blob = await r.blob();
     $('qrImg').src = URL.createObjectURL(blob);
+    if(loginEvents){ loginEvents.close(); loginEvents = null; }
+    if(pollTimer){ clearInterval(pollTimer); pollTimer = null; }
     $('btnPoll').disabled = !loginId;
     setJson('loginOut', {status:'qr_ready', login_id: loginId});
 }
@@ -587,19 +3204,40 @@ async function pollLoginOnce(){
     if(!loginId) return;
     const r = await fetch('/login/status?login_id=' + encodeURIComponent(loginId));
     const j = await r.json();
+    onLoginState(j);
+    if(j.status === 'success'){
+        clearInterval(pollTimer);
+        pollTimer = null;
+    }
+}
+
+function onLoginState(j){
     setJson('loginOut', j);
     if(j.status === 'success'){
         userId = j.user_id;
         token = j.token;
-        clearInterval(pollTimer);
-        pollTimer = null;
     }
 }
 
 function startPoll(){
-    if(pollTimer) return;
-    pollLoginOnce();
-    pollTimer = setInterval(pollLoginOnce, 2000);
+    if(!loginId || pollTimer || loginEvents) return;
+    if(!window.EventSource){
+        // No SSE: fall back to polling /login/status
+        pollLoginOnce();
+        pollTimer = setInterval(pollLoginOnce, 2000);
+        return;
+    }
+    // The server polls Bilibili once per interval and pushes every change here
+    loginEvents = new EventSource('/login/events?login_id=' + encodeURIComponent(loginId));
+    loginEvents.addEventListener('status', (e)=>{
+        const j = JSON.parse(e.data);
+        onLoginState(j);
+        if(['success', 'expired', 'not_found'].includes(j.status)){
+            loginEvents.close();
+            loginEvents = null;
+        }
+    });
+    loginEvents.addEventListener('end', ()=>{ loginEvents.close(); loginEvents = null; });
 }
 
 function authQuery(){
@@ -610,11 +3248,9 @@ function authQuery(){
 async function getUrls(){
     const bvid = $('bvid').value.trim();
     if(!bvid) throw new Error('请填写 bvid');
-    const v = await fetch('/stream/video?bvid=' + encodeURIComponent(bvid) + authQuery());
-    const a = await fetch('/stream/audio?bvid=' + encodeURIComponent(bvid) + authQuery());
-    const jv = await v.json();
-    const ja = await a.json();
-    setJson('urlOut', {video: jv, audio: ja, auth: Boolean(userId && token)});
+    const r = await fetch('/stream/dash?bvid=' + encodeURIComponent(bvid) + authQuery());
+    const j = await r.json();
+    setJson('urlOut', j);
 }
 
 function download(kind){
@@ -645,23 +3281,13 @@ $('btnMergeRemote').addEventListener('click', ()=>{ try{ mergeRemote(); } catch(
         )
 
 
-@app.get("/login/status")
-def login_status(login_id: str = Query(...)):
-    """轮询登录状态。成功时返回 user_id + token（并持久化 cookies 与 user/token）。"""
-    _cleanup_login_flows()
-
-    conn = _db_connect()
-    try:
-        try:
-            row = conn.execute("SELECT qrcode_key FROM login_flows WHERE login_id = ?", (login_id,)).fetchone()
-        except sqlite3.OperationalError as e:
-            if "no such table" in str(e).lower():
-                _db_init()
-                row = None
-            else:
-                raise
-    finally:
-        conn.close()
+def _login_poll_once(login_id: str) -> Dict[str, Any]:
+    """向 B 站轮询一次扫码状态；成功时创建会话。未知/过期 login_id 抛 404。"""
+    # Expired flows are reaped in the background; filter here so a flow past its TTL is never used
+    row = _db_fetchone(
+        "SELECT qrcode_key FROM login_flows WHERE login_id = ? AND created_at >= ?",
+        (login_id, _now() - LOGIN_FLOW_TTL),
+    )
 
     if not row or not row[0]:
         raise HTTPException(status_code=404, detail={"error": "login_id_not_found"})
@@ -688,82 +3314,515 @@ def login_status(login_id: str = Query(...)):
         user_id = uuid.uuid4().hex
         token = secrets.token_urlsafe(32)
 
-        _save_cookies_to_disk(user_id, cookie_dict)
-
-        payload = {"user_id": user_id, "token": token, "created_at": _now()}
+        created_at = _now()
+        payload = {
+            "user_id": user_id,
+            "token": token,
+            "created_at": created_at,
+            "cookies": cookie_dict,
+            # Lets the health checker renew the cookies before they lapse
+            "refresh_token": d.get("refresh_token") or "",
+        }
         enc = _encrypt_json(payload)
         user_key = _user_key(user_id)
 
-        conn = _db_connect()
-        try:
+        with _db_transaction() as conn:
             conn.execute(
-                "INSERT OR REPLACE INTO sessions(user_key, payload) VALUES (?, ?)",
-                (user_key, enc),
+                "INSERT OR REPLACE INTO sessions(user_key, payload, created_at, checked_at) VALUES (?, ?, ?, ?)",
+                (user_key, enc, created_at, created_at),
             )
             conn.execute("DELETE FROM login_flows WHERE login_id = ?", (login_id,))
-        finally:
-            conn.close()
+        if SHARED.stores_sessions:
+            SHARED.set("session", user_key, enc.decode("ascii"), SESSION_MAX_AGE)
 
-        with STORE_LOCK:
-            USER_SESSIONS[user_id] = UserSession(created_at=_now(), token=token, cookie_dict=cookie_dict)
+        USER_SESSIONS_MISSING.pop(user_id)
+        USER_SESSIONS.set(
+            user_id, UserSession(created_at=created_at, token=token, cookie_dict=cookie_dict, user_key=user_key)
+        )
 
         return {"status": "success", "user_id": user_id, "token": token}
 
     return {"status": "unknown", "raw": data}
 
 
-@app.get("/download/video")
-def download_video(
+# Watcher states after which nothing can change any more
+_LOGIN_TERMINAL = ("success", "expired", "not_found")
+
+
+class _LoginWatch:
+    """单个 login_id 的服务端轮询任务：保存最新状态，状态变化时唤醒所有订阅者。"""
+
+    def __init__(self, login_id: str) -> None:
+        self.login_id = login_id
+        self.state: Optional[Dict[str, Any]] = None
+        self.version = 0
+        self.subscribers = 0
+        self.last_seen = time.monotonic()
+        self.done = False
+        self.task: Optional["asyncio.Task[None]"] = None
+        self._changed = asyncio.Event()
+
+    def publish(self, state: Dict[str, Any]) -> None:
+        if state == self.state:
+            return
+        self.state = state
+        self.version += 1
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    def deliver(self) -> Optional[Dict[str, Any]]:
+        """取当前状态交给一个客户端：登录成功的 user_id/token 只交付一次。"""
+        state = self.state
+        if state is not None and state["status"] == "success" and "token" in state:
+            # Other subscribers and late pollers during QR_WATCH_LINGER get the status only
+            self.state = {"status": "success", "delivered": True}
+        return state
+
+    def finish(self) -> None:
+        self.done = True
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    async def wait(self, version: int, timeout: float) -> None:
+        """等到 version 之后的新状态、任务结束或超时。"""
+        if self.version > version or self.done:
+            return
+        try:
+            await asyncio.wait_for(self._changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+
+class _LoginWatchers:
+    """login_id -> _LoginWatch；在事件循环里运行，状态通过 SSE 与长轮询分发给所有客户端。"""
+
+    def __init__(self) -> None:
+        self._watches: Dict[str, _LoginWatch] = {}
+        self.started = 0
+        self.upstream_polls = 0
+        self.upstream_errors = 0
+
+    def get(self, login_id: str) -> Optional[_LoginWatch]:
+        return self._watches.get(login_id)
+
+    def watch(self, login_id: str) -> _LoginWatch:
+        """返回 login_id 的 watcher，没有则启动（必须在事件循环内调用）。"""
+        w = self._watches.get(login_id)
+        if w is None:
+            w = _LoginWatch(login_id)
+            self._watches[login_id] = w
+            w.task = asyncio.get_running_loop().create_task(self._run(w))
+            self.started += 1
+        w.last_seen = time.monotonic()
+        return w
+
+    async def _run(self, w: _LoginWatch) -> None:
+        try:
+            while True:
+                try:
+                    state = await run_in_threadpool(_login_poll_once, w.login_id)
+                except HTTPException as e:
+                    if e.status_code == 404:
+                        # Flow expired (LOGIN_FLOW_TTL) or was never issued
+                        state = {"status": "not_found"}
+                    else:
+                        state = {"status": "error", "detail": e.detail}
+                except Exception as e:
+                    # Transient upstream failure: keep the last good state and retry next tick
+                    self.upstream_errors += 1
+                    state = dict(w.state or {"status": "waiting"}, last_error=str(e))
+                self.upstream_polls += 1
+                w.publish(state)
+                if state["status"] in _LOGIN_TERMINAL:
+                    break
+                if w.subscribers == 0 and time.monotonic() - w.last_seen > QR_WATCH_IDLE:
+                    break
+                await asyncio.sleep(QR_WATCH_INTERVAL)
+        finally:
+            w.finish()
+            asyncio.get_running_loop().call_later(QR_WATCH_LINGER, self._forget, w)
+
+    def _forget(self, w: _LoginWatch) -> None:
+        if self._watches.get(w.login_id) is w:
+            del self._watches[w.login_id]
+
+    def stats(self) -> Dict[str, Any]:
+        active = [w for w in self._watches.values() if not w.done]
+        return {
+            "active": len(active),
+            "subscribers": sum(w.subscribers for w in active),
+            "started": self.started,
+            "upstream_polls": self.upstream_polls,
+            "upstream_errors": self.upstream_errors,
+        }
+
+
+LOGIN_WATCHERS = _LoginWatchers()
+
+
+@app.get("/login/status")
+async def login_status(login_id: str = Query(...)):
+    """查询登录状态。成功时返回 user_id + token（cookies 与 user/token 一起加密写入同一行）。
+
+    若该 login_id 已有服务端 watcher，返回其最新状态（必要时等它的首次轮询），不再单独请求上游。
+    """
+    w = LOGIN_WATCHERS.get(login_id)
+    if w is None:
+        return await run_in_threadpool(_login_poll_once, login_id)
+    w.last_seen = time.monotonic()
+    # A second upstream poll racing the watcher's first one could create the session twice
+    deadline = time.monotonic() + QR_EVENTS_HEARTBEAT
+    while w.state is None and not w.done and time.monotonic() < deadline:
+        await w.wait(w.version, deadline - time.monotonic())
+    state = w.deliver() or {"status": "waiting"}
+    if state["status"] == "not_found":
+        raise HTTPException(status_code=404, detail={"error": "login_id_not_found"})
+    if state["status"] == "error":
+        raise HTTPException(status_code=502, detail=state.get("detail"))
+    return state
+
+
+@app.get("/login/events")
+async def login_events(request: Request, login_id: str = Query(...)):
+    """SSE：推送扫码状态变化（event: status），到达 success/expired/not_found 后结束。"""
+    w = LOGIN_WATCHERS.watch(login_id)
+
+    async def _events() -> AsyncIterator[bytes]:
+        w.subscribers += 1
+        version = 0
+        try:
+            while True:
+                await w.wait(version, QR_EVENTS_HEARTBEAT)
+                if await request.is_disconnected():
+                    return
+                if w.version > version and w.state is not None:
+                    version = w.version
+                    state = w.deliver()
+                    data = json.dumps(state, ensure_ascii=False)
+                    yield f"event: status\ndata: {data}\n\n".encode("utf-8")
+                    if state["status"] in _LOGIN_TERMINAL:
+                        return
+                elif w.done:
+                    yield b"event: end\ndata: {}\n\n"
+                    return
+                else:
+                    yield b": keepalive\n\n"
+        finally:
+            w.subscribers -= 1
+            w.last_seen = time.monotonic()
+
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    return StreamingResponse(_events(), media_type="text/event-stream", headers=headers)
+
+
+@app.get("/login/wait")
+async def login_wait(
+    login_id: str = Query(...),
+    since: Optional[str] = Query(None, description="客户端已知的状态；状态与之不同时立即返回"),
+    timeout: float = Query(25.0, gt=0, le=QR_WAIT_MAX, description="最长等待秒数"),
+):
+    """长轮询：状态不同于 since（或超时）时返回最新状态，字段与 /login/status 相同。"""
+    w = LOGIN_WATCHERS.watch(login_id)
+    deadline = time.monotonic() + timeout
+    w.subscribers += 1
+    try:
+        while True:
+            state = w.state
+            if state is not None and (state["status"] != since or state["status"] in _LOGIN_TERMINAL):
+                break
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or w.done:
+                break
+            await w.wait(w.version, remaining)
+    finally:
+        w.subscribers -= 1
+        w.last_seen = time.monotonic()
+
+    state = w.deliver() or {"status": since or "waiting"}
+    if state["status"] == "not_found":
+        raise HTTPException(status_code=404, detail={"error": "login_id_not_found"})
+    return state
+
+
+@app.post("/logout")
+def logout(
+    user_id: Optional[str] = Query(None),
+    token: Optional[str] = Query(None),
+    x_user_id: Optional[str] = Header(default=None, alias="X-User-Id"),
+    x_token: Optional[str] = Header(default=None, alias="X-Token"),
+):
+    """注销：删除会话（SQLite 与共享后端），并通知其它 worker 丢弃内存中的副本。"""
+    uid, tok = _get_auth_from_request(user_id, token, x_user_id, x_token)
+    sess = _validate_user(uid, tok)
+    if not sess:
+        raise HTTPException(status_code=401, detail={"error": "invalid_session"})
+
+    user_key = sess.user_key or _user_key(uid)
+    _db_execute("DELETE FROM sessions WHERE user_key = ?", (user_key,))
+    if SHARED.stores_sessions:
+        SHARED.delete("session", user_key)
+    # Other hosts (redis) drop their own store.db row too, not just the memory copy
+    SHARED.publish("logout", user_key)
+    USER_SESSIONS.pop(uid)
+    return {"status": "logged_out"}
+
+
+def _apply_invalidations() -> None:
+    """把其它 worker 发布的失效事件应用到本进程的内存缓存。"""
+    for ns, key in SHARED.poll():
+        if ns == "pagelist":
+            PAGELIST_CACHE.memory.pop(key)
+        elif ns == "session":
+            USER_SESSIONS.pop_where(lambda sess: sess.user_key == key)
+        elif ns == "logout":
+            USER_SESSIONS.pop_where(lambda sess: sess.user_key == key)
+            _db_execute("DELETE FROM sessions WHERE user_key = ?", (key,))
+
+
+# Paths whose handlers can raise _REQUEST_FLAGS (they resolve stored cookies); the
+# rest bypass the header middleware entirely
+_FLAGGED_PATHS = ("/stream/", "/merge/", "/download/")
+
+
+class _ResponseHeadersMiddleware:
+    """纯 ASGI 中间件：/stream/* 响应加 Server-Timing，会话 cookies 失效时加 X-Session-Stale。"""
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        path = scope["path"] if scope["type"] == "http" else ""
+        if not path.startswith(_FLAGGED_PATHS):
+            await self.app(scope, receive, send)
+            return
+        # NDJSON batches send their headers before any stage has run
+        timed = path.startswith("/stream/") and path != "/stream/batch"
+        # The list/dict are shared with the handler's threadpool context, which writes to them
+        flags: Dict[str, Any] = {}
+        stages: List[Tuple[str, float]] = []
+        flags_token = _REQUEST_FLAGS.set(flags)
+        token = _STAGES.set(stages if timed else None)
+        start = time.perf_counter()
+
+        async def _send(message: Message) -> None:
+            if message["type"] == "http.response.start":
+                headers = list(message.get("headers", []))
+                if timed:
+                    timing = _server_timing(stages, time.perf_counter() - start)
+                    headers.append((b"server-timing", timing.encode("latin-1")))
+                if flags.get("session_stale"):
+                    # Stored Bilibili cookies expired: served as guest until the user logs in again
+                    headers.append((b"x-session-stale", b"1"))
+                message = dict(message, headers=headers)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, _send)
+        finally:
+            _STAGES.reset(token)
+            _REQUEST_FLAGS.reset(flags_token)
+
+
+app.add_middleware(_ResponseHeadersMiddleware)
+
+
+def _cache_metric_lines() -> List[str]:
+    caches = {
+        "sessions": USER_SESSIONS.stats(),
+        "pagelist": PAGELIST_CACHE.memory.stats(),
+        "playurl": PLAYURL_CACHE.stats(),
+        "dns": _DNS_CACHE.stats(),
+        "merge": MERGE_CACHE.stats(),
+    }
+    lines = [
+        "# HELP biliurl_cache_hits_total Cache hits.",
+        "# TYPE biliurl_cache_hits_total counter",
+        *[f'biliurl_cache_hits_total{{cache="{name}"}} {c["hits"]}' for name, c in caches.items()],
+        "# HELP biliurl_cache_misses_total Cache misses.",
+        "# TYPE biliurl_cache_misses_total counter",
+        *[f'biliurl_cache_misses_total{{cache="{name}"}} {c["misses"]}' for name, c in caches.items()],
+        "# HELP biliurl_cache_hit_ratio Hits / (hits + misses) since start.",
+        "# TYPE biliurl_cache_hit_ratio gauge",
+        *[
+            f'biliurl_cache_hit_ratio{{cache="{name}"}} {c["hit_ratio"]}'
+            for name, c in caches.items()
+            if c["hit_ratio"] is not None
+        ],
+        "# HELP biliurl_mux_jobs ffmpeg jobs running / queued.",
+        "# TYPE biliurl_mux_jobs gauge",
+        f'biliurl_mux_jobs{{state="running"}} {MUX_SCHEDULER.running}',
+        f'biliurl_mux_jobs{{state="queued"}} {MUX_SCHEDULER.queued}',
+    ]
+    gov = GOVERNOR.stats()
+    lines += [
+        "# HELP biliurl_upstream_rate Current api.bilibili.com request budget (req/s).",
+        "# TYPE biliurl_upstream_rate gauge",
+        f"biliurl_upstream_rate {gov['rate']}",
+        "# HELP biliurl_upstream_queue Calls waiting for an upstream token.",
+        "# TYPE biliurl_upstream_queue gauge",
+        *[f'biliurl_upstream_queue{{priority="{p}"}} {n}' for p, n in gov["queue"].items()],
+        "# HELP biliurl_upstream_throttled_total Calls failed with 503 after waiting too long.",
+        "# TYPE biliurl_upstream_throttled_total counter",
+        *[f'biliurl_upstream_throttled_total{{priority="{p}"}} {n}' for p, n in gov["throttled"].items()],
+        "# HELP biliurl_upstream_risk_total -412/-352 risk-control answers.",
+        "# TYPE biliurl_upstream_risk_total counter",
+        f"biliurl_upstream_risk_total {gov['risk_events']}",
+    ]
+    return lines
+
+
+@app.get("/metrics")
+def metrics():
+    """Prometheus 文本格式指标：上游/CDN 延迟直方图、转发字节数、活跃流、ffmpeg 排队与运行耗时、缓存命中率。"""
+    lines: List[str] = []
+    for metric in _METRICS:
+        lines.extend(metric.render())
+    lines.extend(_cache_metric_lines())
+    return Response("\n".join(lines) + "\n", media_type="text/plain; version=0.0.4")
+
+
+@app.get("/stats")
+def stats():
+    """服务端缓存统计（命中/未命中计数等）。"""
+    return {
+        "sessions": USER_SESSIONS.stats(),
+        "sessions_negative": USER_SESSIONS_MISSING.stats(),
+        "session_key_loads": _KEY_STATE["loads"],
+        "session_health": SESSION_HEALTH_STATS,
+        "session_store": {
+            **SESSION_STORE_STATS,
+            "rows": (_db_fetchone("SELECT COUNT(*) FROM sessions") or (0,))[0],
+        },
+        "sqlite": DB_TIMING.stats(),
+        "pagelist": PAGELIST_CACHE.stats(),
+        "pagelist_shared_flights": _PAGELIST_FLIGHT.shared,
+        "playurl": PLAYURL_CACHE.stats(),
+        "playurl_shared_flights": _PLAYURL_FLIGHT.shared,
+        "shared": SHARED.stats(),
+        "login_watchers": LOGIN_WATCHERS.stats(),
+        "wbi_keys": WBI_KEYS.stats(),
+        "api_variants": API_VARIANTS.stats(),
+        "upstream_governor": GOVERNOR.stats(),
+        "http_pool": _http_pool_stats(),
+        "merge_cache": MERGE_CACHE.stats(),
+        "cdn": CDN.stats(),
+    }
+
+
+@app.get("/mux/status")
+def mux_status():
+    """合并任务状态：ffmpeg 调度（运行中/排队数、拒绝次数、平均等待与合并耗时）及内置 bmff 重封装统计。"""
+    return {
+        "muxer": MUXER,
+        "counts": MUX_COUNTS,
+        "bmff": BMFF_TIMING.stats(),
+        "ffmpeg": FFMPEG_INFO,
+        **MUX_SCHEDULER.status(),
+    }
+
+
+@app.delete("/cache/pagelist")
+def invalidate_pagelist(
     bvid: str = Query(...),
     user_id: Optional[str] = Query(None),
     token: Optional[str] = Query(None),
     x_user_id: Optional[str] = Header(default=None, alias="X-User-Id"),
     x_token: Optional[str] = Header(default=None, alias="X-Token"),
+    x_admin_token: Optional[str] = Header(default=None, alias="X-Admin-Token"),
 ):
-    """服务端转发下载视频流（单独视频轨道 m4s）。"""
+    """手动失效某个 bvid 的分P/cid 缓存（内存与共享后端，并通知其它 worker）。
+
+    配置了 BILIURL_ADMIN_TOKEN 时需带 X-Admin-Token，否则需有效的登录会话。
+    """
+    if ADMIN_TOKEN:
+        if not hmac.compare_digest((x_admin_token or "").encode("utf-8"), ADMIN_TOKEN.encode("utf-8")):
+            raise HTTPException(status_code=403, detail={"error": "admin_token_required"})
+    else:
+        uid, tok = _get_auth_from_request(user_id, token, x_user_id, x_token)
+        if not _validate_user(uid, tok):
+            raise HTTPException(status_code=401, detail={"error": "invalid_session"})
+    return {"bvid": bvid, "invalidated": PAGELIST_CACHE.invalidate(bvid)}
+
+
+def _resolve_download_track(
+    kind: str,
+    bvid: str,
+    p: int,
+    user_id: Optional[str],
+    token: Optional[str],
+    x_user_id: Optional[str],
+    x_token: Optional[str],
+    codecs: Optional[str] = None,
+    max_bandwidth: Optional[int] = None,
+) -> Tuple[Dict[str, Any], Optional[Dict[str, str]], Dict[str, Any]]:
     cookies, _qn, authed = _auth_cookies_and_qn(user_id, token, x_user_id, x_token)
-    cid = getCid(bvid, cookies=cookies)
+    cid = _get_cid(bvid, cookies, p)
     _j, dash, cookies_eff, authed_eff, _qn_eff = _playurl_dash_with_fallback(
         bvid=bvid, cid=cid, cookies=cookies, authed=authed
     )
-    prefer = Q480 if not authed else None
-    max_id = Q480 if not authed else None
-    prefer = Q480 if not authed_eff else None
-    max_id = Q480 if not authed_eff else None
-    best_video, _best_audio = _pick_video_audio(dash, prefer_video_id=prefer, max_video_id=max_id)
-    url = best_video.get("baseUrl")
-    if not url:
+    best_video, best_audio, selection = _select_tracks(dash, authed_eff, codecs, max_bandwidth)
+    return (best_video if kind == "video" else best_audio), cookies_eff, selection
+
+
+@app.api_route("/download/video", methods=["GET", "HEAD"])
+async def download_video(
+    request: Request,
+    bvid: str = Query(...),
+    p: int = Query(1, ge=1, description="分P序号，从 1 开始"),
+    codecs: Optional[str] = Query(None, description="编码偏好，逗号分隔按优先级，如 av1,hevc,avc,flac"),
+    max_bandwidth: Optional[int] = Query(None, ge=1, description="视频+音频码率上限（bit/s）"),
+    user_id: Optional[str] = Query(None),
+    token: Optional[str] = Query(None),
+    x_user_id: Optional[str] = Header(default=None, alias="X-User-Id"),
+    x_token: Optional[str] = Header(default=None, alias="X-Token"),
+    range_header: Optional[str] = Header(default=None, alias="Range"),
+    if_range: Optional[str] = Header(default=None, alias="If-Range"),
+):
+    """服务端转发下载视频流（单独视频轨道 m4s），支持 Range/If-Range 与 HEAD。"""
+    # Resolution is sync (cache/SQLite/requests); the transfer itself stays on the event loop
+    best_video, cookies_eff, selection = await run_in_threadpool(
+        _resolve_download_track, "video", bvid, p, user_id, token, x_user_id, x_token, codecs, max_bandwidth
+    )
+    urls = _track_urls(best_video)
+    if not urls:
         raise HTTPException(status_code=502, detail={"error": "no_video_url"})
 
-    iterator, content_type = _stream_download(url, cookies_eff)
-    filename = f"video-{bvid}-id{best_video.get('id')}.m4s"
-    headers = {"Content-Disposition": f'attachment; filename="{filename}"'}
-    return StreamingResponse(iterator, media_type=content_type, headers=headers)
+    filename = f"video-{bvid}{_page_suffix(p)}-id{best_video.get('id')}.m4s"
+    response = await _async_proxy_track(
+        request.method, urls, cookies_eff, filename, range_header, if_range, endpoint=request.url.path
+    )
+    response.headers["X-Stream-Selection"] = _selection_header(selection)
+    return response
 
 
-@app.get("/download/audio")
-def download_audio(
+@app.api_route("/download/audio", methods=["GET", "HEAD"])
+async def download_audio(
+    request: Request,
     bvid: str = Query(...),
+    p: int = Query(1, ge=1, description="分P序号，从 1 开始"),
+    codecs: Optional[str] = Query(None, description="编码偏好，逗号分隔按优先级，如 av1,hevc,avc,flac"),
+    max_bandwidth: Optional[int] = Query(None, ge=1, description="视频+音频码率上限（bit/s）"),
     user_id: Optional[str] = Query(None),
     token: Optional[str] = Query(None),
     x_user_id: Optional[str] = Header(default=None, alias="X-User-Id"),
     x_token: Optional[str] = Header(default=None, alias="X-Token"),
+    range_header: Optional[str] = Header(default=None, alias="Range"),
+    if_range: Optional[str] = Header(default=None, alias="If-Range"),
 ):
-    """服务端转发下载音频流（单独音频轨道 m4s）。"""
-    cookies, _qn, authed = _auth_cookies_and_qn(user_id, token, x_user_id, x_token)
-    cid = getCid(bvid, cookies=cookies)
-    _j, dash, cookies_eff, _authed_eff, _qn_eff = _playurl_dash_with_fallback(
-        bvid=bvid, cid=cid, cookies=cookies, authed=authed
+    """服务端转发下载音频流（单独音频轨道 m4s），支持 Range/If-Range 与 HEAD。"""
+    best_audio, cookies_eff, selection = await run_in_threadpool(
+        _resolve_download_track, "audio", bvid, p, user_id, token, x_user_id, x_token, codecs, max_bandwidth
     )
-    _best_video, best_audio = _pick_video_audio(dash)
-    url = best_audio.get("baseUrl")
-    if not url:
+    urls = _track_urls(best_audio)
+    if not urls:
         raise HTTPException(status_code=502, detail={"error": "no_audio_url"})
 
-    iterator, content_type = _stream_download(url, cookies_eff)
-    filename = f"audio-{bvid}.m4s"
-    headers = {"Content-Disposition": f'attachment; filename="{filename}"'}
-    return StreamingResponse(iterator, media_type=content_type, headers=headers)
+    filename = f"audio-{bvid}{_page_suffix(p)}.m4s"
+    response = await _async_proxy_track(
+        request.method, urls, cookies_eff, filename, range_header, if_range, endpoint=request.url.path
+    )
+    response.headers["X-Stream-Selection"] = _selection_header(selection)
+    return response
 
 
 @app.post("/merge/mp4")
@@ -772,7 +3831,7 @@ def merge_mp4(
     video_file: UploadFile = File(...),
     audio_file: UploadFile = File(...),
 ):
-    """上传 video.m4s + audio.m4s，在服务端用 ffmpeg 封装合并成 mp4 并返回下载。"""
+    """上传 video.m4s + audio.m4s，在服务端封装合并成 mp4 并返回下载（内置 bmff 重封装，必要时回退 ffmpeg）。"""
 
     tmp_dir = tempfile.mkdtemp(prefix="mux_")
     video_path = os.path.join(tmp_dir, "video.m4s")
@@ -794,7 +3853,7 @@ def merge_mp4(
                     break
                 f.write(chunk)
 
-        _ffmpeg_mux_to_mp4(video_path, audio_path, out_path)
+        _mux_to_mp4(video_path, audio_path, out_path)
 
         def _iter_mp4():
             try:
@@ -825,7 +3884,7 @@ def merge_mp4(
         safe_name = "".join([c for c in bvid if c.isalnum() or c in ("-", "_", ".")]) or "output"
         headers = {"Content-Disposition": f'attachment; filename="{safe_name}.mp4"'}
         return StreamingResponse(_iter_mp4(), media_type="video/mp4", headers=headers)
-    except HTTPException:
+    except (HTTPException, _UpstreamThrottled):
         raise
     except Exception as e:
         # Cleanup on unexpected error
@@ -851,140 +3910,353 @@ def merge_mp4(
 @app.get("/merge/mp4/remote")
 def merge_mp4_remote(
     bvid: str = Query(...),
+    p: int = Query(1, ge=1, description="分P序号，从 1 开始"),
+    stream: bool = Query(False, description="流式合并：边拉取边输出 fragmented MP4，不落盘"),
+    codecs: Optional[str] = Query(None, description="编码偏好，逗号分隔按优先级，如 av1,hevc,avc,flac"),
+    max_bandwidth: Optional[int] = Query(None, ge=1, description="视频+音频码率上限（bit/s）"),
     user_id: Optional[str] = Query(None),
     token: Optional[str] = Query(None),
     x_user_id: Optional[str] = Header(default=None, alias="X-User-Id"),
     x_token: Optional[str] = Header(default=None, alias="X-Token"),
 ):
-    """服务端根据 bvid 拉取 video.m4s + audio.m4s，并用 ffmpeg 合并成 mp4 返回下载。"""
+    """服务端根据 bvid 拉取 video.m4s + audio.m4s，合并成 mp4 返回下载（内置 bmff 重封装，必要时回退 ffmpeg）。
+
+    stream=1 时边拉取边输出 fragmented MP4：优先内置重封装直接读上游响应，
+    否则（仅 POSIX）轨道通过管道喂给 ffmpeg。
+    """
 
     cookies, _qn, authed = _auth_cookies_and_qn(user_id, token, x_user_id, x_token)
-    cid = getCid(bvid, cookies=cookies)
+    cid = _get_cid(bvid, cookies, p)
     _j, dash, cookies_eff, authed_eff, _qn_eff = _playurl_dash_with_fallback(
         bvid=bvid, cid=cid, cookies=cookies, authed=authed
     )
 
-    prefer = Q480 if not authed_eff else None
-    max_id = Q480 if not authed_eff else None
-    best_video, best_audio = _pick_video_audio(dash, prefer_video_id=prefer, max_video_id=max_id)
+    best_video, best_audio, selection = _select_tracks(dash, authed_eff, codecs, max_bandwidth)
 
-    video_url = best_video.get("baseUrl")
-    audio_url = best_audio.get("baseUrl")
-    if not video_url or not audio_url:
+    video_urls = _track_urls(best_video)
+    audio_urls = _track_urls(best_audio)
+    if not video_urls or not audio_urls:
         raise HTTPException(status_code=502, detail={"error": "no_stream_url"})
 
-    tmp_dir = tempfile.mkdtemp(prefix="mux_remote_")
-    video_path = os.path.join(tmp_dir, "video.m4s")
-    audio_path = os.path.join(tmp_dir, "audio.m4s")
-    out_path = os.path.join(tmp_dir, "merged.mp4")
-
-    try:
-        _download_to_file(video_url, cookies_eff, video_path)
-        _download_to_file(audio_url, cookies_eff, audio_path)
-        _ffmpeg_mux_to_mp4(video_path, audio_path, out_path)
+    safe_name = "".join([c for c in bvid if c.isalnum() or c in ("-", "_", ".")]) or "output"
+    filename = f"merged-{safe_name}{_page_suffix(p)}.mp4"
+    headers = {
+        "Content-Disposition": f'attachment; filename="{filename}"',
+        "X-Stream-Selection": _selection_header(selection),
+    }
 
-        def _iter_mp4():
-            try:
-                with open(out_path, "rb") as f:
-                    while True:
-                        buf = f.read(1024 * 256)
-                        if not buf:
-                            break
-                        yield buf
-            finally:
-                try:
-                    for p in (video_path, audio_path, out_path):
-                        if os.path.exists(p):
-                            os.remove(p)
-                    if os.path.isdir(tmp_dir):
-                        os.rmdir(tmp_dir)
-                except Exception:
-                    pass
+    cache_key = _merge_cache_key(bvid, cid, best_video, best_audio)
+    cached = MERGE_CACHE.lookup(cache_key)
+    if cached:
+        # FileResponse handles Range/206 and uses zero-copy pathsend where the server supports it
+        return FileResponse(cached, media_type="video/mp4", filename=filename, headers=headers)
+
+    if MUXER == "ffmpeg":
+        MUX_SCHEDULER.check_capacity()
+
+    if stream:
+        background: Optional[BackgroundTask] = None
+        iterator = _bmff_stream_mux(video_urls, audio_urls, cookies_eff) if MUXER != "ffmpeg" else None
+        if iterator is None and MUXER != "bmff" and os.name == "posix":
+            iterator = _ffmpeg_stream_mux(video_urls, audio_urls, cookies_eff)
+            # Also runs when the body was never iterated (client gone before the first chunk)
+            background = BackgroundTask(iterator.close)
+        if iterator is not None:
+            return StreamingResponse(
+                _metered(iterator, "/merge/mp4/remote"), media_type="video/mp4", headers=headers, background=background
+            )
 
-        safe_name = "".join([c for c in bvid if c.isalnum() or c in ("-", "_", ".")]) or "output"
-        filename = f"merged-{safe_name}.mp4"
-        headers = {"Content-Disposition": f'attachment; filename="{filename}"'}
-        return StreamingResponse(_iter_mp4(), media_type="video/mp4", headers=headers)
-    except HTTPException:
+    try:
+        # Concurrent requests for the same key wait on the one in-progress merge
+        path = _MERGE_FLIGHT.do(
+            cache_key, lambda: _build_merged_mp4(cache_key, video_urls, audio_urls, cookies_eff)
+        )
+    except (HTTPException, _UpstreamThrottled):
         raise
     except Exception as e:
-        try:
-            for p in (video_path, audio_path, out_path):
-                if os.path.exists(p):
-                    os.remove(p)
-            if os.path.isdir(tmp_dir):
-                os.rmdir(tmp_dir)
-        except Exception:
-            pass
         raise HTTPException(status_code=500, detail={"error": "merge_remote_failed", "message": str(e)})
+    return FileResponse(path, media_type="video/mp4", filename=filename, headers=headers)
 
 
 @app.get("/stream/video")
 def stream_video(
     bvid: str = Query(...),
+    p: int = Query(1, ge=1, description="分P序号，从 1 开始"),
+    codecs: Optional[str] = Query(None, description="编码偏好，逗号分隔按优先级，如 av1,hevc,avc,flac"),
+    max_bandwidth: Optional[int] = Query(None, ge=1, description="视频+音频码率上限（bit/s）"),
     user_id: Optional[str] = Query(None),
     token: Optional[str] = Query(None),
     x_user_id: Optional[str] = Header(default=None, alias="X-User-Id"),
     x_token: Optional[str] = Header(default=None, alias="X-Token"),
 ):
     """返回视频直链。未提供/无效鉴权时固定 480p；提供有效鉴权时返回最高可用。"""
-    _cleanup_login_flows()
-
-    uid, tok = _get_auth_from_request(user_id, token, x_user_id, x_token)
-    user_sess = _validate_user(uid, tok)
-
-    cookies = user_sess.cookie_dict if user_sess else None
-    authed = bool(user_sess)
+    cookies, _qn, authed = _auth_cookies_and_qn(user_id, token, x_user_id, x_token)
 
-    cid = getCid(bvid, cookies=cookies)
+    cid = _get_cid(bvid, cookies, p)
     _j, dash, _cookies_eff, authed_eff, qn_eff = _playurl_dash_with_fallback(
         bvid=bvid, cid=cid, cookies=cookies, authed=authed
     )
 
-    prefer = Q480 if not authed_eff else None
-    max_id = Q480 if not authed_eff else None
-    best_video, _best_audio = _pick_video_audio(dash, prefer_video_id=prefer, max_video_id=max_id)
+    best_video, _best_audio, selection = _select_tracks(dash, authed_eff, codecs, max_bandwidth)
+    # Mirrors ordered by measured CDN latency
+    mirrors = CDN.rank(_track_urls(best_video))
 
     return {
         "bvid": bvid,
+        "p": p,
         "cid": cid,
         "auth": bool(authed_eff),
         "qn_request": qn_eff,
         "qn_selected": best_video.get("id"),
-        "url": best_video.get("baseUrl"),
-        "backup_url": (best_video.get("backupUrl") or []),
+        "url": mirrors[0] if mirrors else None,
+        "backup_url": mirrors[1:],
+        "selection": selection,
     }
 
 
 @app.get("/stream/audio")
 def stream_audio(
     bvid: str = Query(...),
+    p: int = Query(1, ge=1, description="分P序号，从 1 开始"),
+    codecs: Optional[str] = Query(None, description="编码偏好，逗号分隔按优先级，如 av1,hevc,avc,flac"),
+    max_bandwidth: Optional[int] = Query(None, ge=1, description="视频+音频码率上限（bit/s）"),
     user_id: Optional[str] = Query(None),
     token: Optional[str] = Query(None),
     x_user_id: Optional[str] = Header(default=None, alias="X-User-Id"),
     x_token: Optional[str] = Header(default=None, alias="X-Token"),
 ):
     """返回音频直链。未提供/无效鉴权时用游客（无 cookie）；提供有效鉴权时用登录 cookie。"""
-    _cleanup_login_flows()
+    cookies, _qn, authed = _auth_cookies_and_qn(user_id, token, x_user_id, x_token)
 
-    uid, tok = _get_auth_from_request(user_id, token, x_user_id, x_token)
-    user_sess = _validate_user(uid, tok)
+    cid = _get_cid(bvid, cookies, p)
+    _j, dash, _cookies_eff, authed_eff, qn_eff = _playurl_dash_with_fallback(
+        bvid=bvid, cid=cid, cookies=cookies, authed=authed
+    )
 
-    cookies = user_sess.cookie_dict if user_sess else None
-    authed = bool(user_sess)
+    _best_video, best_audio, selection = _select_tracks(dash, authed_eff, codecs, max_bandwidth)
+    mirrors = CDN.rank(_track_urls(best_audio))
+
+    return {
+        "bvid": bvid,
+        "p": p,
+        "cid": cid,
+        "auth": bool(authed_eff),
+        "qn_request": qn_eff,
+        "url": mirrors[0] if mirrors else None,
+        "backup_url": mirrors[1:],
+        "selection": selection,
+    }
 
-    cid = getCid(bvid, cookies=cookies)
+
+@app.get("/stream/dash")
+def stream_dash(
+    bvid: str = Query(...),
+    p: int = Query(1, ge=1, description="分P序号，从 1 开始"),
+    formats: bool = Query(False, description="同时列出所有可用的画质/编码组合"),
+    codecs: Optional[str] = Query(None, description="编码偏好，逗号分隔按优先级，如 av1,hevc,avc,flac"),
+    max_bandwidth: Optional[int] = Query(None, ge=1, description="视频+音频码率上限（bit/s）"),
+    user_id: Optional[str] = Query(None),
+    token: Optional[str] = Query(None),
+    x_user_id: Optional[str] = Header(default=None, alias="X-User-Id"),
+    x_token: Optional[str] = Header(default=None, alias="X-Token"),
+):
+    """一次解析同时返回视频与音频直链（含 backup_url），可选列出全部可用轨道。"""
+    cookies, _qn, authed = _auth_cookies_and_qn(user_id, token, x_user_id, x_token)
+    cid = _get_cid(bvid, cookies, p)
     _j, dash, _cookies_eff, authed_eff, qn_eff = _playurl_dash_with_fallback(
         bvid=bvid, cid=cid, cookies=cookies, authed=authed
     )
 
-    _best_video, best_audio = _pick_video_audio(dash)
+    best_video, best_audio, selection = _select_tracks(dash, authed_eff, codecs, max_bandwidth)
 
-    return {
+    result: Dict[str, Any] = {
         "bvid": bvid,
+        "p": p,
         "cid": cid,
         "auth": bool(authed_eff),
         "qn_request": qn_eff,
-        "url": best_audio.get("baseUrl"),
-        "backup_url": (best_audio.get("backupUrl") or []),
+        "qn_selected": best_video.get("id"),
+        "video": _track_info(best_video),
+        "audio": _track_info(best_audio),
+        "selection": selection,
+    }
+    if formats:
+        result["formats"] = {
+            "video": [_track_info(v, with_urls=False) for v in (dash.get("video") or [])],
+            "audio": [_track_info(a, with_urls=False) for a in biliurl.audioTracks(dash)],
+        }
+    return result
+
+
+_RESOLVE_POOL = ThreadPoolExecutor(max_workers=PAGE_RESOLVE_WORKERS, thread_name_prefix="biliurl-resolve")
+
+
+def _resolve_page(
+    bvid: str,
+    page: Dict[str, Any],
+    cookies: Optional[Dict[str, str]],
+    authed: bool,
+    codecs: Optional[str],
+    max_bandwidth: Optional[int],
+    max_qn: Optional[int] = None,
+) -> Dict[str, Any]:
+    entry: Dict[str, Any] = {
+        "p": page.get("page"),
+        "cid": str(page.get("cid")),
+        "part": page.get("part"),
+        "duration": page.get("duration"),
+    }
+    try:
+        # Bulk resolution (/stream/pages, /stream/batch) yields to single-stream requests
+        with _upstream_priority("batch"):
+            _j, dash, _cookies_eff, authed_eff, qn_eff = _playurl_dash_with_fallback(
+                bvid=bvid, cid=entry["cid"], cookies=cookies, authed=authed
+            )
+        best_video, best_audio, selection = _select_tracks(dash, authed_eff, codecs, max_bandwidth, max_qn)
+    except (HTTPException, _UpstreamThrottled) as e:
+        # One broken page must not fail the whole listing
+        entry["error"] = e.detail
+        return entry
+    except Exception as e:
+        # e.g. upstream connection errors or an unexpected dash shape: same as /stream/batch
+        entry["error"] = {"error": "resolve_failed", "message": str(e)}
+        return entry
+    entry.update(
+        auth=bool(authed_eff),
+        qn_request=qn_eff,
+        qn_selected=best_video.get("id"),
+        video=_track_info(best_video),
+        audio=_track_info(best_audio),
+        selection=selection,
+    )
+    return entry
+
+
+@app.get("/stream/pages")
+def stream_pages(
+    bvid: str = Query(...),
+    codecs: Optional[str] = Query(None, description="编码偏好，逗号分隔按优先级，如 av1,hevc,avc,flac"),
+    max_bandwidth: Optional[int] = Query(None, ge=1, description="视频+音频码率上限（bit/s）"),
+    user_id: Optional[str] = Query(None),
+    token: Optional[str] = Query(None),
+    x_user_id: Optional[str] = Header(default=None, alias="X-User-Id"),
+    x_token: Optional[str] = Header(default=None, alias="X-Token"),
+):
+    """并发解析一个 bvid 的所有分P，一次返回每一P的视频与音频直链。单P失败时该P带 error 字段。"""
+    cookies, _qn, authed = _auth_cookies_and_qn(user_id, token, x_user_id, x_token)
+    _parse_codecs(codecs)  # reject bad values before fanning out
+    # Copies: the page dicts are shared with the pagelist cache
+    pages = [dict(page, page=page.get("page") or index + 1) for index, page in enumerate(_get_pages(bvid, cookies))]
+    # copy_context: per-page stages still land in this request's Server-Timing
+    futures = [
+        _RESOLVE_POOL.submit(copy_context().run, _resolve_page, bvid, page, cookies, authed, codecs, max_bandwidth)
+        for page in pages
+    ]
+    results = [f.result() for f in futures]
+    return {
+        "bvid": bvid,
+        "count": len(results),
+        "failed": sum(1 for r in results if "error" in r),
+        "pages": results,
     }
+
+
+class BatchItem(BaseModel):
+    bvid: str
+    pages: List[Annotated[int, Field(ge=1)]] = Field(default_factory=lambda: [1], description="分P序号列表，默认 [1]")
+    qn: Optional[int] = Field(None, description="该条目的最高画质 id")
+
+    @field_validator("pages")
+    @classmethod
+    def _unique_pages(cls, pages: List[int]) -> List[int]:
+        # Repeats would resolve (and count against BATCH_MAX_ITEMS) more than once
+        return list(dict.fromkeys(pages))
+
+
+class BatchRequest(BaseModel):
+    items: List[BatchItem] = Field(default_factory=list)
+    bvids: List[str] = Field(default_factory=list, description="简写：只解析第 1P")
+    qn: Optional[int] = Field(None, description="默认最高画质 id")
+    codecs: Optional[str] = None
+    max_bandwidth: Optional[int] = Field(None, ge=1)
+
+
+# Shared by every batch so concurrent batches can't multiply upstream load; the work
+# runs on its own threads so a big batch can't starve anyio's request threadpool
+_BATCH_SEMAPHORE = asyncio.Semaphore(BATCH_CONCURRENCY)
+_BATCH_POOL = ThreadPoolExecutor(max_workers=BATCH_CONCURRENCY, thread_name_prefix="biliurl-batch")
+
+
+def _resolve_batch_entry(
+    bvid: str,
+    p: int,
+    cookies: Optional[Dict[str, str]],
+    authed: bool,
+    codecs: Optional[str],
+    max_bandwidth: Optional[int],
+    max_qn: Optional[int],
+) -> Dict[str, Any]:
+    try:
+        with _upstream_priority("batch"):
+            page = _page_entry(_get_pages(bvid, cookies), p)
+    except (HTTPException, _UpstreamThrottled) as e:
+        return {"bvid": bvid, "p": p, "error": e.detail}
+    entry = _resolve_page(bvid, dict(page, page=p), cookies, authed, codecs, max_bandwidth, max_qn)
+    return {"bvid": bvid, **entry}
+
+
+@app.post("/stream/batch")
+async def stream_batch(
+    body: BatchRequest,
+    user_id: Optional[str] = Query(None),
+    token: Optional[str] = Query(None),
+    x_user_id: Optional[str] = Header(default=None, alias="X-User-Id"),
+    x_token: Optional[str] = Header(default=None, alias="X-Token"),
+):
+    """批量解析多个 bvid（可指定分P与画质上限），以 NDJSON 流式返回，每解析完一条输出一行。
+
+    每行带 index（请求中的顺序）；失败的条目带 error 字段，不影响其他条目。
+    """
+    items = list(body.items) + [BatchItem(bvid=bvid) for bvid in body.bvids]
+    jobs = [(item.bvid, p, item.qn if item.qn is not None else body.qn) for item in items for p in item.pages]
+    if not jobs:
+        raise HTTPException(status_code=400, detail={"error": "empty_batch"})
+    if len(jobs) > BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail={"error": "batch_too_large", "max_items": BATCH_MAX_ITEMS})
+    _parse_codecs(body.codecs)
+    cookies, _qn, authed = await run_in_threadpool(_auth_cookies_and_qn, user_id, token, x_user_id, x_token)
+
+    async def _run(index: int, bvid: str, p: int, max_qn: Optional[int]) -> Dict[str, Any]:
+        async with _BATCH_SEMAPHORE:
+            try:
+                # copy_context: the handler's request flags still apply on the pool thread
+                entry = await asyncio.wrap_future(
+                    _BATCH_POOL.submit(
+                        copy_context().run,
+                        _resolve_batch_entry,
+                        bvid,
+                        p,
+                        cookies,
+                        authed,
+                        body.codecs,
+                        body.max_bandwidth,
+                        max_qn,
+                    )
+                )
+            except Exception as e:
+                # e.g. upstream connection errors: report on this line, keep the stream going
+                entry = {"bvid": bvid, "p": p, "error": {"error": "resolve_failed", "message": str(e)}}
+        return {"index": index, **entry}
+
+    async def _lines() -> AsyncIterator[bytes]:
+        tasks = [asyncio.ensure_future(_run(i, bvid, p, qn)) for i, (bvid, p, qn) in enumerate(jobs)]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                entry = await next_done
+                yield (json.dumps(entry, ensure_ascii=False, separators=(",", ":")) + "\n").encode("utf-8")
+        finally:
+            # Client went away: drop what hasn't started
+            for task in tasks:
+                task.cancel()
+
+    return StreamingResponse(_lines(), media_type="application/x-ndjson")
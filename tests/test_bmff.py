@@ -0,0 +1,171 @@
+"""bmff.remux against synthetic DASH tracks from bench/fmp4.py.
+
+Every sample the output's trun boxes point at must be the original sample's bytes,
+inside the mdat that follows its moof.
+"""
+
+import io
+import os
+import struct
+import sys
+from typing import Dict, Iterator, List, Tuple
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "bench"))
+
+import bmff  # noqa: E402
+import fmp4  # noqa: E402
+
+_TFHD_BASE_DATA_OFFSET = 0x000001
+_TFHD_DEFAULT_BASE_IS_MOOF = 0x020000
+_TRUN_DATA_OFFSET = 0x000001
+_TRUN_FIRST_SAMPLE_FLAGS = 0x000004
+_TRUN_ENTRY_FLAGS = (0x000100, 0x000200, 0x000400, 0x000800)
+_TRUN_SAMPLE_SIZE = 0x000200
+
+
+def _boxes(buf: bytes, start: int = 0, end: int = -1) -> Iterator[Tuple[bytes, int, int, int]]:
+    """(type, box_start, payload_start, box_end); 32-bit sizes only, as fmp4.py writes."""
+    end = len(buf) if end < 0 else end
+    pos = start
+    while pos < end:
+        size, box_type = struct.unpack_from(">I4s", buf, pos)
+        assert size >= 8 and pos + size <= end, f"bad {box_type!r} box at {pos}"
+        yield box_type, pos, pos + 8, pos + size
+        pos += size
+
+
+def _child(buf: bytes, start: int, end: int, box_type: bytes) -> Tuple[int, int, int]:
+    for t, s, p, e in _boxes(buf, start, end):
+        if t == box_type:
+            return s, p, e
+    raise AssertionError(f"no {box_type!r} in {start}-{end}")
+
+
+def _samples(buf: bytes) -> Dict[int, List[bytes]]:
+    """track_ID -> sample bytes in file order, resolved through tfhd/trun offsets."""
+    out: Dict[int, List[bytes]] = {}
+    top = list(_boxes(buf))
+    for i, (box_type, moof_start, payload, moof_end) in enumerate(top):
+        if box_type != b"moof":
+            continue
+        mdat = next(b for b in top[i + 1 :] if b[0] == b"mdat")
+        _s, traf, traf_end = _child(buf, payload, moof_end, b"traf")
+        _s, tfhd, _e = _child(buf, traf, traf_end, b"tfhd")
+        tfhd_flags = struct.unpack_from(">I", buf, tfhd)[0] & 0xFFFFFF
+        track_id = struct.unpack_from(">I", buf, tfhd + 4)[0]
+        base = moof_start
+        if tfhd_flags & _TFHD_BASE_DATA_OFFSET:
+            base = struct.unpack_from(">Q", buf, tfhd + 8)[0]
+        _s, trun, _e = _child(buf, traf, traf_end, b"trun")
+        flags = struct.unpack_from(">I", buf, trun)[0] & 0xFFFFFF
+        count = struct.unpack_from(">I", buf, trun + 4)[0]
+        assert flags & _TRUN_DATA_OFFSET and flags & _TRUN_SAMPLE_SIZE
+        pos = base + struct.unpack_from(">i", buf, trun + 8)[0]
+        entry = trun + 12 + (4 if flags & _TRUN_FIRST_SAMPLE_FLAGS else 0)
+        fields = [f for f in _TRUN_ENTRY_FLAGS if flags & f]
+        size_index = fields.index(_TRUN_SAMPLE_SIZE)
+        for n in range(count):
+            size = struct.unpack_from(">I", buf, entry + 4 * (n * len(fields) + size_index))[0]
+            # Samples must come from this fragment's own mdat payload
+            assert mdat[2] <= pos and pos + size <= mdat[3]
+            out.setdefault(track_id, []).append(buf[pos : pos + size])
+            pos += size
+    return out
+
+
+def _gapped_fragment(
+    seq: int, file_pos: int, decode_time: int, payload: bytes, gap_box: bytes, absolute: bool
+) -> bytes:
+    # A box between moof and mdat that the remuxer drops; tfhd carries either an
+    # absolute base_data_offset (the moof's own position) or default-base-is-moof
+    sizes = [len(payload) // 2, len(payload) - len(payload) // 2]
+    samples = b"".join(struct.pack(">II", 512, size) for size in sizes)
+    tfdt = fmp4._full_box(b"tfdt", 1, 0, struct.pack(">Q", decode_time))
+    tfhd_len = 8 + 4 + 4 + (8 if absolute else 0)
+    trun_len = 8 + 4 + 4 + 4 + len(samples)
+    moof_len = 8 + 16 + 8 + tfhd_len + len(tfdt) + trun_len
+    if absolute:
+        tfhd = fmp4._full_box(b"tfhd", 0, _TFHD_BASE_DATA_OFFSET, struct.pack(">IQ", 1, file_pos))
+    else:
+        tfhd = fmp4._full_box(b"tfhd", 0, _TFHD_DEFAULT_BASE_IS_MOOF, struct.pack(">I", 1))
+    data_offset = moof_len + len(gap_box) + 8
+    trun = fmp4._full_box(b"trun", 0, 0x000301, struct.pack(">Ii", len(sizes), data_offset), samples)
+    mfhd = fmp4._full_box(b"mfhd", 0, 0, struct.pack(">I", seq))
+    moof = fmp4._box(b"moof", mfhd, fmp4._box(b"traf", tfhd, tfdt, trun))
+    assert len(moof) == moof_len
+    return moof + gap_box + fmp4._box(b"mdat", payload)
+
+
+def _gapped_track(absolute: bool, fragments: int = 4) -> bytes:
+    sidx = fmp4._full_box(b"sidx", 0, 0, struct.pack(">IIII", 1, 15360, 0, 0), b"\x00" * 16)
+    out = bytearray(fmp4._init_segment("video", 1, 15360, 512))
+    # Top-level sidx right after the init segment, as Bilibili serves it
+    out += sidx
+    for i in range(fragments):
+        payload = bytes([0x41 + i]) * 3000 + os.urandom(1000)
+        out += _gapped_fragment(i + 1, len(out), i * 1024, payload, sidx, absolute)
+    return bytes(out)
+
+
+def _remux(video: bytes, audio: bytes) -> bytes:
+    return b"".join(bmff.remux(io.BytesIO(video), io.BytesIO(audio)))
+
+
+def _check(video: bytes, audio: bytes, out: bytes) -> None:
+    top = [b[0] for b in _boxes(out)]
+    assert top[:2] == [b"ftyp", b"moov"]
+    assert top[2:] == [b"moof", b"mdat"] * ((len(top) - 2) // 2)
+
+    _s, moov, moov_end = _child(out, 0, len(out), b"moov")
+    children = [t for t, *_rest in _boxes(out, moov, moov_end)]
+    assert children.count(b"trak") == 2
+    _s, mvex, mvex_end = _child(out, moov, moov_end, b"mvex")
+    trex_ids = [struct.unpack_from(">I", out, p + 4)[0] for t, _s, p, _e in _boxes(out, mvex, mvex_end) if t == b"trex"]
+    assert sorted(trex_ids) == [1, 2]
+
+    sequences = []
+    for box_type, _s, payload, end in _boxes(out):
+        if box_type == b"moof":
+            _s, mfhd, _e = _child(out, payload, end, b"mfhd")
+            sequences.append(struct.unpack_from(">I", out, mfhd + 4)[0])
+    assert sequences == list(range(1, len(sequences) + 1))
+
+    got = _samples(out)
+    assert got[1] == _samples(video)[1]
+    assert got[2] == _samples(audio)[1]
+
+
+def test_remux_make_pair():
+    video, audio = fmp4.make_pair(video_bytes=1 << 20, audio_bytes=256 << 10)
+    _check(video, audio, _remux(video, audio))
+
+
+@pytest.mark.parametrize("absolute", [False, True])
+def test_remux_sidx_between_moof_and_mdat(absolute):
+    video = _gapped_track(absolute)
+    audio = fmp4.make_track("audio", 256 << 10)
+    _check(video, audio, _remux(video, audio))
+
+
+@pytest.mark.parametrize("variant", ["make_pair", "relative", "absolute"])
+def test_remux_files_matches_streaming(tmp_path, variant):
+    if variant == "make_pair":
+        video = fmp4.make_track("video", 1 << 20)
+    else:
+        video = _gapped_track(absolute=variant == "absolute")
+    audio = fmp4.make_track("audio", 256 << 10)
+    (tmp_path / "v.m4s").write_bytes(video)
+    (tmp_path / "a.m4s").write_bytes(audio)
+    out = tmp_path / "out.mp4"
+    bmff.remux_files(str(tmp_path / "v.m4s"), str(tmp_path / "a.m4s"), str(out))
+    assert out.read_bytes() == _remux(video, audio)
+
+
+def test_rejects_mdat_without_moof():
+    video = fmp4._init_segment("video", 1, 15360, 512) + fmp4._box(b"mdat", b"\x00" * 16)
+    with pytest.raises(bmff.BmffError):
+        _remux(video, fmp4.make_track("audio", 64 << 10))
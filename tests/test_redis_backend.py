@@ -0,0 +1,186 @@
+"""_RedisBackend against a throwaway local redis-server.
+
+Skipped unless both the redis package and a redis-server binary are available.
+"""
+
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+import pytest
+
+redis = pytest.importorskip("redis")
+if shutil.which("redis-server") is None:
+    pytest.skip("redis-server not installed", allow_module_level=True)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("BILIURL_DATA_DIR", tempfile.mkdtemp(prefix="biliurl-test-"))
+
+import server  # noqa: E402
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+@pytest.fixture(scope="module")
+def redis_url():
+    port = _free_port()
+    proc = subprocess.Popen(
+        ["redis-server", "--port", str(port), "--bind", "127.0.0.1", "--save", "", "--appendonly", "no"],
+        stdout=subprocess.DEVNULL,
+    )
+    url = f"redis://127.0.0.1:{port}/0"
+    client = redis.Redis.from_url(url)
+    deadline = time.monotonic() + 10
+    while True:
+        try:
+            client.ping()
+            break
+        except redis.ConnectionError:
+            if time.monotonic() > deadline:
+                proc.kill()
+                raise
+            time.sleep(0.05)
+    yield url
+    proc.terminate()
+    proc.wait()
+
+
+@pytest.fixture
+def backend(redis_url):
+    return server._RedisBackend(redis_url, f"biliurl-test-{uuid.uuid4().hex}:")
+
+
+def _wait_for(predicate, timeout: float = 5.0) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.02)
+    return False
+
+
+def test_get_returns_value_and_remaining_ttl(backend):
+    backend.set("pagelist", "BV1xx411c7mD", '[{"cid":1}]', 60)
+    value, remaining = backend.get("pagelist", "BV1xx411c7mD")
+    assert value == '[{"cid":1}]'
+    assert 0 < remaining <= 60
+    assert backend.get("pagelist", "BV1missing") is None
+    assert backend.stats()["hits"] == 1
+    assert backend.stats()["misses"] == 1
+
+
+def test_values_expire(backend):
+    backend.set("playurl", "k", "{}", 0.05)
+    assert _wait_for(lambda: backend.get("playurl", "k") is None)
+
+
+def test_delete(backend):
+    backend.set("session", "k", "v", 60)
+    assert backend.delete("session", "k")
+    assert not backend.delete("session", "k")
+    assert backend.get("session", "k") is None
+
+
+def test_invalidations_reach_other_workers(redis_url, backend):
+    other = server._RedisBackend(redis_url, backend.prefix)
+    other.start()
+    try:
+        # Published events are only delivered once the listener has subscribed
+        assert _wait_for(lambda: backend.client.pubsub_numsub(backend.channel)[0][1] >= 1)
+        backend.publish("pagelist", "BV1xx411c7mD")
+        backend.publish("session", "user-key")
+        events = []
+        assert _wait_for(lambda: events.extend(other.poll()) or len(events) >= 2)
+        assert events == [("pagelist", "BV1xx411c7mD"), ("session", "user-key")]
+    finally:
+        server._BACKGROUND_STOP.set()
+        other._thread.join(timeout=5)
+        server._BACKGROUND_STOP.clear()
+
+
+def test_session_ttl_counts_from_login(backend, monkeypatch):
+    monkeypatch.setattr(server, "SHARED", backend)
+    server._db_init()
+    user_key = uuid.uuid4().hex
+    created_at = server._now() - server.SESSION_MAX_AGE + 100
+    blob = server._encrypt_json({"cookies": {}})
+    server._db_execute(
+        "INSERT INTO sessions(user_key, payload, created_at, checked_at) VALUES (?, ?, ?, ?)",
+        (user_key, blob, created_at, created_at),
+    )
+    assert server._store_session_payload(
+        user_key, {"cookies": {"SESSDATA": "x"}}, server._now(), expect=blob, created_at=created_at
+    )
+    _value, remaining = backend.get("session", user_key)
+    assert remaining <= 100
+
+
+def test_logout_on_one_host_ends_the_session_on_another(redis_url, backend, monkeypatch):
+    # "Host B": its own SHARED backend and store.db row; "host A" logs the user out
+    host_a = server._RedisBackend(redis_url, backend.prefix)
+    host_b = server._RedisBackend(redis_url, backend.prefix)
+    monkeypatch.setattr(server, "SHARED", host_b)
+    server._db_init()
+    user_id, token = uuid.uuid4().hex, "t"
+    user_key = server._user_key(user_id)
+    now = server._now()
+    blob = server._encrypt_json(
+        {"user_id": user_id, "token": token, "created_at": now, "cookies": {"SESSDATA": "x"}}
+    )
+    server._db_execute(
+        "INSERT INTO sessions(user_key, payload, created_at, checked_at) VALUES (?, ?, ?, ?)",
+        (user_key, blob, now, now),
+    )
+    host_a.set("session", user_key, blob.decode("ascii"), server.SESSION_MAX_AGE)
+    assert server._validate_user(user_id, token) is not None
+
+    host_b.start()
+    try:
+        assert _wait_for(lambda: host_a.client.pubsub_numsub(host_a.channel)[0][1] >= 1)
+        # What /logout does on host A, minus host A's own store.db
+        host_a.delete("session", user_key)
+        host_a.publish("logout", user_key)
+
+        def _applied() -> bool:
+            server._apply_invalidations()
+            return server._db_fetchone("SELECT 1 FROM sessions WHERE user_key = ?", (user_key,)) is None
+
+        assert _wait_for(_applied)
+    finally:
+        server._BACKGROUND_STOP.set()
+        host_b._thread.join(timeout=5)
+        server._BACKGROUND_STOP.clear()
+
+    server.USER_SESSIONS_MISSING.pop(user_id)
+    assert server._validate_user(user_id, token) is None
+
+
+def test_missed_logout_does_not_resurrect_the_session(redis_url, backend, monkeypatch):
+    monkeypatch.setattr(server, "SHARED", backend)
+    server._db_init()
+    user_id, token = uuid.uuid4().hex, "t"
+    user_key = server._user_key(user_id)
+    now = server._now()
+    blob = server._encrypt_json(
+        {"user_id": user_id, "token": token, "created_at": now, "cookies": {"SESSDATA": "x"}}
+    )
+    # This host still has the row, but the shared store no longer has the session
+    server._db_execute(
+        "INSERT INTO sessions(user_key, payload, created_at, checked_at) VALUES (?, ?, ?, ?)",
+        (user_key, blob, now, 0.0),
+    )
+    assert server._validate_user(user_id, token) is None
+
+    monkeypatch.setattr(server, "_nav_is_login", lambda cookies: pytest.fail("checked a logged-out session"))
+    server._check_session_health()
+    assert server._db_fetchone("SELECT 1 FROM sessions WHERE user_key = ?", (user_key,)) is None
+    assert backend.get("session", user_key) is None
@@ -0,0 +1,32 @@
+"""WBI signing against the reference vector published in bilibili-API-collect (docs/misc/sign/wbi.md)."""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import biliurl  # noqa: E402
+
+IMG_KEY = "7cd084941338484aae1ad9425b84077c"
+SUB_KEY = "4932caff0ff746eab6f01bf08b70ac45"
+MIXIN_KEY = "ea1db124af3c7062474693fa704f4ff8"
+
+
+def test_mixin_key():
+    assert biliurl.getMixinKey(IMG_KEY, SUB_KEY) == MIXIN_KEY
+
+
+def test_sign_reference_vector():
+    signed = biliurl.signWbiParams({"foo": "114", "bar": "514", "zab": 1919810}, MIXIN_KEY, wts=1702204169)
+    assert signed == {
+        "bar": "514",
+        "foo": "114",
+        "wts": "1702204169",
+        "zab": "1919810",
+        "w_rid": "8f6f2b5b3d485fe1886cec6a0be8c5d4",
+    }
+
+
+def test_sign_strips_reserved_characters():
+    signed = biliurl.signWbiParams({"keyword": "a!b'c(d)e*f"}, MIXIN_KEY, wts=1702204169)
+    assert signed["keyword"] == "abcdef"